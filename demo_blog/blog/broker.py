@@ -0,0 +1,213 @@
+"""
+Delivery of new comments to the browsers watching a post, for
+comment_events, the server-sent events view.
+
+Comment.save() publishes each new comment, once it's committed, to the
+broker named by the BLOG_COMMENT_BROKER setting, on its post's channel.
+The message is the comment's comment_data() as JSON, so the comment is
+rendered once however many browsers are watching.  Two brokers come
+with the blog:
+
+- LocalBroker keeps subscribers in memory, so it only reaches browsers
+  connected to the process the comment was posted through.  It's the
+  default, and all that runserver or a single threaded process needs.
+- PostgresBroker uses LISTEN/NOTIFY, so every process connected to the
+  database hears every comment.  Each subscriber holds a connection of
+  its own while it listens.
+
+Set BLOG_COMMENT_BROKER to None to stop publishing comments.
+"""
+
+import copy
+import json
+import Queue
+import select
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+from django.template.loader import render_to_string
+from django.utils.importlib import import_module
+
+
+#messages waiting for a LocalBroker subscriber that isn't keeping up are
+#dropped past this many
+LOCAL_QUEUE_SIZE = 100
+
+#NOTIFY payloads must be shorter than 8000 bytes; longer messages are sent
+#without the comment's markup, which subscribers then render themselves
+NOTIFY_MAX_PAYLOAD = 7900
+
+
+def comment_data(comment):
+    """
+    A comment as it's sent to scripts on the post's page: its id, its
+    parent's id, and its markup, without any replies (which have their own
+    markup, to go inside it).
+    """
+    #a copy, so the comment's own replies aren't changed under its owner
+    childless = copy.copy(comment)
+    childless._replies_cache = []
+    return {'id': comment.pk,
+            'parent_id': comment.parent_id,
+            'html': render_to_string('blog/comment_inline.html', {'comment': childless})}
+
+
+def post_channel(post_id):
+    """
+    The channel a post's new comments are published on.  It's also a
+    valid postgres identifier, as LISTEN needs.
+    """
+    return 'blog_post_%s' % post_id
+
+
+class LocalSubscription(object):
+
+    def __init__(self, broker, channel):
+        self.broker = broker
+        self.channel = channel
+        self.queue = Queue.Queue(LOCAL_QUEUE_SIZE)
+
+    def get(self, timeout):
+        """
+        The next message, waiting up to timeout seconds for one, or None if
+        none came.
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker(object):
+    """
+    Publishes messages to subscribers in this process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = {}     #channel: set of subscriptions
+
+    def has_subscribers(self, channel):
+        return bool(self.subscriptions.get(channel))
+
+    def publish(self, channel, message):
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.queue.put_nowait(message)
+            except Queue.Full:
+                pass
+
+    def subscribe(self, channel):
+        """
+        Start listening on a channel.  Close the subscription when done.
+        """
+        subscription = LocalSubscription(self, channel)
+        with self.lock:
+            self.subscriptions.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.channel, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self.subscriptions.pop(subscription.channel, None)
+
+
+class PostgresSubscription(object):
+
+    def __init__(self, channel):
+        import psycopg2
+        import psycopg2.extensions
+        settings_dict = connection.settings_dict
+        params = {'database': settings_dict['NAME']}
+        for param, setting in (('user', 'USER'), ('password', 'PASSWORD'),
+                               ('host', 'HOST'), ('port', 'PORT')):
+            if settings_dict[setting]:
+                params[param] = settings_dict[setting]
+        self.connection = psycopg2.connect(**params)
+        self.connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        self.connection.cursor().execute('LISTEN %s' % channel)
+
+    def get(self, timeout):
+        """
+        The next message, waiting up to timeout seconds for one, or None if
+        none came.
+        """
+        if not self.connection.notifies:
+            if select.select([self.connection], [], [], timeout) == ([], [], []):
+                return None
+            self.connection.poll()
+            if not self.connection.notifies:
+                return None
+        return self.connection.notifies.pop(0).payload
+
+    def close(self):
+        self.connection.close()
+
+
+class PostgresBroker(object):
+    """
+    Publishes messages with postgres' NOTIFY, to subscribers in any process
+    using the same database.
+    """
+
+    def has_subscribers(self, channel):
+        #listeners in other processes can't be seen from here
+        return True
+
+    def publish(self, channel, message):
+        cursor = connection.cursor()
+        cursor.execute('SELECT pg_notify(%s, %s)', [channel, message])
+        #notifications are only sent once the transaction commits
+        transaction.commit_unless_managed()
+
+    def subscribe(self, channel):
+        return PostgresSubscription(channel)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+def get_broker():
+    """
+    The broker named by BLOG_COMMENT_BROKER, or None if comments aren't
+    published.  Every thread shares one.
+    """
+    global _broker
+    path = getattr(settings, 'BLOG_COMMENT_BROKER', 'demo_blog.blog.broker.LocalBroker')
+    if path is None:
+        return None
+    with _broker_lock:
+        if _broker is None or _broker.path != path:
+            module_name, class_name = path.rsplit('.', 1)
+            try:
+                broker_class = getattr(import_module(module_name), class_name)
+            except (ImportError, AttributeError), e:
+                raise ImproperlyConfigured("Can't load BLOG_COMMENT_BROKER %r: %s" % (path, e))
+            _broker = broker_class()
+            _broker.path = path
+        return _broker
+
+
+def publish_comment(comment):
+    """
+    Send a new comment to everyone subscribed to its post's channel.
+    """
+    broker = get_broker()
+    channel = post_channel(comment.post_id)
+    if broker is None or not broker.has_subscribers(channel):
+        return
+    data = comment_data(comment)
+    message = json.dumps(data)
+    if len(message) > NOTIFY_MAX_PAYLOAD and isinstance(broker, PostgresBroker):
+        del data['html']
+        message = json.dumps(data)
+    broker.publish(channel, message)
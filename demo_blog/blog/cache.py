@@ -0,0 +1,210 @@
+"""
+Caching of rendered pages and fragments of pages.
+
+Cached content is never deleted when what it shows changes.  Instead,
+every cache key includes a version number for the thing the content
+shows, and the version is bumped when that thing changes (see the signal
+handlers in models.py).  Stale content then simply stops being looked up
+and expires, and there's no need to know every URL and query string a
+page might have been cached under.
+
+Versions are named; the list of posts is POST_LIST_VERSION and each
+post's page is post_version(post.pk).
+
+Each post's comments are also cached, in a compact form, for the comment
+threads to be paged through without the database (see get_comment_tree()).
+Unlike the rendered content, that's updated in place when a comment is added.
+
+Every lookup sends cache_hit or cache_miss, with kind saying what was looked
+up, for anything counting how well the cache works (see middleware.py).
+"""
+
+import cPickle as pickle
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.dispatch import Signal
+
+cache_hit = Signal(providing_args=['kind'])
+cache_miss = Signal(providing_args=['kind'])
+
+#how long rendered pages and fragments are kept, in seconds
+PAGE_CACHE_TIMEOUT = getattr(settings, 'BLOG_PAGE_CACHE_TIMEOUT', 60 * 60)
+
+#version bumped whenever anything shown on the list of posts changes
+POST_LIST_VERSION = 'posts'
+
+
+def post_version(post_id):
+    """
+    The name of the version bumped whenever anything shown on a post's page changes.
+    """
+    return 'post:%s' % post_id
+
+
+def _version_key(name):
+    return 'blog:version:%s' % name
+
+
+def _initial_version():
+    #versions start from the clock rather than from 1, so that a version
+    #which has been evicted can't restart at a number that still has
+    #cached content filed under it.
+    return int(time.time() * 1000)
+
+
+def get_version(name):
+    """
+    The current value of a version.
+    """
+    version = cache.get(_version_key(name))
+    if version is None:
+        cache.add(_version_key(name), _initial_version())
+        version = cache.get(_version_key(name))
+    return version
+
+
+def bump_version(name):
+    """
+    Change a version, so nothing cached under the old value is used again.
+    """
+    try:
+        cache.incr(_version_key(name))
+    except ValueError:
+        #incr raises ValueError if the key isn't there
+        cache.set(_version_key(name), _initial_version())
+
+
+def _content_key(kind, version_name, vary):
+    #vary can be anything (e.g. a path with a query string), so hash it
+    #to keep the key short and free of characters memcached won't take.
+    return 'blog:%s:%s:%s:%s' % (kind, version_name, get_version(version_name),
+                                 hashlib.md5(vary.encode('utf-8')).hexdigest())
+
+
+def _counted(kind, value):
+    #send cache_hit or cache_miss for a value just looked up
+    (cache_miss if value is None else cache_hit).send(sender=None, kind=kind)
+    return value
+
+
+def get_content(kind, version_name, vary):
+    """
+    Get rendered content cached by set_content(), or None if there isn't
+    any for the current version.
+    
+    kind says what sort of content it is (e.g. 'page'), and vary tells
+    apart different content of that kind under the same version.
+    """
+    return _counted(kind, cache.get(_content_key(kind, version_name, vary)))
+
+
+def set_content(kind, version_name, vary, content):
+    """
+    Cache rendered content under the current value of version_name.
+    """
+    cache.set(_content_key(kind, version_name, vary), content, PAGE_CACHE_TIMEOUT)
+
+
+def _slug_key(slug):
+    return 'blog:post_id:%s' % slug
+
+
+def get_post_id(slug):
+    """
+    The pk of the post with this slug, if it's cached.
+    
+    This lets a post's cached page be found from its URL without a query.
+    """
+    return _counted('post_id', cache.get(_slug_key(slug)))
+
+
+def set_post_id(slug, post_id):
+    cache.set(_slug_key(slug), post_id, PAGE_CACHE_TIMEOUT)
+
+
+def forget_post_id(slug):
+    cache.delete(_slug_key(slug))
+
+
+def comment_tree_max_comments():
+    """
+    Posts with more comments than this don't have their comments cached
+    with set_comment_tree(), so they aren't all loaded just to find out
+    they're too big to cache.
+    """
+    return getattr(settings, 'BLOG_COMMENT_TREE_MAX_COMMENTS', 1000)
+
+
+def comment_tree_max_bytes():
+    """
+    A post's comments are only cached by set_comment_tree() if they pickle
+    to no more than this, to keep within memcached's limit on the size of a
+    value (1MB by default), whatever the length of the comments.
+    """
+    return getattr(settings, 'BLOG_COMMENT_TREE_MAX_BYTES', 1000 * 1000)
+
+
+#the fields of a comment kept in the cache of a post's comments, in the order
+#they're stored in each node; see Comment.tree_node()
+TREE_NODE_FIELDS = ('id', 'parent', 'thread_path', 'user', 'user_name', 'content', 'created',
+                    'is_removed')
+
+#bumped whenever what set_comment_tree() caches around the nodes changes
+#shape.  The key also changes with TREE_NODE_FIELDS, so comments cached in
+#an old shape aren't read as the new one after either changes.
+COMMENT_TREE_FORMAT = '%s.%s' % (2, hashlib.md5(','.join(TREE_NODE_FIELDS)).hexdigest()[:8])
+
+
+def _comment_tree_key(post_id):
+    return 'blog:comment_tree:%s:%s' % (COMMENT_TREE_FORMAT, post_id)
+
+
+def get_comment_tree(post_id):
+    """
+    The comments on a post cached by set_comment_tree(), as a pair of the
+    count_error and nodes it was given, or None.  nodes is None if they
+    were too big to cache.
+    """
+    return _counted('comment_tree', cache.get(_comment_tree_key(post_id)))
+
+
+def set_comment_tree(post_id, nodes, count_error=0):
+    """
+    Cache the comments on a post as a list of nodes, each a tuple of the
+    comment's fields (see Comment.tree_node()), along with count_error, how
+    far the post's comment_count was from the number of them.
+    
+    Returns False if the nodes are too big to cache (see
+    comment_tree_max_bytes()).  That's cached instead, so that they aren't
+    loaded again for every page only to find that out.
+    """
+    cached = len(pickle.dumps(nodes)) <= comment_tree_max_bytes()
+    cache.set(_comment_tree_key(post_id), (count_error, nodes if cached else None),
+              PAGE_CACHE_TIMEOUT)
+    return cached
+
+
+def append_to_comment_tree(post_id, node):
+    """
+    Add a new comment's node to the end of the post's cached comments, if
+    they're cached.
+    
+    If two comments are added at once, one of them can be lost.  Readers
+    check the number of nodes against the post's comment_count, so a tree
+    that's missing a comment is noticed and reloaded rather than shown.
+    """
+    tree = cache.get(_comment_tree_key(post_id))
+    if tree is not None and tree[1] is not None:
+        count_error, nodes = tree
+        nodes.append(node)
+        set_comment_tree(post_id, nodes, count_error)
+
+
+def forget_comment_tree(post_id):
+    """
+    Stop using the post's cached comments, e.g. after one's changed or deleted.
+    """
+    cache.delete(_comment_tree_key(post_id))
@@ -0,0 +1,189 @@
+"""
+A management command which fills a throwaway test database with
+synthetic posts and comment threads, sends requests to the blog's
+busiest pages through the test client, and reports latency percentiles,
+throughput and queries per request for each::
+
+    manage.py benchmark_blog --posts=200 --threads=20 --depth=4 --fanout=2
+
+The test database is created with whatever database backend settings.py
+uses, so point it at sqlite or a local postgres to benchmark either; the
+real database is never touched.  Caching is whatever settings.py sets up.
+
+Anonymous page views are served from the page cache after the first
+request for each page, so run it both with and without ``--logged-in``
+to see the cache's effect.  Use ``--json`` to keep the results, so later
+runs can be compared to spot regressions.
+
+"""
+
+import json
+import random
+import time
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import NoArgsCommand
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.test.client import Client
+
+from ...models import Post, Comment
+from .import_blog import BlogImporter, keeping_timestamps
+
+
+#the pages benchmarked, in the order they're run
+ENDPOINTS = ['post-list', 'post-detail', 'comment-create', 'reply-create']
+
+BENCHMARK_USERNAME = 'benchmark'
+BENCHMARK_PASSWORD = 'benchmark'
+
+
+def thread_records(post_id, threads, depth, fanout, next_id):
+    """
+    Export-style records for threads top-level comments on a post, each with
+    fanout replies, each of those with fanout replies, and so on down to
+    depth levels of replies.  Comment ids start from next_id.
+    """
+    records = []
+    for thread in range(threads):
+        level = [None]
+        for current_depth in range(depth + 1):
+            next_level = []
+            for parent_id in level:
+                for i in range(1 if parent_id is None else fanout):
+                    records.append({'type': 'comment', 'id': next_id, 'post': post_id,
+                                    'parent': parent_id, 'user_name': 'commenter%s' % next_id,
+                                    'content': 'Comment %s at depth %s. ' % (next_id, current_depth) * 5})
+                    next_level.append(next_id)
+                    next_id += 1
+            level = next_level
+    return records
+
+
+def percentile(sorted_values, percent):
+    """
+    The nearest-rank percentile of an already sorted list.
+    """
+    index = max(0, int(round(percent / 100.0 * len(sorted_values))) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+class Command(NoArgsCommand):
+    help = "Benchmark the post list, post page and commenting on synthetic data"
+    option_list = NoArgsCommand.option_list + (
+        make_option('--posts', type='int', dest='posts', default=50,
+                    help='Posts to create.'),
+        make_option('--threads', type='int', dest='threads', default=10,
+                    help='Top-level comments on each post.'),
+        make_option('--depth', type='int', dest='depth', default=3,
+                    help='Levels of replies under each top-level comment.'),
+        make_option('--fanout', type='int', dest='fanout', default=2,
+                    help='Replies to each comment that has any.'),
+        make_option('--requests', type='int', dest='requests', default=200,
+                    help='Requests to send to each page.'),
+        make_option('--logged-in', action='store_true', dest='logged_in', default=False,
+                    help="Send requests as a logged-in user, which the page cache doesn't serve."),
+        make_option('--seed', type='int', dest='seed', default=0,
+                    help='Random seed, so runs choose the same posts and comments.'),
+        make_option('--json', dest='json',
+                    help='Also write the results to this file as JSON.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        random.seed(options['seed'])
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=verbosity)
+        try:
+            start = time.time()
+            comments = self.seed(options)
+            if verbosity >= 1:
+                self.stdout.write("Created %s posts and %s comments in %.1f s.\n" %
+                                  (options['posts'], comments, time.time() - start))
+            results = self.run(options)
+        finally:
+            connection.use_debug_cursor = None
+            connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+
+        self.stdout.write("%-15s %8s %9s %9s %9s %9s %9s\n" %
+                          ('page', 'requests', 'p50 ms', 'p90 ms', 'p99 ms', 'req/s', 'queries'))
+        for result in results:
+            self.stdout.write("%(endpoint)-15s %(requests)8d %(p50)9.1f %(p90)9.1f %(p99)9.1f "
+                              "%(throughput)9.1f %(queries)9.1f\n" % result)
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump({'options': dict((name, options[name]) for name in
+                                           ('posts', 'threads', 'depth', 'fanout',
+                                            'requests', 'logged_in', 'seed')),
+                           'database': connection.vendor,
+                           'results': results}, f, indent=2)
+
+    @transaction.commit_on_success
+    def seed(self, options):
+        """
+        Create the user, posts and comments to benchmark with, using the
+        import_blog machinery.  Returns the number of comments.
+        """
+        User.objects.create_user(BENCHMARK_USERNAME, 'benchmark@example.com', BENCHMARK_PASSWORD)
+        importer = BlogImporter(batch_size=1000)
+        with keeping_timestamps(Post, Comment):
+            next_comment_id = 1
+            for post_id in range(1, options['posts'] + 1):
+                importer.add({'type': 'post', 'id': post_id, 'owner': BENCHMARK_USERNAME,
+                              'title': 'Benchmark post %s' % post_id,
+                              'content': 'Some words about benchmarking. ' * 50})
+            for post_id in range(1, options['posts'] + 1):
+                records = thread_records(post_id, options['threads'], options['depth'],
+                                         options['fanout'], next_comment_id)
+                for record in records:
+                    importer.add(record)
+                next_comment_id += len(records)
+            importer.finish()
+        return importer.comment_total
+
+    def run(self, options):
+        """
+        Send the requests, returning a dict of results for each endpoint.
+        """
+        client = Client()
+        if options['logged_in']:
+            client.login(username=BENCHMARK_USERNAME, password=BENCHMARK_PASSWORD)
+        slugs = list(Post.objects.values_list('slug', flat=True))
+        comments = list(Comment.objects.values_list('pk', 'post__slug'))
+        comment_data = {'user_name': 'benchmarker', 'content': 'A benchmark comment.'}
+
+        def request(endpoint):
+            if endpoint == 'post-list':
+                return client.get(reverse('post-list'))
+            if endpoint == 'post-detail':
+                return client.get(reverse('post-detail', kwargs={'slug': random.choice(slugs)}))
+            if endpoint == 'comment-create':
+                return client.post(reverse('comment-create', kwargs={'post_slug': random.choice(slugs)}),
+                                   comment_data)
+            comment_id, slug = random.choice(comments)
+            return client.post(reverse('reply-create', kwargs={'post_slug': slug, 'parent_id': comment_id}),
+                               comment_data)
+
+        connection.use_debug_cursor = True
+        results = []
+        for endpoint in ENDPOINTS:
+            times = []
+            queries = 0
+            for i in range(options['requests']):
+                connection.queries = []
+                start = time.time()
+                response = request(endpoint)
+                times.append(time.time() - start)
+                queries += len(connection.queries)
+                if response.status_code not in (200, 302):
+                    raise ValueError("%s returned %s" % (endpoint, response.status_code))
+            times.sort()
+            results.append({'endpoint': endpoint,
+                            'requests': len(times),
+                            'p50': percentile(times, 50) * 1000,
+                            'p90': percentile(times, 90) * 1000,
+                            'p99': percentile(times, 99) * 1000,
+                            'throughput': len(times) / sum(times),
+                            'queries': float(queries) / len(times)})
+        return results
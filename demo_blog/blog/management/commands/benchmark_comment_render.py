@@ -0,0 +1,109 @@
+"""
+A management command which times rendering comment threads with the
+comment_tree template tag against the recursive {% include %} template it
+replaced, for deep and for wide threads.
+
+The threads are built in memory, so this needs no database and measures
+nothing but rendering.  For example::
+
+    manage.py benchmark_comment_render --depth=100 --breadth=1 --threads=10
+
+Without options, a deep and a wide shape are both run.
+
+"""
+
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.template import Context, Template
+from django.utils import timezone
+
+from ...models import Post, Comment
+
+
+INCLUDE_TEMPLATE = Template("{% for comment in comments %}<li>"
+                            "{% include 'blog/benchmark/comment_inline_include.html' %}"
+                            "</li>{% endfor %}")
+TAG_TEMPLATE = Template("{% load comment_tree %}{% comment_tree comments %}")
+
+#(name, depth, breadth, threads) run when no shape is given
+DEFAULT_SHAPES = [('deep', 30, 1, 20),
+                  ('wide', 2, 30, 5)]
+
+
+def build_threads(depth, breadth, threads):
+    """
+    Build comment threads in memory: threads top-level comments, each with
+    breadth replies, each of those with breadth replies, and so on down to
+    depth levels of replies.  Returns the top-level comments, as
+    Comment.build_tree() would.
+    """
+    post = Post(pk=1, title='Benchmark', slug='benchmark')
+    now = timezone.now()
+    comments = []
+    level = [None] * threads
+    for current_depth in range(depth + 1):
+        next_level = []
+        for parent in level:
+            for i in range(1 if parent is None else breadth):
+                comment = Comment(pk=len(comments) + 1, post=post,
+                                  user_name='user%s' % len(comments),
+                                  content='Comment at depth %s & <such>.' % current_depth,
+                                  created=now,
+                                  parent_id=parent.pk if parent else None)
+                comments.append(comment)
+                next_level.append(comment)
+        level = next_level
+    return Comment.build_tree(comments, post=post), len(comments)
+
+
+def time_render(template, comments, repeat):
+    """
+    The best time, in seconds, of repeat renders of template, or the
+    exception raised trying.
+    """
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        try:
+            template.render(Context({'comments': comments}))
+        except RuntimeError, e:
+            #the include-based template recurses once per level of replies
+            return e
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+class Command(NoArgsCommand):
+    help = "Compare the speed of the comment_tree tag and recursive includes"
+    option_list = NoArgsCommand.option_list + (
+        make_option('--depth', type='int', dest='depth',
+                    help='Levels of replies under each top-level comment.'),
+        make_option('--breadth', type='int', dest='breadth', default=1,
+                    help='Replies to each comment that has any.'),
+        make_option('--threads', type='int', dest='threads', default=10,
+                    help='Number of top-level comments.'),
+        make_option('--repeat', type='int', dest='repeat', default=5,
+                    help='Renders of each template; the best time is reported.'),
+    )
+
+    def handle_noargs(self, **options):
+        if options['depth'] is None:
+            shapes = DEFAULT_SHAPES
+        else:
+            shapes = [('custom', options['depth'], options['breadth'], options['threads'])]
+        
+        for name, depth, breadth, threads in shapes:
+            comments, count = build_threads(depth, breadth, threads)
+            self.stdout.write("%s: %s comments (depth %s, breadth %s, %s threads)\n" %
+                              (name, count, depth, breadth, threads))
+            for label, template in (('include', INCLUDE_TEMPLATE),
+                                    ('comment_tree', TAG_TEMPLATE)):
+                result = time_render(template, comments, options['repeat'])
+                if isinstance(result, Exception):
+                    self.stdout.write("  %-12s failed: %s\n" % (label, result))
+                else:
+                    self.stdout.write("  %-12s %8.1f ms\n" % (label, result * 1000))
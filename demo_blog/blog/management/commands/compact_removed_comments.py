@@ -0,0 +1,94 @@
+"""
+A management command which deletes removed comments for good where
+there's nothing left to show under them: removed comments whose replies
+(and theirs, etc.) were all removed too.  Removed comments with replies
+still showing stay, as placeholders.  Run it off-peak, e.g. nightly::
+
+    manage.py compact_removed_comments
+
+Only posts with removed comments are looked at.  Each post's comments
+are read in one query, which is enough to find its dead subtrees from
+their thread paths, and those are deleted a batch of ids per DELETE, in
+one transaction per post.
+
+"""
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+from django.db.models import F
+
+from ...cache import bump_version, post_version, forget_comment_tree
+from ...models import Comment, THREAD_PATH_SEPARATOR, THREAD_PATH_SEGMENT_WIDTH
+
+
+class Command(NoArgsCommand):
+    help = "Delete removed comments that have no replies left showing"
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+                    help='Comments to delete per query.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Only count the comments that would be deleted.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        post_ids = list(Comment.objects.filter(is_removed=True).order_by()
+                                       .values_list('post', flat=True).distinct())
+        deleted = 0
+        for post_id in post_ids:
+            post_deleted = self.compact_post(post_id, options['batch_size'], options['dry_run'])
+            if post_deleted and not options['dry_run']:
+                forget_comment_tree(post_id)
+                bump_version(post_version(post_id))
+            deleted += post_deleted
+            if verbosity >= 2:
+                self.stdout.write("Post %s: %s comments.\n" % (post_id, post_deleted))
+
+        if verbosity >= 1:
+            self.stdout.write("%s %s removed comments from %s posts.\n" %
+                              ('Would delete' if options['dry_run'] else 'Deleted',
+                               deleted, len(post_ids)))
+
+    @transaction.commit_on_success
+    def compact_post(self, post_id, batch_size, dry_run):
+        """
+        Delete the dead subtrees on one post, returning how many comments
+        they had.
+        """
+        comments = list(Comment.objects.filter(post=post_id).order_by()
+                                       .values_list('pk', 'thread_path', 'is_removed'))
+        #comments still showing, and every comment above one of them
+        keep = set()
+        for pk, thread_path, is_removed in comments:
+            if not is_removed:
+                keep.add(pk)
+                if thread_path:
+                    keep.update(int(segment) for segment in thread_path.split(THREAD_PATH_SEPARATOR))
+        dead = [(pk, thread_path) for pk, thread_path, is_removed in comments if pk not in keep]
+        if dry_run or not dead:
+            return len(dead)
+
+        #dead replies come off their thread's count, unless the whole thread's dead
+        dead_ids = set(pk for pk, thread_path in dead)
+        thread_counts = {}
+        for pk, thread_path in dead:
+            if thread_path:
+                root_id = int(thread_path[:THREAD_PATH_SEGMENT_WIDTH])
+                if root_id not in dead_ids:
+                    thread_counts[root_id] = thread_counts.get(root_id, 0) + 1
+
+        #a raw DELETE, since Django's would load each comment to cascade to
+        #its replies, which are all being deleted anyway
+        table = connection.ops.quote_name(Comment._meta.db_table)
+        cursor = connection.cursor()
+        ids = sorted(dead_ids)
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+            cursor.execute('DELETE FROM ' + table + ' WHERE id IN (' +
+                           ', '.join(['%s'] * len(batch)) + ')', batch)
+        transaction.set_dirty()
+        for root_id, count in thread_counts.items():
+            Comment.objects.filter(pk=root_id).update(descendant_count=F('descendant_count') - count)
+        return len(ids)
@@ -0,0 +1,101 @@
+"""
+A management command which writes every post and comment out as JSON
+Lines, one record per line, for ``manage.py import_blog`` to read back in::
+
+    manage.py export_blog > blog.jsonl
+    manage.py import_blog blog.jsonl
+
+Posts come first, then comments, each in order of id, so every comment
+follows its post and its parent.  The records look like::
+
+    {"type": "post", "id": 1, "title": "...", "content": "...",
+     "owner": "username", "slug": "...", "created": "...", "modified": "..."}
+    {"type": "comment", "id": 7, "post": 1, "parent": null, "user": "username",
+     "user_name": "...", "content": "...", "created": "...", "modified": "...",
+     "is_removed": false}
+
+ids are only used to link records together; importing gives everything
+new ids.  A comment's user is null if it was left anonymously.
+
+Rows are read a batch at a time, so memory use doesn't grow with the
+size of the blog.
+
+"""
+
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
+
+from ...models import Post, Comment
+
+
+class ExportEncoder(DjangoJSONEncoder):
+    """
+    Writes dates with all their microseconds (DjangoJSONEncoder drops all
+    but the milliseconds), so that posts keep their exact order.
+    """
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super(ExportEncoder, self).default(o)
+
+
+def batches(queryset, batch_size):
+    """
+    Yield the rows of a values() queryset batch_size at a time, in order of id.
+    """
+    last_id = 0
+    while True:
+        rows = list(queryset.filter(pk__gt=last_id).order_by('pk')[:batch_size])
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1]['id']
+
+
+class Command(BaseCommand):
+    help = "Write all posts and comments out as JSON Lines"
+    args = '[file]'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+                    help='Rows to read per query.'),
+    )
+
+    def handle(self, filename=None, **options):
+        verbosity = int(options.get('verbosity', 1))
+        output = open(filename, 'w') if filename else self.stdout
+        encoder = ExportEncoder(sort_keys=True)
+        batch_size = options['batch_size']
+
+        def write(record):
+            output.write(encoder.encode(record) + '\n')
+
+        posts = Post.objects.values('id', 'title', 'content', 'owner__username',
+                                    'slug', 'created', 'modified')
+        post_count = 0
+        for rows in batches(posts, batch_size):
+            for row in rows:
+                row['type'] = 'post'
+                row['owner'] = row.pop('owner__username')
+                write(row)
+            post_count += len(rows)
+
+        #a left join, so anonymous comments have no username
+        comments = Comment.objects.filter(post__deleted=False) \
+                                  .values('id', 'post', 'parent', 'user__username',
+                                          'user_name', 'content', 'created', 'modified',
+                                          'is_removed')
+        comment_count = 0
+        for rows in batches(comments, batch_size):
+            for row in rows:
+                row['type'] = 'comment'
+                row['user'] = row.pop('user__username')
+                write(row)
+            comment_count += len(rows)
+
+        if filename:
+            output.close()
+        if verbosity >= 1:
+            self.stderr.write("Exported %s posts and %s comments.\n" % (post_count, comment_count))
@@ -0,0 +1,285 @@
+"""
+A management command which loads posts and comments from JSON Lines, as
+written by ``manage.py export_blog`` (see there for the format)::
+
+    manage.py import_blog blog.jsonl
+
+Everything imported gets a new id, so a blog can be loaded alongside
+posts already in the database.  Rows are added with bulk_create a batch
+at a time, and each comment's thread_path and the comment counts are
+worked out in memory from the parent links instead of saving comments
+one by one, so even a million comments take minutes rather than days.
+
+Posts keep their slugs unless the slug is taken, in which case they get
+a new one just as if they'd been posted now.  Post owners are looked up
+by username (see ``--owner`` for owners who don't exist here); comments
+by users who don't exist here are imported as anonymous, keeping their
+user_name.
+
+The whole file is imported in one transaction.  New ids are handed out
+by the command itself, so nothing else should add posts or comments
+while it runs.
+
+"""
+
+import json
+import sys
+from contextlib import contextmanager
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from ...cache import bump_version, POST_LIST_VERSION
+from ...models import Post, Comment
+
+
+#sqlite refuses queries with more parameters than this
+SQLITE_MAX_PARAMETERS = 999
+
+#ids per UPDATE when setting the comment counts
+UPDATE_BATCH_SIZE = 500
+
+
+@contextmanager
+def keeping_timestamps(*models):
+    """
+    Turn off auto_now and auto_now_add on models' date fields, so that
+    imported rows keep the dates they were exported with.
+    """
+    fields = [field for model in models for field in model._meta.local_fields
+              if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)]
+    settings = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in settings:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+def bulk_insert(model, objs, batch_size):
+    """
+    bulk_create objs, in batches small enough for the database.
+    """
+    if connection.vendor == 'sqlite':
+        batch_size = min(batch_size, SQLITE_MAX_PARAMETERS // len(model._meta.local_fields))
+    for start in range(0, len(objs), batch_size):
+        model.objects.bulk_create(objs[start:start + batch_size])
+
+
+def parse_date(value):
+    """
+    A datetime from an exported date, or now if there isn't one.
+    """
+    if not value:
+        return timezone.now()
+    date = parse_datetime(value)
+    if date is None:
+        raise CommandError("%r isn't a date." % value)
+    if timezone.is_naive(date):
+        date = timezone.make_aware(date, timezone.get_default_timezone())
+    return date
+
+
+class BlogImporter(object):
+    """
+    Turns exported records into posts and comments, and saves them a batch
+    at a time.  Call add() with each record in turn, then finish().
+    """
+
+    def __init__(self, batch_size, default_owner=None):
+        self.batch_size = batch_size
+        self.default_owner = default_owner
+        self.next_post_id = (Post.all_objects.aggregate(Max('pk'))['pk__max'] or 0) + 1
+        self.next_comment_id = (Comment.objects.aggregate(Max('pk'))['pk__max'] or 0) + 1
+        self.post_ids = {}          #exported post id: new post id
+        self.comment_paths = {}     #exported comment id: (new id, path of its replies)
+        self.post_counts = {}       #new post id: comments
+        self.thread_counts = {}     #new top-level comment id: replies
+        self.user_ids = {}          #username: user id, or None if there's no such user
+        self.posts = []             #(post, owner's username) waiting to be saved
+        self.comments = []          #(comment, user's username) waiting to be saved
+        self.post_total = 0
+        self.comment_total = 0
+
+    def add(self, record):
+        kind = record.get('type')
+        if kind == 'post':
+            self.add_post(record)
+        elif kind == 'comment':
+            self.add_comment(record)
+        else:
+            raise CommandError("Unknown record type %r." % kind)
+
+    def add_post(self, record):
+        if record['id'] in self.post_ids:
+            raise CommandError("Post %s is in the file twice." % record['id'])
+        post = Post(pk=self.next_post_id, title=record['title'], content=record['content'],
+                    slug=record.get('slug') or '',
+                    created=parse_date(record.get('created')),
+                    modified=parse_date(record.get('modified')))
+        self.next_post_id += 1
+        self.post_ids[record['id']] = post.pk
+        self.posts.append((post, record.get('owner')))
+        if len(self.posts) >= self.batch_size:
+            self.save_posts()
+
+    def add_comment(self, record):
+        if record['id'] in self.comment_paths:
+            raise CommandError("Comment %s is in the file twice." % record['id'])
+        try:
+            post_id = self.post_ids[record['post']]
+        except KeyError:
+            raise CommandError("Comment %s is on post %s, which isn't before it in the file." %
+                               (record['id'], record['post']))
+        parent_id = thread_path = None
+        if record.get('parent') is not None:
+            try:
+                parent_id, thread_path = self.comment_paths[record['parent']]
+            except KeyError:
+                raise CommandError("Comment %s replies to comment %s, which isn't before it in the file." %
+                                   (record['id'], record['parent']))
+
+        comment = Comment(pk=self.next_comment_id, post_id=post_id, parent_id=parent_id,
+                          user_name=record.get('user_name') or record.get('user') or 'Anonymous',
+                          content=record['content'], thread_path=thread_path,
+                          created=parse_date(record.get('created')),
+                          modified=parse_date(record.get('modified')),
+                          is_removed=bool(record.get('is_removed')))
+        self.next_comment_id += 1
+        self.comment_paths[record['id']] = (comment.pk, comment.child_thread_path)
+        if not comment.is_removed:
+            self.post_counts[post_id] = self.post_counts.get(post_id, 0) + 1
+        if comment.root_id is not None:
+            self.thread_counts[comment.root_id] = self.thread_counts.get(comment.root_id, 0) + 1
+        self.comments.append((comment, record.get('user')))
+        if len(self.comments) >= self.batch_size:
+            self.save_comments()
+
+    def look_up_users(self, usernames):
+        """
+        Find the ids of any of usernames not already looked up, in one query.
+        """
+        missing = set(usernames) - set(self.user_ids) - set([None])
+        if missing:
+            found = dict(User.objects.filter(username__in=missing).values_list('username', 'pk'))
+            for username in missing:
+                self.user_ids[username] = found.get(username)
+
+    def save_posts(self):
+        if not self.posts:
+            return
+        usernames = [username for post, username in self.posts]
+        if self.default_owner:
+            usernames.append(self.default_owner)
+        self.look_up_users(usernames)
+
+        slugs = [post.slug[:Post._meta.get_field('slug').max_length] for post, username in self.posts]
+        taken = set(Post.all_objects.filter(slug__in=[slug for slug in slugs if slug])
+                                    .values_list('slug', flat=True))
+        used = set()
+        for (post, username), slug in zip(self.posts, slugs):
+            post.owner_id = self.user_ids.get(username) or self.user_ids.get(self.default_owner)
+            if post.owner_id is None:
+                raise CommandError("Post %r is owned by %r, who isn't a user here; "
+                                   "use --owner to give such posts an owner." % (post.title, username))
+            if not slug or slug in taken or slug in used:
+                slug = post.allocate_slug(reserved=used)
+            post.slug = slug
+            used.add(slug)
+
+        bulk_insert(Post, [post for post, username in self.posts], self.batch_size)
+        self.post_total += len(self.posts)
+        self.posts = []
+
+    def save_comments(self):
+        if not self.comments:
+            return
+        #comments can't be saved before their posts
+        self.save_posts()
+        self.look_up_users([username for comment, username in self.comments])
+        for comment, username in self.comments:
+            comment.user_id = self.user_ids.get(username)
+
+        bulk_insert(Comment, [comment for comment, username in self.comments], self.batch_size)
+        self.comment_total += len(self.comments)
+        self.comments = []
+
+    def finish(self):
+        """
+        Save whatever's waiting, and bring the counts and sequences up to date.
+        """
+        self.save_posts()
+        self.save_comments()
+        set_counts(Post, 'comment_count', self.post_counts)
+        set_counts(Comment, 'descendant_count', self.thread_counts)
+
+        #ids were given explicitly, so postgres' sequences haven't moved
+        cursor = connection.cursor()
+        for sql in connection.ops.sequence_reset_sql(no_style(), [Post, Comment]):
+            cursor.execute(sql)
+
+
+def set_counts(model, field_name, counts):
+    """
+    Set field_name on the model with each pk in counts to the count.
+
+    Most counts are small numbers shared by many rows, so rows are
+    updated together by count, rather than one at a time.
+    """
+    pks_by_count = {}
+    for pk, count in counts.items():
+        pks_by_count.setdefault(count, []).append(pk)
+    for count, pks in pks_by_count.items():
+        for start in range(0, len(pks), UPDATE_BATCH_SIZE):
+            model.objects.filter(pk__in=pks[start:start + UPDATE_BATCH_SIZE]) \
+                         .update(**{field_name: count})
+
+
+class Command(BaseCommand):
+    help = "Load posts and comments from JSON Lines written by export_blog"
+    args = '<file>'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+                    help='Rows to insert per query.'),
+        make_option('--owner', dest='owner',
+                    help="Username to own posts whose owner doesn't exist here."),
+    )
+
+    def handle(self, filename=None, **options):
+        verbosity = int(options.get('verbosity', 1))
+        if not filename:
+            raise CommandError("Give the file to import, or - to read standard input.")
+        input = sys.stdin if filename == '-' else open(filename)
+
+        with transaction.commit_on_success():
+            with keeping_timestamps(Post, Comment):
+                importer = BlogImporter(options['batch_size'], options['owner'])
+                for line_number, line in enumerate(input, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        importer.add(json.loads(line))
+                    except ValueError, e:
+                        raise CommandError("Line %s: %s" % (line_number, e))
+                    except KeyError, e:
+                        raise CommandError("Line %s: missing %s." % (line_number, e))
+                    except CommandError, e:
+                        raise CommandError("Line %s: %s" % (line_number, e))
+                    if verbosity >= 2 and line_number % 10000 == 0:
+                        self.stdout.write("Read %s lines.\n" % line_number)
+                importer.finish()
+
+        if filename != '-':
+            input.close()
+        bump_version(POST_LIST_VERSION)
+        if verbosity >= 1:
+            self.stdout.write("Imported %s posts and %s comments.\n" %
+                              (importer.post_total, importer.comment_total))
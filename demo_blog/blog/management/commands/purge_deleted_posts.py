@@ -0,0 +1,47 @@
+"""
+A management command which deletes the posts marked deleted while
+BLOG_DEFER_POST_DELETION was on, along with their comments.  Run it from
+cron, e.g. nightly::
+
+    manage.py purge_deleted_posts
+
+Each post is deleted in a transaction of its own, its comments with one
+DELETE (see Post.delete()), so a large backlog doesn't hold one long
+transaction open.
+
+"""
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from ...models import Post
+
+
+class Command(NoArgsCommand):
+    help = "Delete posts marked deleted, and their comments"
+    option_list = NoArgsCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Only count the posts that would be deleted.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        post_ids = list(Post.all_objects.filter(deleted=True).order_by('pk')
+                                        .values_list('pk', flat=True))
+        if options['dry_run']:
+            if verbosity >= 1:
+                self.stdout.write("%s deleted posts would be purged.\n" % len(post_ids))
+            return
+
+        comments = 0
+        for post_id in post_ids:
+            post = Post.all_objects.get(pk=post_id)
+            comment_count = post.comment_count
+            post.delete()
+            comments += comment_count
+            if verbosity >= 2:
+                self.stdout.write("Purged %r and its %s comments.\n" % (post.title, comment_count))
+
+        if verbosity >= 1:
+            self.stdout.write("Purged %s deleted posts and %s comments.\n" % (len(post_ids), comments))
@@ -0,0 +1,79 @@
+"""
+A management command which recalculates every comment's thread_path
+from its parent links.
+
+Use it to backfill comments saved before thread paths were zero-padded
+(see ``blog.models.thread_path_segment``), or to repair paths after
+comments have been edited by hand.
+
+syncdb doesn't add indexes to tables that already exist; run
+``manage.py sqlindexes blog`` to get the statements that create the
+thread_path index (and, on postgres, its text_pattern_ops twin).
+
+"""
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from ...models import Post, Comment, THREAD_PATH_SEPARATOR, thread_path_segment
+
+
+class Command(NoArgsCommand):
+    help = "Recalculate the thread_path of every comment from its parent links"
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        updated = 0
+        for post_id in Post.objects.values_list('pk', flat=True).iterator():
+            updated += self.rebuild_post(post_id)
+        if verbosity >= 1:
+            self.stdout.write("Updated the thread path of %s comments.\n" % updated)
+
+    @transaction.commit_on_success
+    def rebuild_post(self, post_id):
+        """
+        Rebuild the paths of one post's comments.  Returns the number of
+        comments whose path changed.
+        
+        Replies to the same comment all share a path, so each group of
+        siblings is fixed with one UPDATE.
+        """
+        rows = Comment.objects.filter(post=post_id).values_list('pk', 'parent', 'thread_path')
+        parents = {}
+        old_paths = {}
+        for pk, parent_id, thread_path in rows:
+            parents[pk] = parent_id
+            old_paths[pk] = thread_path
+        
+        new_paths = {}
+        def child_path(pk):
+            segment = thread_path_segment(pk)
+            if new_paths[pk]:
+                return new_paths[pk] + THREAD_PATH_SEPARATOR + segment
+            return segment
+        
+        def path_for(pk):
+            #walk up to the nearest ancestor whose path is already known (or
+            #to the top of the thread), then fill in paths on the way back down.
+            #Iterative rather than recursive, so deep threads are fine.
+            chain = []
+            while pk is not None and pk not in new_paths:
+                chain.append(pk)
+                pk = parents.get(pk)
+            path = child_path(pk) if pk is not None else None
+            for pk in reversed(chain):
+                new_paths[pk] = path
+                path = child_path(pk)
+        
+        stale = {}
+        for pk in parents:
+            path_for(pk)
+        for pk, old_path in old_paths.items():
+            if new_paths[pk] != old_path:
+                stale.setdefault(new_paths[pk], []).append(pk)
+        
+        for path, pks in stale.items():
+            #keep the IN list under sqlite's limit on query parameters
+            for start in range(0, len(pks), 500):
+                Comment.objects.filter(pk__in=pks[start:start + 500]).update(thread_path=path)
+        return sum(len(pks) for pks in stale.values())
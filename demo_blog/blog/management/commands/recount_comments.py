@@ -0,0 +1,51 @@
+"""
+A management command which recalculates Post.comment_count and
+Comment.descendant_count from the comments actually in the database.
+Removed comments count towards their thread's descendant_count, since
+they're still in it as placeholders, but not their post's comment_count.
+
+The counts are normally kept up to date as comments are saved and
+deleted, but they can drift if comments are changed with raw SQL, or if
+a post or top-level comment is saved from a copy that was loaded before
+a comment was added.  Run this to fix them, and once after adding the
+count columns to an existing database.
+
+"""
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from django.db.models import Count
+
+from ...models import Post, Comment, THREAD_PATH_SEGMENT_WIDTH
+
+
+class Command(NoArgsCommand):
+    help = "Recalculate the denormalized comment counts on posts and threads"
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        
+        Post.objects.update(comment_count=0)
+        post_counts = (Comment.objects.filter(is_removed=False)
+                                      .values_list('post').annotate(Count('pk')).order_by())
+        for post_id, count in post_counts:
+            Post.objects.filter(pk=post_id).update(comment_count=count)
+        
+        #every reply's thread_path starts with the pk of its thread's top-level
+        #comment, so counting replies per distinct path and adding those up
+        #by that first segment gives each thread's size.
+        thread_counts = {}
+        path_counts = (Comment.objects.exclude(thread_path=None)
+                                      .values_list('thread_path').annotate(Count('pk')).order_by())
+        for thread_path, count in path_counts:
+            root_id = int(thread_path[:THREAD_PATH_SEGMENT_WIDTH])
+            thread_counts[root_id] = thread_counts.get(root_id, 0) + count
+        
+        Comment.objects.filter(thread_path=None).update(descendant_count=0)
+        for root_id, count in thread_counts.items():
+            Comment.objects.filter(pk=root_id).update(descendant_count=count)
+        
+        if verbosity >= 1:
+            self.stdout.write("Recounted comments on %s posts and %s threads.\n" %
+                              (len(post_counts), len(thread_counts)))
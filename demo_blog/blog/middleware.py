@@ -0,0 +1,157 @@
+"""
+Instrumentation of every request: the queries it ran and how long they took,
+how often the caches had what it looked up, and how long templates took to
+render, without needing DEBUG on.
+
+QueryInstrumentationMiddleware is listed in MIDDLEWARE_CLASSES but does
+nothing unless BLOG_INSTRUMENTATION is True.  When it is, each request is
+logged to the 'blog.instrumentation' logger as one line of key=value pairs
+(at WARNING if it took longer than BLOG_SLOW_REQUEST_TIME seconds, INFO
+otherwise), and the figures are added to the response as X-... headers,
+unless BLOG_INSTRUMENTATION_HEADERS is False.  Times are in milliseconds.
+
+Content streamed after the response leaves the middleware (e.g. the post
+page with ?stream=1) isn't counted.
+"""
+
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.template.base import Template
+
+from johnny.signals import qc_hit, qc_miss
+
+from .cache import cache_hit, cache_miss
+
+
+logger = logging.getLogger('blog.instrumentation')
+
+#the stats of the request this thread is handling, if it's being instrumented
+_local = threading.local()
+
+
+class RequestStats(object):
+    """
+    What one request has done so far.
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.template_time = 0.0
+        self.rendering = False
+        #each connection's use_debug_cursor before the request, and how many
+        #queries it had logged
+        self.connections = [(connection, connection.use_debug_cursor, len(connection.queries))
+                            for connection in connections.all()]
+        for connection, use_debug_cursor, queries in self.connections:
+            connection.use_debug_cursor = True
+
+    def finish(self):
+        """
+        Stop recording queries, and return the number run and their total
+        time in seconds.
+        """
+        count = 0
+        query_time = 0.0
+        for connection, use_debug_cursor, queries in self.connections:
+            new_queries = connection.queries[queries:]
+            count += len(new_queries)
+            query_time += sum(float(query['time']) for query in new_queries)
+            connection.use_debug_cursor = use_debug_cursor
+        return count, query_time
+
+
+def current_stats():
+    return getattr(_local, 'stats', None)
+
+
+def count_hit(sender, **kwargs):
+    stats = current_stats()
+    if stats is not None:
+        stats.cache_hits += 1
+
+
+def count_miss(sender, **kwargs):
+    stats = current_stats()
+    if stats is not None:
+        stats.cache_misses += 1
+
+
+def instrument_templates():
+    """
+    Make Template.render() add the time it takes to the current request's
+    stats.  Templates rendered while rendering another (includes, or those
+    rendered by template tags) are part of the outer one's time.
+    """
+    if getattr(Template.render, 'instrumented', False):
+        return
+    original_render = Template.render
+
+    def render(self, context):
+        stats = current_stats()
+        if stats is None or stats.rendering:
+            return original_render(self, context)
+        stats.rendering = True
+        start = time.time()
+        try:
+            return original_render(self, context)
+        finally:
+            stats.template_time += time.time() - start
+            stats.rendering = False
+    render.instrumented = True
+    Template.render = render
+
+
+class QueryInstrumentationMiddleware(object):
+    """
+    Records queries, cache hits and misses and template rendering time for
+    each request; see the module docstring.  List it first in
+    MIDDLEWARE_CLASSES, so that it sees the work of all the others.
+    """
+    def __init__(self):
+        if not getattr(settings, 'BLOG_INSTRUMENTATION', False):
+            raise MiddlewareNotUsed
+        self.slow_request_time = getattr(settings, 'BLOG_SLOW_REQUEST_TIME', 1.0)
+        self.add_headers = getattr(settings, 'BLOG_INSTRUMENTATION_HEADERS', True)
+        for signal in (qc_hit, cache_hit):
+            signal.connect(count_hit, dispatch_uid='blog.middleware.count_hit')
+        for signal in (qc_miss, cache_miss):
+            signal.connect(count_miss, dispatch_uid='blog.middleware.count_miss')
+        instrument_templates()
+
+    def process_request(self, request):
+        _local.stats = RequestStats()
+
+    def process_response(self, request, response):
+        stats = current_stats()
+        if stats is None:
+            #an earlier middleware answered before process_request was reached
+            return response
+        _local.stats = None
+        query_count, query_time = stats.finish()
+        elapsed = time.time() - stats.start
+
+        figures = [('Query-Count', query_count),
+                   ('Query-Time', '%.1f' % (query_time * 1000)),
+                   ('Cache-Hits', stats.cache_hits),
+                   ('Cache-Misses', stats.cache_misses),
+                   ('Template-Time', '%.1f' % (stats.template_time * 1000)),
+                   ('Response-Time', '%.1f' % (elapsed * 1000))]
+        if self.add_headers:
+            for name, value in figures:
+                response['X-%s' % name] = str(value)
+
+        slow = elapsed >= self.slow_request_time
+        logger.log(logging.WARNING if slow else logging.INFO,
+                   'method=%s path="%s" status=%s %s slow=%s',
+                   request.method, request.get_full_path().replace('"', '%22'),
+                   response.status_code,
+                   ' '.join('%s=%s' % (name.lower().replace('-', '_'), value)
+                            for name, value in figures),
+                   int(slow))
+        return response
@@ -1,10 +1,62 @@
-from django.db import models
+import logging
+import re
+
+from django.db import models, connection, transaction, IntegrityError
+from django.db.models import F, Q
+from django.db.models.signals import post_delete
 from django.contrib.auth.models import User
-from autoslug import AutoSlugField
 from django.core.urlresolvers import reverse_lazy
+from django.template.defaultfilters import slugify
 
+from django import forms
 from django.contrib import admin
 
+from ..transactions import commit_on_success_unless_managed
+from .cache import bump_version, post_version, POST_LIST_VERSION, set_post_id, forget_post_id
+from .cache import get_comment_tree, set_comment_tree, append_to_comment_tree, forget_comment_tree
+from .cache import comment_tree_max_comments, TREE_NODE_FIELDS
+from .broker import publish_comment
+
+logger = logging.getLogger('blog.models')
+
+#longest slug, and the longest numbered suffix ('-' and up to ten digits)
+#allowed for on the end of one
+SLUG_MAX_LENGTH = 50
+SLUG_SUFFIX_MAX_LENGTH = 11
+
+#times Post.save() will try another slug when a concurrent save took the one
+#it picked
+SLUG_ATTEMPTS = 5
+
+#slugs Post.allocate_slug() looks at per query for the highest numbered one
+SLUG_CANDIDATES = 10
+
+def reload_fields(instance, field_names):
+    """
+    Set the fields named on instance to what's stored in its row, so that
+    saving an instance loaded before they were last updated doesn't put
+    back old values.  Use within a transaction: the row is locked until it
+    ends (where the database can lock rows), so they can't change again
+    before the save.
+    """
+    if instance.pk is None:
+        return
+    stored = instance.__class__._base_manager.select_for_update() \
+                                             .filter(pk=instance.pk).values(*field_names)
+    for values in stored:
+        for name, value in values.items():
+            setattr(instance, name, value)
+
+class PostManager(models.Manager):
+    """
+    Posts that haven't been deleted.  Posts deleted while
+    BLOG_DEFER_POST_DELETION is on are only marked deleted (see
+    Post.tombstone()) until purge_deleted_posts removes them, and only
+    Post.all_objects finds them.
+    """
+    def get_query_set(self):
+        return super(PostManager, self).get_query_set().filter(deleted=False)
+
 class Post(models.Model):
     """
     A blog post.
@@ -14,20 +66,115 @@ class Post(models.Model):
     content = models.TextField()
     owner = models.ForeignKey(User)
 
-    #AutoSlugFields are automatically calculated upon save
-    #and in the case of a collision append -2, -3, etc.
-    slug = AutoSlugField(populate_from = lambda x: x.title,
-                         unique=True)
+    #slugs are calculated from the title on the first save, and in the case
+    #of a collision append -2, -3, etc.  See Post.allocate_slug().
+    slug = models.SlugField(max_length=SLUG_MAX_LENGTH, unique=True, editable=False)
     
     created = models.DateTimeField(auto_now_add = True)
     modified = models.DateTimeField(auto_now = True)
     
+    #number of comments on this post, kept up to date by Comment.save()
+    #and when comments are deleted.  See the recount_comments command.
+    #Post.save() never changes it.
+    comment_count = models.PositiveIntegerField(default=0, editable=False)
+    
+    #set by tombstone(); see PostManager.  Post.save() never changes it.
+    deleted = models.BooleanField(default=False, editable=False)
+    
+    objects = PostManager()
+    all_objects = models.Manager()
+    
     class Meta:
         """
         By default, sort by newest first.
         """
         ordering = ['-created']    
     
+    def save(self, *args, **kwargs):
+        """
+        Give a new post its slug.
+        
+        If another post is saved with the same slug at the same time, the
+        unique index refuses one of them, and that one picks another slug.
+        
+        Saving an existing post keeps the comment count stored for it, and
+        doesn't undo tombstone().
+        
+        The post's cache versions are bumped once it's committed (see
+        comment_changed()).
+        """
+        if self.slug:
+            with commit_on_success_unless_managed():
+                reload_fields(self, ('comment_count', 'deleted'))
+                super(Post, self).save(*args, **kwargs)
+        else:
+            with commit_on_success_unless_managed():
+                for attempt in range(SLUG_ATTEMPTS):
+                    self.slug = self.allocate_slug()
+                    savepoint = transaction.savepoint()
+                    try:
+                        super(Post, self).save(*args, **kwargs)
+                    except IntegrityError:
+                        transaction.savepoint_rollback(savepoint)
+                        if attempt == SLUG_ATTEMPTS - 1 or \
+                           not Post.all_objects.filter(slug=self.slug).exists():
+                            raise
+                    else:
+                        transaction.savepoint_commit(savepoint)
+                        break
+        post_saved(Post, self)
+    
+    def allocate_slug(self, reserved=()):
+        """
+        The first free slug for this post's title: the slugified title, or if
+        that's taken, the title followed by one more than the highest number
+        any post with the same title has, e.g. my-post-3 after my-post-2.
+        
+        Usually costs one query however many posts share the title.  A slug
+        that's just another post's title (e.g. that of "My post 2013") isn't
+        counted, nor is a number too long to have been allocated here, but
+        the number chosen is moved past any such slug that has it already.
+        Titles too long to be numbered are cut short enough to leave room for
+        any number.  Slugs in reserved are treated as taken too, e.g. those of
+        posts about to be saved alongside this one.
+        """
+        base = slugify(self.title)[:SLUG_MAX_LENGTH] or self._meta.module_name
+        stem = base[:SLUG_MAX_LENGTH - SLUG_SUFFIX_MAX_LENGTH]
+        
+        #the unnumbered slug sorts last, numbered ones longest (biggest) first.
+        #numbers have a digit less than there's room for, so one more still fits.
+        taken = Post.all_objects.filter(Q(slug=base) |
+                                        Q(slug__startswith=stem + '-',
+                                          slug__regex=r'^%s-[1-9][0-9]{0,%d}$' %
+                                                      (re.escape(stem), SLUG_SUFFIX_MAX_LENGTH - 3))) \
+                                .extra(select={'slug_order': "CASE WHEN slug = %s THEN 0 ELSE LENGTH(slug) END"},
+                                       select_params=(base,)) \
+                                .order_by('-slug_order', '-slug') \
+                                .values_list('slug', 'title', 'slug_order')
+        number = 1
+        start = 0
+        #titles' own slugs sorting before the highest allocated number, i.e.
+        #every taken slug with a higher number
+        skipped = set()
+        while number == 1:
+            candidates = list(taken[start:start + SLUG_CANDIDATES])
+            for slug, title, slug_order in candidates:
+                if slug == base:
+                    number = 2
+                    break
+                if slug != slugify(title)[:SLUG_MAX_LENGTH]:
+                    number = int(slug[len(stem) + 1:]) + 1
+                    break
+                skipped.add(slug)
+            if len(candidates) < SLUG_CANDIDATES:
+                break
+            start += SLUG_CANDIDATES
+        slug = base if number == 1 else '%s-%d' % (stem, number)
+        while slug in reserved or slug in skipped:
+            number += 1
+            slug = '%s-%d' % (stem, number)
+        return slug
+    
     def get_absolute_url(self):
         """
         The authoritative url for viewing a post.
@@ -54,7 +201,63 @@ class Post(models.Model):
         """
         return Comment.objects.filter(post=self)
     
+    def delete(self, *args, **kwargs):
+        """
+        Delete the post, deleting its comments first with one DELETE (see
+        delete_comments()) rather than letting Django load every one of
+        them to cascade.  Both are done in one transaction.
+        
+        Posts deleted by a queryset, e.g. by the admin's "delete selected"
+        action or along with their owner, don't come through here, so their
+        comments are loaded and deleted one at a time.  Posts with many
+        comments are better deleted one by one, or tombstoned.
+        """
+        pk = self.pk
+        with commit_on_success_unless_managed():
+            self._delete_comment_rows()
+            super(Post, self).delete(*args, **kwargs)
+        #only once it's committed (see comment_changed()); post_deleted()
+        #ran on post_delete, but before the commit
+        forget_comment_tree(pk)
+        forget_post_id(self.slug)
+        bump_version(post_version(pk))
+        bump_version(POST_LIST_VERSION)
+    
+    def delete_comments(self):
+        """
+        Delete every comment on this post with one DELETE, returning how
+        many there were.
+        
+        This skips the comments' delete signals, so the post's comment
+        count and cached comments are reset here instead.
+        """
+        with commit_on_success_unless_managed():
+            deleted = self._delete_comment_rows()
+        forget_comment_tree(self.pk)
+        bump_version(post_version(self.pk))
+        bump_version(POST_LIST_VERSION)
+        return deleted
+    
+    def _delete_comment_rows(self):
+        table = connection.ops.quote_name(Comment._meta.db_table)
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM ' + table + ' WHERE post_id = %s', [self.pk])
+        transaction.set_dirty()
+        Post.all_objects.filter(pk=self.pk).update(comment_count=0)
+        self.comment_count = 0
+        return cursor.rowcount
+    
+    def tombstone(self):
+        """
+        Mark the post deleted, which hides it at once, leaving it and its
+        comments for the purge_deleted_posts command to delete later.
+        """
+        Post.all_objects.filter(pk=self.pk).update(deleted=True)
+        self.deleted = True
+        post_deleted(Post, self)
+    
 #This is just to help with development; admin can post this way but staff cannot.        
+#Its "delete selected" action deletes comments one at a time; see Post.delete().
 admin.site.register(Post)
     
 
@@ -63,6 +266,122 @@ admin.site.register(Post)
 #see Comment.thread_path
 THREAD_PATH_SEPARATOR = ';'
 
+#every pk in a thread path is zero-padded to this many digits, which is enough
+#for any positive 32-bit integer pk.  Fixed-width segments mean paths sort
+#lexically in thread order and a prefix match can't confuse pk 1 with pk 12.
+THREAD_PATH_SEGMENT_WIDTH = 10
+
+def thread_path_segment(pk):
+    """
+    Encode a comment pk as one fixed-width segment of a thread path.
+    """
+    return str(pk).zfill(THREAD_PATH_SEGMENT_WIDTH)
+
+#database vendors whose subtree queries with a max_depth walk parent links
+#with a recursive CTE; see CommentManager.subtree()
+SUBTREE_CTE_VENDORS = ('postgresql',)
+
+def thread_order(comments):
+    """
+    Sort comments so that each is followed by all of its replies, and
+    those by theirs, etc.
+    """
+    return sorted(comments, key=lambda comment: comment.child_thread_path)
+
+class CommentManager(models.Manager):
+    """
+    Queries for parts of comment threads, each of them a single query.
+    
+    Most are answered from thread_path: a comment's descendants share a
+    prefix of it, found with one range scan of its index, and its ancestors'
+    pks are in it.  Where only the first few levels of a large subtree are
+    wanted, subtree() instead walks parent links with a recursive CTE on
+    databases in SUBTREE_CTE_VENDORS, reading just those levels.
+    """
+    
+    def subtree(self, comment, max_depth=None):
+        """
+        comment followed by its replies, and theirs, etc., in thread order,
+        down to max_depth levels below comment (all of them if None).
+        """
+        if max_depth is not None and max_depth < 1:
+            return [comment]
+        if max_depth is not None and connection.vendor in SUBTREE_CTE_VENDORS:
+            descendants = self._subtree_cte(comment, max_depth)
+        else:
+            descendants = self.filter(post=comment.post_id,
+                                      thread_path__startswith=comment.child_thread_path).order_by()
+            if max_depth is not None:
+                #a path of n segments is n * (width + 1) - 1 characters long
+                max_length = (comment.depth + max_depth) * (THREAD_PATH_SEGMENT_WIDTH + 1) - 1
+                descendants = descendants.extra(where=['LENGTH(thread_path) <= %s'],
+                                                params=[max_length])
+        return [comment] + thread_order(descendants)
+    
+    def _subtree_cte(self, comment, max_depth):
+        #the outer SELECT is for sqlite, which also understands this: python's
+        #sqlite3 commits the transaction before statements starting otherwise
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        sql = ('SELECT * FROM ('
+               ' WITH RECURSIVE subtree AS ('
+               '  SELECT ' + table + '.*, 1 AS relative_depth FROM ' + table +
+               '   WHERE parent_id = %s'
+               '  UNION ALL'
+               '  SELECT ' + table + '.*, subtree.relative_depth + 1 FROM ' + table +
+               '   JOIN subtree ON ' + table + '.parent_id = subtree.id'
+               '   WHERE subtree.relative_depth < %s'
+               ' ) SELECT * FROM subtree'
+               ') descendants')
+        return self.raw(sql, [comment.pk, max_depth])
+    
+    def ancestors(self, comment):
+        """
+        The comments that comment replies to, top-level comment first, found
+        by the pks in its thread_path.
+        """
+        pks = [int(pk) for pk in comment.path_list]
+        if not pks:
+            return []
+        return thread_order(self.filter(pk__in=pks).order_by())
+    
+    def thread_for_post(self, post, order='oldest'):
+        """
+        Every comment on post, with its threads oldest or newest first as
+        order says, and each thread in thread order (replies oldest first).
+        Use build_tree() to link them together.
+        """
+        if order not in ('oldest', 'newest'):
+            raise ValueError("order must be 'oldest' or 'newest', not %r" % order)
+        comments = thread_order(self.filter(post=post).order_by())
+        if order == 'newest':
+            #sorted() is stable, so each thread keeps its order
+            comments = sorted(comments, reverse=True,
+                              key=lambda comment: comment.root_id or comment.pk)
+        return comments
+    
+    def remove(self, comments):
+        """
+        Remove comments (a queryset), leaving placeholders in their threads,
+        and take them off their posts' comment counts.  Returns how many
+        were removed.
+        """
+        with commit_on_success_unless_managed():
+            removed = list(comments.filter(is_removed=False).order_by()
+                                   .values_list('pk', 'post'))
+            counts = {}
+            for pk, post_id in removed:
+                counts[post_id] = counts.get(post_id, 0) + 1
+            self.filter(pk__in=[pk for pk, post_id in removed]).update(is_removed=True)
+            for post_id, count in counts.items():
+                Post.all_objects.filter(pk=post_id).update(comment_count=F('comment_count') - count)
+        for post_id in counts:
+            forget_comment_tree(post_id)
+            bump_version(post_version(post_id))
+        if counts:
+            bump_version(POST_LIST_VERSION)
+        return len(removed)
+
+
 class Comment(models.Model):
     """
     Represents a comment on a post.
@@ -79,17 +398,31 @@ class Comment(models.Model):
     parent = models.ForeignKey('Comment', null=True, default=None) #for threaded comments, later
     
     # The path to this comment.
-    # e.g. 1;5;6;8 means that this comment is a reply to comment 8, which in turn
-    # is a comment on 6, then 5, then 1.  
+    # e.g. 0000000001;0000000005;0000000006;0000000008 means that this comment is a
+    # reply to comment 8, which in turn is a comment on 6, then 5, then 1.
     # A comment that is not a reply (i.e. a top-level comment on a post) will have a path of None (NULL).
     
-    # This is actually unused at the moment outside of unit tests, but could be used
-    # for pagination or AJAX loading of comment trees.
-    thread_path = models.TextField(default=None, null=True) 
+    # Each pk is zero-padded (see thread_path_segment), so every descendant of a comment
+    # shares a plain string prefix with it and can be found with one index range scan.
+    # On postgres, db_index also creates a text_pattern_ops index so LIKE 'prefix%' uses it.
+    thread_path = models.TextField(default=None, null=True, db_index=True)
     
     created = models.DateTimeField(auto_now_add=True)
     modified = models.DateTimeField(auto_now=True)
     
+    # For top-level comments only, the number of replies in the thread it starts.
+    # Maintained like Post.comment_count.
+    descendant_count = models.PositiveIntegerField(default=0, editable=False)
+    
+    # Removed comments are shown as placeholders, so their replies keep their
+    # place in the thread, and aren't counted in Post.comment_count (but are
+    # in descendant_count).  See CommentManager.remove() and the
+    # compact_removed_comments command, which deletes them for good.
+    # Comment.save() never changes it.
+    is_removed = models.BooleanField(default=False, editable=False)
+    
+    objects = CommentManager()
+    
     class Meta:
         ordering = ['created']
     
@@ -101,11 +434,276 @@ class Comment(models.Model):
         """
         return Comment.objects.filter(post=post, parent=None)
 
+    @staticmethod
+    def get_comment_tree_for_post(post):
+        """
+        Load every comment on a post with a single query and link
+        them together in memory.
+        
+        Returns the top-level comments; the replies of every comment in
+        the tree are already attached, so walking the whole thread
+        doesn't hit the database again.
+        """
+        return Comment.build_tree(Comment.objects.filter(post=post), post=post)
+
+    @staticmethod
+    def get_thread_page(post, after=None, first=None, threads=20,
+                        replies_per_thread=50, reveal=None):
+        """
+        Load one page of a post's comment threads, oldest thread first.
+        
+        Pages are keyed on the pk of top-level comments: a page holds the
+        first threads top-level comments with a pk greater than after, or
+        starting at first if that's given instead.
+        
+        At most replies_per_thread replies are loaded for each thread (None
+        for no limit), taking the oldest first so that every loaded reply's
+        parent is loaded too.  If reveal is the pk of a reply on this page,
+        its thread is loaded at least up to it regardless of the limit.
+        
+        Returns (top_comments, next_after), with replies attached as in
+        build_tree.  next_after is the value of after for the next page, or
+        None if this is the last one.  Each top-level comment gets a
+        reply_count and a hidden_reply_count for the replies left out.
+        
+        The post's comments are paged through in memory if they're cached,
+        or cached if there aren't too many of them (see get_tree_nodes), so
+        this is at most one query.  Posts with more comments than the cache
+        takes are paged in the database, with two queries, however many
+        threads and replies there are.
+        """
+        nodes = Comment.get_tree_nodes(post)
+        if nodes is not None:
+            return Comment._page_tree_nodes(post, nodes, after, first, threads,
+                                            replies_per_thread, reveal)
+        
+        top_comments = Comment.objects.filter(post=post, parent=None).order_by('pk')
+        if first is not None:
+            top_comments = top_comments.filter(pk__gte=first)
+        elif after is not None:
+            top_comments = top_comments.filter(pk__gt=after)
+        top_comments = list(top_comments[:threads + 1])
+        
+        next_after = None
+        if len(top_comments) > threads:
+            top_comments = top_comments[:threads]
+            next_after = top_comments[-1].pk
+        
+        if not top_comments:
+            return [], None
+        
+        replies = Comment._get_thread_replies(post, top_comments[0].pk, top_comments[-1].pk,
+                                              replies_per_thread, reveal)
+        for comment in top_comments:
+            comment.reply_count = 0
+            comment.hidden_reply_count = 0
+        by_id = dict((comment.pk, comment) for comment in top_comments)
+        for reply in replies:
+            root = by_id[int(reply.thread_root)]
+            root.reply_count = reply.thread_reply_count
+            root.hidden_reply_count = reply.thread_reply_count - reply.reply_number
+        
+        return Comment.build_tree(top_comments + replies, post=post), next_after
+
+    @staticmethod
+    def get_tree_nodes(post):
+        """
+        Every comment on post as a node (see tree_node()), in pk order, from
+        the cache, or loaded with one query and cached.
+        
+        Returns None if the post has too many comments to cache, or they
+        take up too much room (see cache.comment_tree_max_bytes()).
+        
+        Cached nodes are only used if the number of them that haven't been
+        removed still matches the post's comment_count, so a cache that's
+        missed a new comment is reloaded.  If the count was wrong when they
+        were loaded (see the recount_comments command), that's logged, and
+        by how much is cached with them, so that they aren't reloaded for
+        every page.
+        """
+        if post.comment_count > comment_tree_max_comments():
+            return None
+        removed_index = TREE_NODE_FIELDS.index('is_removed')
+        def counted(nodes):
+            return len([node for node in nodes if not node[removed_index]])
+        
+        tree = get_comment_tree(post.pk)
+        if tree is not None:
+            count_error, nodes = tree
+            if nodes is None:
+                return None
+            if counted(nodes) + count_error == post.comment_count:
+                return nodes
+        
+        nodes = list(Comment.objects.filter(post=post).order_by('pk')
+                                    .values_list(*TREE_NODE_FIELDS))
+        count_error = post.comment_count - counted(nodes)
+        if count_error:
+            #post may just have been loaded before a comment was added
+            stored = Post.all_objects.filter(pk=post.pk).values_list('comment_count', flat=True)
+            count_error = (stored[0] if stored else post.comment_count) - counted(nodes)
+        if count_error:
+            logger.warning("Post %s has a comment_count of %s, but %s comments; "
+                           "run the recount_comments command.",
+                           post.pk, counted(nodes) + count_error, counted(nodes))
+        set_comment_tree(post.pk, nodes, count_error)
+        return nodes
+    
+    @staticmethod
+    def _page_tree_nodes(post, nodes, after, first, threads, replies_per_thread, reveal):
+        """
+        get_thread_page(), done in memory with the post's nodes.  Only the
+        comments on the page are made into Comment instances.
+        """
+        id_index = TREE_NODE_FIELDS.index('id')
+        path_index = TREE_NODE_FIELDS.index('thread_path')
+        
+        roots = [node for node in nodes if node[path_index] is None]
+        if first is not None:
+            roots = [node for node in roots if node[id_index] >= first]
+        elif after is not None:
+            roots = [node for node in roots if node[id_index] > after]
+        roots = roots[:threads + 1]
+        
+        next_after = None
+        if len(roots) > threads:
+            roots = roots[:threads]
+            next_after = roots[-1][id_index]
+        
+        if not roots:
+            return [], None
+        
+        replies = dict((node[id_index], []) for node in roots)
+        reveal_root_id = None
+        for node in nodes:
+            if node[path_index] is not None:
+                root_id = int(node[path_index][:THREAD_PATH_SEGMENT_WIDTH])
+                if root_id in replies:
+                    replies[root_id].append(node)
+                    if node[id_index] == reveal:
+                        reveal_root_id = root_id
+        
+        attnames = [Comment._meta.get_field(name).attname for name in TREE_NODE_FIELDS]
+        def make_comment(node):
+            return Comment(post_id=post.pk, **dict(zip(attnames, node)))
+        
+        top_comments = []
+        shown_replies = []
+        for root in roots:
+            comment = make_comment(root)
+            thread_replies = replies[comment.pk]
+            if replies_per_thread is None:
+                shown = thread_replies
+            else:
+                shown = [node for number, node in enumerate(thread_replies)
+                         if number < replies_per_thread or
+                         (comment.pk == reveal_root_id and node[id_index] <= reveal)]
+            comment.descendant_count = comment.reply_count = len(thread_replies)
+            comment.hidden_reply_count = len(thread_replies) - len(shown)
+            top_comments.append(comment)
+            shown_replies.extend(shown)
+        shown_replies.sort(key=lambda node: node[id_index])
+        
+        return (Comment.build_tree(top_comments + [make_comment(node) for node in shown_replies],
+                                   post=post),
+                next_after)
+    
+    @staticmethod
+    def _get_thread_replies(post, first_root_id, last_root_id, limit, reveal=None):
+        """
+        Load the replies in the threads started by top-level comments with pks
+        from first_root_id to last_root_id, at most limit per thread, in pk order.
+        
+        Replies to those threads are exactly the comments whose thread_path is
+        between the first root's segment and the segment after the last root's,
+        so this is a single range scan of the thread_path index.  A window
+        function numbers each thread's replies, which is how the per-thread
+        limit is applied without a query per thread.
+        """
+        table = connection.ops.quote_name(Comment._meta.db_table)
+        root_segment = 'SUBSTR(thread_path, 1, %s)' % THREAD_PATH_SEGMENT_WIDTH
+        params = [post.pk, thread_path_segment(first_root_id), thread_path_segment(last_root_id + 1)]
+        
+        conditions = []
+        if limit is not None:
+            conditions.append('reply_number <= %s')
+            params.append(limit)
+            if reveal is not None:
+                conditions.append('id <= %s AND thread_root = (SELECT ' + root_segment +
+                                  ' FROM ' + table + ' WHERE id = %s)')
+                params.extend([reveal, reveal])
+        where = ' OR '.join(conditions) or '1 = 1'
+        
+        sql = ('SELECT * FROM ('
+               ' SELECT *, ' + root_segment + ' AS thread_root,'
+               '  ROW_NUMBER() OVER (PARTITION BY ' + root_segment + ' ORDER BY id) AS reply_number,'
+               '  COUNT(*) OVER (PARTITION BY ' + root_segment + ') AS thread_reply_count'
+               ' FROM ' + table +
+               ' WHERE post_id = %s AND thread_path >= %s AND thread_path < %s'
+               ') replies WHERE ' + where + ' ORDER BY id')
+        return list(Comment.objects.raw(sql, params))
+
+    @staticmethod
+    def get_thread_root_id(post, comment_id):
+        """
+        Find the pk of the top-level comment at the start of the thread that
+        comment_id is in, or None if there's no such comment on post.
+        """
+        nodes = Comment.get_tree_nodes(post)
+        if nodes is not None:
+            paths = [node[TREE_NODE_FIELDS.index('thread_path')] for node in nodes
+                     if node[TREE_NODE_FIELDS.index('id')] == comment_id]
+        else:
+            paths = list(Comment.objects.filter(post=post, pk=comment_id)
+                                        .values_list('thread_path', flat=True))
+        if not paths:
+            return None
+        if paths[0] is None:
+            return comment_id
+        return int(paths[0].split(THREAD_PATH_SEPARATOR)[0])
+
+    @staticmethod
+    def build_tree(comments, post=None):
+        """
+        Attach each comment in comments to its parent's replies and
+        return the comments that have no parent.
+        
+        comments should be in display order (e.g. by created); the
+        order of each comment's replies follows it.  Comments whose
+        parent isn't in comments are dropped, since there's nowhere
+        to hang them.
+        
+        If post is given, it's cached on every comment so that things
+        like get_reply_url() don't lazily load it again.
+        """
+        comments = list(comments)
+        by_id = {}
+        for comment in comments:
+            comment._replies_cache = []
+            if post is not None:
+                comment._post_cache = post
+            by_id[comment.pk] = comment
+        
+        top_comments = []
+        for comment in comments:
+            if comment.parent_id is None:
+                top_comments.append(comment)
+            elif comment.parent_id in by_id:
+                parent = by_id[comment.parent_id]
+                comment._parent_cache = parent
+                parent._replies_cache.append(comment)
+        return top_comments
+
     @property
     def replies(self):
         """
         Returns all comments that directly reply to this comment.
+        
+        If this comment was loaded as part of a tree (see build_tree),
+        the already-loaded replies are returned instead of querying.
         """
+        if hasattr(self, '_replies_cache'):
+            return self._replies_cache
         return Comment.objects.filter(parent=self)
         
     @property
@@ -116,42 +714,108 @@ class Comment(models.Model):
         """
         if not self.thread_path:
             return []
-        return self.thread_path.split(THREAD_PATH_SEPARATOR)
+        return [str(int(segment)) for segment in self.thread_path.split(THREAD_PATH_SEPARATOR)]
+
+    @property
+    def child_thread_path(self):
+        """
+        The thread_path that replies to this comment get, i.e. this
+        comment's own path with its pk appended.
+        
+        Sorting comments by this value puts them in thread order:
+        each comment is immediately followed by all of its descendants.
+        """
+        if self.thread_path:
+            return self.thread_path + THREAD_PATH_SEPARATOR + thread_path_segment(self.pk)
+        return thread_path_segment(self.pk)
+
+    @property
+    def descendants(self):
+        """
+        All replies to this comment, and replies to those, etc. in thread order.
+        
+        See CommentManager.subtree().
+        """
+        return Comment.objects.subtree(self)[1:]
 
     @property
     def descendants_count(self):
         """
         Only applicable to top-level comments, this property
         counts all descendants from this comment.
+        
+        The count is stored in descendant_count, so this doesn't query.
         """
-        if self.thread_path != '':
+        if self.thread_path is not None:
             raise ValueError('descendants_count only valid for top-level comments')
         
-        filter_string = "%s%s" % (self.pk, THREAD_PATH_SEPARATOR)
-        qs = (Comment.objects.filter(thread_path=str(self.pk)) |
-                Comment.objects.filter(thread_path__startswith=filter_string))
-        return qs.count()
+        return self.descendant_count
     
+    @property
+    def root_id(self):
+        """
+        The pk of the top-level comment that starts this comment's thread,
+        or None if this is a top-level comment.
+        """
+        if not self.thread_path:
+            return None
+        return int(self.thread_path[:THREAD_PATH_SEGMENT_WIDTH])
+
     def save(self, *args, **kwargs):
         """
         Overriding default save to:
         - denormalize username into this model (standardizing whether comment
           came from a logged-in user or anon
         - calculate this comment's thread path and save it.
+        - count a new comment on its post and the thread it's in, and keep
+          the stored count of an existing comment's replies, and whether
+          it's removed (see CommentManager.remove()).
+        - add a new comment to its post's cached comments, and publish it
+          to anyone watching the post (see broker.py).
         """
-        if self.user and not self.user_name:
+        if self.user_id is not None and not self.user_name:
             self.user_name = self.user.username
             
         #also calculate the thread_path
         #conveniently, it's just the parent's thread_path with
         #the parent's ID appended.
-        if self.parent:
-            path = self.parent.path_list
-            path.append(str(self.parent.pk))
-            self.thread_path = THREAD_PATH_SEPARATOR.join(path)
+        if self.parent_id is not None:
+            self.thread_path = self.parent.child_thread_path
         else:
             self.thread_path = None
-        return super(Comment, self).save(*args, **kwargs)
+        
+        adding = self.pk is None
+        with commit_on_success_unless_managed():
+            if not adding:
+                reload_fields(self, ('descendant_count', 'is_removed'))
+            super(Comment, self).save(*args, **kwargs)
+            if adding:
+                #F() makes these atomic increments in the database, so concurrent
+                #comments can't overwrite each other's counts.
+                Post.objects.filter(pk=self.post_id).update(comment_count=F('comment_count') + 1)
+                if self.root_id is not None:
+                    Comment.objects.filter(pk=self.root_id).update(descendant_count=F('descendant_count') + 1)
+        #only once it's committed, so readers can't see it in the cache first
+        comment_changed(Comment, self, created=adding)
+        if adding:
+            append_to_comment_tree(self.post_id, self.tree_node())
+            publish_comment(self)
+    
+    def delete(self, *args, **kwargs):
+        """
+        Delete the comment and its replies, bumping its post's cache
+        versions again once that's committed; comment_changed() already ran
+        on post_delete, but before the commit.
+        """
+        super(Comment, self).delete(*args, **kwargs)
+        comment_changed(Comment, self)
+    
+    def tree_node(self):
+        """
+        This comment as it's kept in the cache of its post's comments: a
+        tuple of the values of TREE_NODE_FIELDS.
+        """
+        return tuple(getattr(self, self._meta.get_field(name).attname) for name in TREE_NODE_FIELDS)
     
     @property
     def depth(self):
@@ -160,13 +824,173 @@ class Comment(models.Model):
         """
         return len(self.path_list)
     
+    def validate_move(self, new_parent):
+        """
+        Raise ValueError if move_subtree() can't move this comment under
+        new_parent: if it's on another post, is this comment or one of its
+        replies (or theirs, etc.), or is newer than this comment.
+        
+        Replies are paged and exported in pk order, which puts each one
+        after what it replies to only as long as every comment is newer
+        than its parent.
+        """
+        if new_parent is None:
+            return
+        if new_parent.post_id != self.post_id:
+            raise ValueError("A comment can only be moved to another comment on its post.")
+        if new_parent.pk == self.pk or \
+           (new_parent.thread_path or '').startswith(self.child_thread_path):
+            raise ValueError("A comment can't be moved under itself or its replies.")
+        if new_parent.pk > self.pk:
+            raise ValueError("A comment can't be moved under a newer comment.")
+    
+    def move_subtree(self, new_parent):
+        """
+        Make this comment a reply to new_parent, or a top-level comment if
+        new_parent is None, taking all its replies (and theirs, etc.) along.
+        
+        Every descendant's thread_path starts with this comment's, so one
+        UPDATE swaps that prefix for the new one in all of them, however
+        many there are.  The threads' reply counts are moved along with the
+        comments, and the post's cached pages and comments are dropped.
+        """
+        self.validate_move(new_parent)
+        old_prefix = self.child_thread_path
+        old_root_id = self.root_id
+        self.parent = new_parent
+        self.thread_path = new_parent.child_thread_path if new_parent is not None else None
+        new_root_id = self.root_id
+        
+        table = connection.ops.quote_name(Comment._meta.db_table)
+        with commit_on_success_unless_managed():
+            cursor = connection.cursor()
+            cursor.execute('UPDATE ' + table + ' SET thread_path = %s || SUBSTR(thread_path, %s)'
+                           ' WHERE post_id = %s AND thread_path LIKE %s',
+                           [self.child_thread_path, len(old_prefix) + 1, self.post_id,
+                            old_prefix + '%'])
+            transaction.set_dirty()
+            moved = cursor.rowcount + 1
+            
+            if old_root_id != new_root_id:
+                if old_root_id is not None:
+                    Comment.objects.filter(pk=old_root_id) \
+                                   .update(descendant_count=F('descendant_count') - moved)
+                if new_root_id is not None:
+                    Comment.objects.filter(pk=new_root_id) \
+                                   .update(descendant_count=F('descendant_count') + moved)
+            self.descendant_count = moved - 1 if new_root_id is None else 0
+            Comment.objects.filter(pk=self.pk).update(parent=new_parent,
+                                                      thread_path=self.thread_path,
+                                                      descendant_count=self.descendant_count)
+        bump_version(post_version(self.post_id))
+        forget_comment_tree(self.post_id)
+    
     def get_reply_url(self):
         """
         Calculates the URL to get/post a reply to this comment.
+        
+        This needs the post's slug, so comments being shown together should
+        share an already loaded post (see build_tree) rather than each
+        loading their own.
         """
         return reverse_lazy('reply-create', kwargs={'post_slug':self.post.slug,
                                                     'parent_id':self.pk})
     
+class CommentAdminForm(forms.ModelForm):
+    class Meta:
+        model = Comment
+    
+    def clean(self):
+        cleaned_data = super(CommentAdminForm, self).clean()
+        parent = cleaned_data.get('parent')
+        if self.instance.pk is not None and parent != self.instance.parent:
+            try:
+                self.instance.validate_move(parent)
+            except ValueError, e:
+                raise forms.ValidationError(unicode(e))
+        return cleaned_data
+
+class CommentAdmin(admin.ModelAdmin):
+    """
+    Changing a comment's parent moves its replies along with it (see
+    Comment.move_subtree()).
+    """
+    form = CommentAdminForm
+    raw_id_fields = ('post', 'user', 'parent')
+    readonly_fields = ('thread_path', 'is_removed')
+    list_display = ('id', 'post', 'user_name', 'created', 'is_removed')
+    actions = ['remove_comments']
+    
+    def remove_comments(self, request, queryset):
+        removed = Comment.objects.remove(queryset)
+        self.message_user(request, "Removed %s comments." % removed)
+    remove_comments.short_description = "Remove selected comments, leaving placeholders"
+    
+    def save_model(self, request, obj, form, change):
+        if change and 'parent' in form.changed_data:
+            stored = Comment.objects.get(pk=obj.pk)
+            stored.move_subtree(obj.parent)
+            obj.thread_path = stored.thread_path
+            obj.descendant_count = stored.descendant_count
+        obj.save()
+
 #currently the only way to edit or delete a comment
-admin.site.register(Comment)
+admin.site.register(Comment, CommentAdmin)
+
+
+def uncount_deleted_comment(sender, instance, **kwargs):
+    """
+    Undo what Comment.save() added to the comment counts.
+    
+    This is a signal handler rather than part of Comment.delete() so that
+    it also runs for queryset deletes and for replies deleted in cascade.
+    If the post or top-level comment is being deleted too, the update
+    just doesn't match anything.
+    """
+    #removed comments were taken off the count already
+    if not instance.is_removed:
+        Post.objects.filter(pk=instance.post_id).update(comment_count=F('comment_count') - 1)
+    if instance.root_id is not None:
+        Comment.objects.filter(pk=instance.root_id).update(descendant_count=F('descendant_count') - 1)
+
+post_delete.connect(uncount_deleted_comment, sender=Comment)
+
+
+def post_saved(sender, instance, **kwargs):
+    """
+    A post's page and the list of posts are out of date when it's saved,
+    so bump their cache versions.  Also remember which post the slug
+    belongs to, so its cached page can be found without a query.
+    
+    Post.save() calls this once it's committed; see comment_changed().
+    """
+    set_post_id(instance.slug, instance.pk)
+    bump_version(post_version(instance.pk))
+    bump_version(POST_LIST_VERSION)
+
+def post_deleted(sender, instance, **kwargs):
+    forget_post_id(instance.slug)
+    bump_version(post_version(instance.pk))
+    bump_version(POST_LIST_VERSION)
+
+def comment_changed(sender, instance, **kwargs):
+    """
+    A comment is shown on its post's page and counted on the list of
+    posts, so bump both cache versions when it's saved or deleted, and
+    forget the post's cached comments when one is edited or deleted.
+    
+    Comment.save() and Comment.delete() call this once they've committed.
+    Bumped any earlier, a page rendered from the old comments by another
+    request before the commit would be cached under the new versions, and
+    shown until it expired.  Comments deleted by a queryset or along with
+    their parent never go through Comment.delete(), so this is connected
+    to post_delete too, which is the best those can do.
+    """
+    bump_version(post_version(instance.post_id))
+    bump_version(POST_LIST_VERSION)
+    #new comments are added to the post's cached comments by Comment.save()
+    if not kwargs.get('created'):
+        forget_comment_tree(instance.post_id)
 
+post_delete.connect(post_deleted, sender=Post)
+post_delete.connect(comment_changed, sender=Comment)
@@ -0,0 +1,4 @@
+-- Run by syncdb after creating the blog_comment table.
+-- compact_removed_comments looks for the posts with removed comments,
+-- which are few, so only they are indexed.
+CREATE INDEX blog_comment_removed_post ON blog_comment (post_id) WHERE is_removed;
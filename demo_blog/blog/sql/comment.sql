@@ -0,0 +1,3 @@
+-- Run by syncdb after creating the blog_comment table.
+-- poll_comments looks up a post's comments posted since a given time.
+CREATE INDEX blog_comment_post_created ON blog_comment (post_id, created);
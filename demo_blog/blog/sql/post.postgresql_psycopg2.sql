@@ -0,0 +1,7 @@
+-- Run by syncdb after creating the blog_post table.
+-- Post.allocate_slug() finds numbered slugs by prefix, which the unique
+-- index on slug can't serve outside the C locale.
+CREATE INDEX blog_post_slug_like ON blog_post (slug varchar_pattern_ops);
+
+-- purge_deleted_posts looks for the few posts marked deleted.
+CREATE INDEX blog_post_deleted ON blog_post (id) WHERE deleted;
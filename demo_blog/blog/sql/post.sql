@@ -0,0 +1,3 @@
+-- Run by syncdb after creating the blog_post table.
+-- ListPosts pages through posts by (created, id), newest first.
+CREATE INDEX blog_post_created_id ON blog_post (created, id);
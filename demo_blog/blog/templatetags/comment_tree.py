@@ -0,0 +1,67 @@
+"""
+Template tags for rendering threads of comments.
+"""
+
+from django import template
+from django.template.loader import get_template
+from django.utils.safestring import mark_safe
+
+register = template.Library()
+
+#the markup of a comment before and after its replies, which
+#blog/comment_inline.html includes too
+COMMENT_HEAD_TEMPLATE = 'blog/comment_head.html'
+COMMENT_TAIL_TEMPLATE = 'blog/comment_tail.html'
+
+
+def render_fragment(fragment, comment, context):
+    """
+    Render one of the fragments with comment in the context.
+    """
+    context.push()
+    try:
+        context['comment'] = comment
+        return fragment.render(context)
+    finally:
+        context.pop()
+
+
+@register.simple_tag(takes_context=True)
+def comment_tree(context, comments):
+    """
+    Render comments and all of their replies, each in an <li>.
+    
+    Usage::
+    
+        <ul>{% comment_tree comments %}</ul>
+    
+    This produces the same markup as including blog/comment_inline.html for
+    each comment, which includes itself for each reply, from the same
+    fragments, but in one pass: the tree is walked with an explicit stack
+    instead of recursing, so there's no limit on how deep a thread can be.
+    The fragments are looked up once per tree rather than per comment
+    (and are only compiled once if TEMPLATE_LOADERS uses
+    django.template.loaders.cached.Loader).
+    
+    Each comment's replies are read from comment.replies, so comments
+    should come from Comment.build_tree() or one of the loaders that use
+    it; otherwise every comment costs a query.
+    """
+    head = get_template(COMMENT_HEAD_TEMPLATE)
+    tail = get_template(COMMENT_TAIL_TEMPLATE)
+    output = []
+    #the stack holds comments still to be rendered and the markup that
+    #closes comments already opened, in the reverse of the order they go out.
+    stack = []
+    for comment in reversed(list(comments)):
+        stack.extend([u"</li>\n", comment, u"<li>"])
+    while stack:
+        item = stack.pop()
+        if isinstance(item, basestring):
+            output.append(item)
+            continue
+        output.append(render_fragment(head, item, context))
+        stack.append(render_fragment(tail, item, context))
+        for reply in reversed(list(item.replies)):
+            stack.extend([u"</li>\n", reply, u"<li>"])
+    return mark_safe(u''.join(output))
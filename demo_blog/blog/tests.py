@@ -1,8 +1,35 @@
-from django.test import TestCase
+import datetime
+import json
+import logging
+import os
+import tempfile
+from StringIO import StringIO
+
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from johnny import settings as johnny_settings
+from johnny.cache import local as johnny_local
+from django.test.client import Client, RequestFactory
+from django.contrib.auth.models import AnonymousUser
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
 from django.core.exceptions import ObjectDoesNotExist
+from django.core import management
+from django.core.cache import cache
+from django.core.management.base import CommandError
+from django.core.signals import request_started
+from django.db import connection, reset_queries, transaction
+from django.db.models.signals import post_save, pre_delete
+from django.template import Context, Template
+from django.utils.html import escape
+from django.utils.timezone import utc
+from . import models
 from .models import Post, Comment
+from . import cache as blog_cache
+from . import views
+from .views import ViewPost, STREAMED_COMMENTS_MARKER
+from ..registration.models import RegistrationProfile
+from .management.commands import import_blog
 
 class TestPostSlugs(TestCase):
     """
@@ -28,6 +55,85 @@ class TestPostSlugs(TestCase):
                                                    owner=self.user)
         self.assertEqual(post.slug, 'my-blog-post-2')
         
+    def test_dupe_slug_queries(self):
+        """
+        Finding the next free slug costs the same however many posts share the title.
+        """
+        for i in range(10):
+            Post.objects.create(title='Weekly update', content='Monkeys', owner=self.user)
+        
+        with self.assertNumQueries(2):
+            post = Post.objects.create(title='Weekly update', content='Monkeys', owner=self.user)
+        self.assertEqual(post.slug, 'weekly-update-11')
+        #titles whose slugs merely look numbered aren't counted
+        Post.objects.create(title='Weekly update 2013', content='Monkeys', owner=self.user)
+        Post.objects.create(title='Weekly update 99999999999', content='Monkeys', owner=self.user)
+        post = Post.objects.create(title='Weekly update', content='Monkeys', owner=self.user)
+        self.assertEqual(post.slug, 'weekly-update-12')
+        
+    def test_dupe_slug_after_many_numbered_titles(self):
+        """
+        Numbered titles are skipped however many of them sort before the
+        highest allocated number.
+        """
+        Post.objects.create(title='Weekly update', content='Monkeys', owner=self.user)
+        Post.objects.create(title='Weekly update', content='Monkeys', owner=self.user)
+        for year in range(2000, 2025):
+            Post.objects.create(title='Weekly update %s' % year, content='Monkeys', owner=self.user)
+        post = Post.objects.create(title='Weekly update', content='Monkeys', owner=self.user)
+        self.assertEqual(post.slug, 'weekly-update-3')
+        
+    def test_dupe_slug_past_numbered_title(self):
+        """
+        A number that another title's own slug already has is skipped.
+        """
+        for title in ('My post', 'My post 3', 'My post', 'My post'):
+            post = Post.objects.create(title=title, content='Monkeys', owner=self.user)
+        self.assertEqual(post.slug, 'my-post-4')
+        self.assertEqual(sorted(Post.objects.values_list('slug', flat=True)),
+                         ['my-post', 'my-post-2', 'my-post-3', 'my-post-4'])
+        
+    def test_first_slug_beside_numbered_title(self):
+        """
+        A title gets its own slug while only numbered titles share its start.
+        """
+        Post.objects.create(title='Weekly update 2013', content='Monkeys', owner=self.user)
+        post = Post.objects.create(title='Weekly update', content='Monkeys', owner=self.user)
+        self.assertEqual(post.slug, 'weekly-update')
+        
+    def test_slug_taken_while_saving(self):
+        """
+        If another post takes the slug between choosing it and saving, the next one is used.
+        """
+        Post.objects.create(title='My Blog Post', content='Monkeys', owner=self.user)
+        post = Post(title='My Blog Post', content='Monkeys', owner=self.user)
+        slugs = ['my-blog-post', 'my-blog-post-2']
+        post.allocate_slug = lambda: slugs.pop(0)
+        post.save()
+        self.assertEqual(post.slug, 'my-blog-post-2')
+        self.assertEqual(Post.objects.filter(slug__startswith='my-blog-post').count(), 2)
+        
+    def test_long_dupe_slug(self):
+        """
+        Long titles are cut short enough for their numbers to fit.
+        """
+        title = 'Monkeys ' * 10
+        first = Post.objects.create(title=title, content='Monkeys', owner=self.user)
+        second = Post.objects.create(title=title, content='Monkeys', owner=self.user)
+        third = Post.objects.create(title=title, content='Monkeys', owner=self.user)
+        self.assertEqual(len(first.slug), 50)
+        self.assertEqual(second.slug, first.slug[:39] + '-2')
+        self.assertEqual(third.slug, first.slug[:39] + '-3')
+        
+    def test_slug_kept_on_edit(self):
+        """
+        Changing a post's title doesn't change its slug.
+        """
+        post = Post.objects.create(title='My Blog Post', content='Monkeys', owner=self.user)
+        post.title = 'Another Title'
+        post.save()
+        self.assertEqual(Post.objects.get(pk=post.pk).slug, 'my-blog-post')
+        
     def test_get_absolute_url(self):
         """
         Test to ensure that the right url for a post involves the slug in some fashion,
@@ -55,6 +161,58 @@ class TestPostSlugs(TestCase):
         self.assertContains(resp, post.owner.username)
         
 
+class TestListPosts(TestCase):
+    """
+    Tests of the list of posts.
+    """
+    
+    def setUp(self):
+        self.user = User.objects.create_user('monkey')
+        
+    def test_list_pages(self):
+        """
+        Page through 25 posts, newest first.
+        """
+        posts = [Post.objects.create(title='Post %s' % i, content='Monkeys', owner=self.user)
+                 for i in range(25)]
+        
+        res = self.client.get(reverse('post-list'))
+        self.assertEqual([post.pk for post in res.context['object_list']],
+                         [post.pk for post in posts[:-21:-1]])
+        self.assertTrue(res.context['next_posts_url'])
+        
+        res = self.client.get(res.context['next_posts_url'])
+        self.assertEqual([post.pk for post in res.context['object_list']],
+                         [post.pk for post in posts[4::-1]])
+        self.assertEqual(res.context['next_posts_url'], None)
+        
+    def test_same_created_time(self):
+        """
+        Posts created at the same instant are told apart by id.
+        """
+        posts = [Post.objects.create(title='Post %s' % i, content='Monkeys', owner=self.user)
+                 for i in range(25)]
+        Post.objects.update(created=posts[0].created)
+        
+        res = self.client.get(reverse('post-list'))
+        seen = list(res.context['object_list'])
+        res = self.client.get(res.context['next_posts_url'])
+        seen.extend(res.context['object_list'])
+        self.assertEqual(sorted(post.pk for post in seen), sorted(post.pk for post in posts))
+        
+    def test_list_queries(self):
+        """
+        The list is one query, without loading each post's owner separately.
+        """
+        for i in range(5):
+            owner = User.objects.create_user('owner_%s' % i)
+            Post.objects.create(title='Post %s' % i, content='Monkeys', owner=owner)
+        
+        with self.assertNumQueries(1):
+            res = self.client.get(reverse('post-list'))
+        self.assertContains(res, 'owner_4')
+        
+
 class TestCRUDPosts(TestCase):
     """
     Tests that actually exercise pages to create/update/delete blog posts.
@@ -242,7 +400,11 @@ class CommentTestCase(TestCase):
     def setUp(self):
         """
         Fixtures shared between tests.
+        
+        Posts' ids are used again from test to test, so nothing cached for
+        an earlier test's posts is kept.
         """
+        cache.clear()
         self.author = User.objects.create(username='post_author')
         self.commenter = User.objects.create_user(username='logged_in_commenter',
                                                   password='logged_in_commenter_pass') #for logged-in commenters
@@ -367,6 +529,60 @@ class TestComments(CommentTestCase):
         reply = Comment.objects.get(user_name='Anonymous 2')
         self.assertEqual(reply.parent, comment)
         
+    def test_post_comment_reply_other_post(self):
+        """
+        Tests that a reply can't be posted under a comment on another post,
+        or under a comment that doesn't exist.
+        """
+        other_post = Post.objects.create(title='Other Post', content='Monkeys', owner=self.author)
+        comment = Comment.objects.create(user_name='Anonymous', content='Elsewhere.',
+                                         post=other_post)
+        reply_params = {'user_name': 'Anonymous 2', 'content': 'Lost.'}
+        
+        url = reverse('reply-create', kwargs={'post_slug': self.post.slug, 'parent_id': comment.pk})
+        res = self.client.post(url, data=reply_params)
+        self.assertEqual(res.status_code, 404)
+        url = reverse('reply-create', kwargs={'post_slug': self.post.slug, 'parent_id': comment.pk + 1})
+        res = self.client.post(url, data=reply_params)
+        self.assertEqual(res.status_code, 404)
+        self.assertFalse(Comment.objects.filter(user_name='Anonymous 2').exists())
+    
+    def test_post_comment_ajax(self):
+        """
+        Tests that posting a reply over AJAX returns the new comment's
+        markup as JSON, without rendering the post.
+        """
+        comment = Comment.objects.create(user_name='Anonymous',
+                                         content='This is a parent comment.  Please reply.',
+                                         post=self.post)
+        url = comment.get_reply_url()
+        
+        #the post, the parent, the insert and the two counts; rendering is free
+        with self.assertNumQueries(5):
+            res = self.client.post(url, data={'user_name': 'Anonymous 2',
+                                              'content': 'This is a <b>child</b> comment.'},
+                                   HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        
+        self.assertEqual(res['Content-Type'], 'application/json')
+        data = json.loads(res.content)
+        reply = Comment.objects.get(user_name='Anonymous 2')
+        self.assertEqual(data['id'], reply.pk)
+        self.assertEqual(data['parent_id'], comment.pk)
+        self.assertTrue(data['html'].strip().startswith("<div id='comment_%s'>" % reply.pk))
+        self.assertTrue('This is a &lt;b&gt;child&lt;/b&gt; comment.' in data['html'])
+        self.assertTrue(unicode(reply.get_reply_url()) in data['html'])
+        
+    def test_post_comment_ajax_invalid(self):
+        """
+        Tests that a bad comment posted over AJAX gets the form back, with errors.
+        """
+        res = self.client.post(self.comment_form_url, data={'user_name': 'Anonymous'},
+                               HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        
+        self.assertEqual(res.status_code, 400)
+        self.assertContains(res, 'name="content"', status_code=400)
+        self.assertFalse(self.post.get_comments().exists())
+        
 
 class TestCommentThreads(CommentTestCase):
     """
@@ -398,7 +614,7 @@ class TestCommentThreads(CommentTestCase):
                                                content='This is the child comment',
                                                parent=parent_comment)
         
-        self.assertEqual(child_comment.thread_path, str(parent_comment.pk))
+        self.assertEqual(child_comment.path_list, [str(parent_comment.pk)])
         self.assertEqual(child_comment.depth, 1)
         
     def test_comment_path_two(self):
@@ -442,4 +658,1694 @@ class TestCommentThreads(CommentTestCase):
         
         replies = parent_comment.replies
         self.assertTrue(child_one in replies)
-        self.assertTrue(child_two in replies)
\ No newline at end of file
+        self.assertTrue(child_two in replies)
+
+    def test_comment_tree_for_post(self):
+        """
+        Load a post's comment tree and make sure replies are attached
+        to the right parents without any more queries.
+        """
+        parent_comment = Comment.objects.create(user=self.commenter,
+                                                post=self.post,
+                                                content='This is the parent comment.')
+        child_comment = Comment.objects.create(user=self.commenter,
+                                               post=self.post,
+                                               content='This is the child comment.',
+                                               parent=parent_comment)
+        grandchild_comment = Comment.objects.create(user=self.commenter,
+                                                    post=self.post,
+                                                    content='This is the grandchild comment.',
+                                                    parent=child_comment)
+        other_comment = Comment.objects.create(user=self.commenter,
+                                               post=self.post,
+                                               content='This is another top-level comment.')
+        
+        with self.assertNumQueries(1):
+            top_comments = Comment.get_comment_tree_for_post(self.post)
+        
+        with self.assertNumQueries(0):
+            self.assertEqual(top_comments, [parent_comment, other_comment])
+            self.assertEqual(top_comments[0].replies, [child_comment])
+            self.assertEqual(top_comments[0].replies[0].replies, [grandchild_comment])
+            self.assertEqual(top_comments[1].replies, [])
+            #the post is already attached, so reply urls are free too
+            top_comments[0].replies[0].get_reply_url()
+
+    def test_post_detail_queries_independent_of_comments(self):
+        """
+        The number of queries needed to render a post's page shouldn't
+        grow with the number of comments on it.
+        """
+        def add_thread(depth):
+            parent = None
+            for i in range(depth):
+                parent = Comment.objects.create(user_name='Anonymous',
+                                                 post=self.post,
+                                                 content='Comment at depth %s' % i,
+                                                 parent=parent)
+        
+        #warm up the query cache, so both measured requests start out alike
+        self.client.get(self.post.get_absolute_url())
+        add_thread(depth=2)
+        connection.use_debug_cursor = True
+        try:
+            connection.queries = []
+            self.client.get(self.post.get_absolute_url())
+            small_thread_queries = len(connection.queries)
+            
+            add_thread(depth=5)
+            add_thread(depth=5)
+            connection.queries = []
+            self.client.get(self.post.get_absolute_url())
+            large_thread_queries = len(connection.queries)
+        finally:
+            connection.use_debug_cursor = None
+        
+        self.assertEqual(small_thread_queries, large_thread_queries)
+
+    def test_thread_path_sorts_in_thread_order(self):
+        """
+        Comment 9's replies must sort before comment 10, even though
+        '9' > '10' as plain strings.
+        """
+        nine = Comment.objects.create(pk=9, user_name='Anonymous',
+                                      post=self.post, content='Comment nine.')
+        ten = Comment.objects.create(pk=10, user_name='Anonymous',
+                                     post=self.post, content='Comment ten.')
+        reply = Comment.objects.create(pk=11, user_name='Anonymous',
+                                       post=self.post, content='Reply to nine.',
+                                       parent=nine)
+        
+        ordered = sorted([ten, reply, nine], key=lambda comment: comment.child_thread_path)
+        self.assertEqual(ordered, [nine, reply, ten])
+        
+    def test_descendants(self):
+        """
+        descendants should include the whole subtree in thread order,
+        and nothing from sibling threads.
+        """
+        parent_comment = Comment.objects.create(pk=1, user_name='Anonymous',
+                                                post=self.post, content='Parent.')
+        sibling = Comment.objects.create(pk=12, user_name='Anonymous',
+                                         post=self.post, content='Not a descendant.')
+        child_comment = Comment.objects.create(pk=13, user_name='Anonymous',
+                                               post=self.post, content='Child.',
+                                               parent=parent_comment)
+        sibling_reply = Comment.objects.create(pk=14, user_name='Anonymous',
+                                               post=self.post, content='Also not a descendant.',
+                                               parent=sibling)
+        grandchild = Comment.objects.create(pk=15, user_name='Anonymous',
+                                            post=self.post, content='Grandchild.',
+                                            parent=child_comment)
+        second_child = Comment.objects.create(pk=16, user_name='Anonymous',
+                                              post=self.post, content='Second child.',
+                                              parent=parent_comment)
+        
+        self.assertEqual(parent_comment.descendants, [child_comment, grandchild, second_child])
+        
+    def make_subtree(self):
+        """
+        Helper method.  A thread three replies deep, with a sibling thread.
+        """
+        root = Comment.objects.create(user_name='Anonymous', post=self.post, content='Root.')
+        sibling = Comment.objects.create(user_name='Anonymous', post=self.post, content='Sibling.')
+        child = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                       content='Child.', parent=root)
+        Comment.objects.create(user_name='Anonymous', post=self.post,
+                               content='Sibling reply.', parent=sibling)
+        grandchild = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                            content='Grandchild.', parent=child)
+        great_grandchild = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                                  content='Great-grandchild.', parent=grandchild)
+        second_child = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                              content='Second child.', parent=root)
+        return root, sibling, child, grandchild, great_grandchild, second_child
+    
+    def test_subtree(self):
+        """
+        A comment's subtree is it and its replies, and theirs, etc. in thread
+        order, found with one query, down to max_depth levels if given.
+        """
+        root, sibling, child, grandchild, great_grandchild, second_child = self.make_subtree()
+        with self.assertNumQueries(1):
+            self.assertEqual(Comment.objects.subtree(root),
+                             [root, child, grandchild, great_grandchild, second_child])
+        self.assertEqual(Comment.objects.subtree(root, max_depth=1), [root, child, second_child])
+        self.assertEqual(Comment.objects.subtree(child, max_depth=1), [child, grandchild])
+        self.assertEqual(Comment.objects.subtree(root, max_depth=2),
+                         [root, child, grandchild, second_child])
+        with self.assertNumQueries(0):
+            self.assertEqual(Comment.objects.subtree(root, max_depth=0), [root])
+    
+    def test_subtree_cte(self):
+        """
+        The recursive CTE used on postgres finds the same comments (sqlite
+        understands it too).
+        """
+        root, sibling, child, grandchild, great_grandchild, second_child = self.make_subtree()
+        old_vendors = models.SUBTREE_CTE_VENDORS
+        models.SUBTREE_CTE_VENDORS = (connection.vendor,)
+        try:
+            with self.assertNumQueries(1):
+                self.assertEqual(Comment.objects.subtree(root, max_depth=2),
+                                 [root, child, grandchild, second_child])
+            self.assertEqual(Comment.objects.subtree(child, max_depth=5),
+                             [child, grandchild, great_grandchild])
+        finally:
+            models.SUBTREE_CTE_VENDORS = old_vendors
+    
+    def test_ancestors(self):
+        """
+        A comment's ancestors are found with one query, top-level comment first.
+        """
+        root, sibling, child, grandchild, great_grandchild, second_child = self.make_subtree()
+        with self.assertNumQueries(1):
+            self.assertEqual(Comment.objects.ancestors(great_grandchild), [root, child, grandchild])
+        with self.assertNumQueries(0):
+            self.assertEqual(Comment.objects.ancestors(root), [])
+    
+    def test_thread_for_post(self):
+        """
+        Every thread on a post, oldest or newest thread first, with one query.
+        """
+        root, sibling, child, grandchild, great_grandchild, second_child = self.make_subtree()
+        sibling_reply = Comment.objects.get(content='Sibling reply.')
+        with self.assertNumQueries(1):
+            self.assertEqual(Comment.objects.thread_for_post(self.post),
+                             [root, child, grandchild, great_grandchild, second_child,
+                              sibling, sibling_reply])
+        self.assertEqual(Comment.objects.thread_for_post(self.post, order='newest'),
+                         [sibling, sibling_reply,
+                          root, child, grandchild, great_grandchild, second_child])
+        self.assertRaises(ValueError, Comment.objects.thread_for_post, self.post, order='best')
+    
+    def test_rebuild_thread_paths(self):
+        """
+        Paths in the old, unpadded format should be rewritten by the
+        rebuild_thread_paths command.
+        """
+        parent_comment = Comment.objects.create(user_name='Anonymous',
+                                                post=self.post, content='Parent.')
+        child_comment = Comment.objects.create(user_name='Anonymous',
+                                               post=self.post, content='Child.',
+                                               parent=parent_comment)
+        grandchild = Comment.objects.create(user_name='Anonymous',
+                                            post=self.post, content='Grandchild.',
+                                            parent=child_comment)
+        expected = Comment.objects.get(pk=grandchild.pk).thread_path
+        
+        Comment.objects.filter(pk=child_comment.pk).update(thread_path=str(parent_comment.pk))
+        Comment.objects.filter(pk=grandchild.pk).update(thread_path='%s;%s' % (parent_comment.pk,
+                                                                               child_comment.pk))
+        
+        management.call_command('rebuild_thread_paths', verbosity=0)
+        
+        self.assertEqual(Comment.objects.get(pk=child_comment.pk).thread_path,
+                         parent_comment.child_thread_path)
+        self.assertEqual(Comment.objects.get(pk=grandchild.pk).thread_path, expected)
+        self.assertEqual(Comment.objects.get(pk=parent_comment.pk).thread_path, None)
+
+
+class TestCommentPages(CommentTestCase):
+    """
+    Tests of paging through a post's comment threads.
+    """
+    
+    #queries to load a page of threads with nothing cached
+    page_queries = 1
+    
+    def add_thread(self, replies=0):
+        """
+        Helper method.  Add a top-level comment with a chain of replies
+        and return all of them, top-level comment first.
+        """
+        comments = [Comment.objects.create(user_name='Anonymous', post=self.post,
+                                           content='Top-level comment.')]
+        for i in range(replies):
+            comments.append(Comment.objects.create(user_name='Anonymous', post=self.post,
+                                                   content='Reply %s.' % i,
+                                                   parent=comments[-1]))
+        return comments
+    
+    def test_thread_pages(self):
+        """
+        Page through threads two at a time.
+        """
+        threads = [self.add_thread(replies=1) for i in range(5)]
+        
+        post = Post.objects.get(pk=self.post.pk)
+        with self.assertNumQueries(self.page_queries):
+            comments, next_after = Comment.get_thread_page(post, threads=2)
+        self.assertEqual(comments, [threads[0][0], threads[1][0]])
+        self.assertEqual(comments[0].replies, [threads[0][1]])
+        
+        comments, next_after = Comment.get_thread_page(self.post, after=next_after, threads=2)
+        self.assertEqual(comments, [threads[2][0], threads[3][0]])
+        
+        comments, next_after = Comment.get_thread_page(self.post, after=next_after, threads=2)
+        self.assertEqual(comments, [threads[4][0]])
+        self.assertEqual(next_after, None)
+        
+    def test_replies_per_thread(self):
+        """
+        Only the oldest replies in a thread are loaded, and the rest are counted.
+        """
+        thread = self.add_thread(replies=5)
+        other_thread = self.add_thread(replies=1)
+        
+        comments, next_after = Comment.get_thread_page(self.post, replies_per_thread=2)
+        self.assertEqual(comments[0].replies, [thread[1]])
+        self.assertEqual(comments[0].replies[0].replies, [thread[2]])
+        self.assertEqual(comments[0].replies[0].replies[0].replies, [])
+        self.assertEqual(comments[0].reply_count, 5)
+        self.assertEqual(comments[0].hidden_reply_count, 3)
+        self.assertEqual(comments[1].replies, [other_thread[1]])
+        self.assertEqual(comments[1].hidden_reply_count, 0)
+        
+    def test_reveal_reply(self):
+        """
+        A reply past the per-thread limit is still loaded when asked for.
+        """
+        thread = self.add_thread(replies=5)
+        
+        comments, next_after = Comment.get_thread_page(self.post, first=thread[0].pk,
+                                                       replies_per_thread=2, reveal=thread[4].pk)
+        self.assertEqual(comments[0].reply_count, 5)
+        self.assertEqual(comments[0].hidden_reply_count, 1)
+        
+    def test_comment_id_jumps_to_page(self):
+        """
+        Linking to a comment on a later page of threads shows that page.
+        """
+        threads = [self.add_thread(replies=1) for i in range(25)]
+        
+        res = self.client.get(self.post.get_absolute_url())
+        self.assertNotContains(res, 'comment_%s' % threads[22][1].pk)
+        self.assertContains(res, 'id=\'next_comments_link\'')
+        
+        res = self.client.get(self.post.get_absolute_url(),
+                              {'comment_id': threads[22][1].pk})
+        self.assertContains(res, 'comment_%s' % threads[22][1].pk)
+        self.assertContains(res, 'id=\'first_comments_link\'')
+        
+    def test_stream_all_comments(self):
+        """
+        Streaming the page shows every thread, after the post itself has
+        been sent without loading any comments.
+        """
+        threads = [self.add_thread(replies=2) for i in range(60)]
+        request = RequestFactory().get(self.post.get_absolute_url(), {'stream': '1'})
+        request.user = AnonymousUser()
+        
+        with self.assertNumQueries(2):
+            #the post and its owner
+            res = ViewPost.as_view()(request, slug=self.post.slug)
+            content = iter(res)
+            self.assertTrue(self.post.content in content.next())
+        
+        content = ''.join(content)
+        for thread in threads:
+            self.assertTrue('comment_%s_content' % thread[-1].pk in content)
+        self.assertTrue("id='add_comment_form'" in content)
+        
+    def test_stream_marker_in_post(self):
+        """
+        A post that mentions the marker the streamed page is split on still streams.
+        """
+        self.post.title = self.post.content = STREAMED_COMMENTS_MARKER
+        self.post.save()
+        comment = self.add_thread()[0]
+        
+        res = self.client.get(self.post.get_absolute_url(), {'stream': '1'})
+        content = ''.join(res)
+        self.assertTrue('comment_%s_content' % comment.pk in content)
+        self.assertTrue(escape(STREAMED_COMMENTS_MARKER) in content)
+        
+    def test_whole_thread(self):
+        """
+        The thread parameter shows one thread with all of its replies.
+        """
+        top_comment = self.add_thread()[0]
+        for i in range(60):
+            last_reply = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                                content='Reply %s.' % i,
+                                                parent=top_comment)
+        other_thread = self.add_thread()
+        
+        res = self.client.get(self.post.get_absolute_url())
+        self.assertNotContains(res, 'comment_%s' % last_reply.pk)
+        self.assertContains(res, '10 more replies')
+        
+        res = self.client.get(self.post.get_absolute_url(), {'thread': top_comment.pk})
+        self.assertContains(res, 'comment_%s' % last_reply.pk)
+        self.assertNotContains(res, 'comment_%s' % other_thread[0].pk)
+
+
+@override_settings(BLOG_COMMENT_TREE_MAX_COMMENTS=0)
+class TestCommentPagesInDatabase(TestCommentPages):
+    """
+    The same tests, for posts with too many comments to cache, which are
+    paged through in the database.
+    """
+    page_queries = 2
+
+
+class TestCommentTreeCache(CommentTestCase):
+    """
+    Tests of the cache of each post's comments.
+    """
+    
+    def comment_queries(self, path, data=None):
+        """
+        Helper method.  Get path, returning the response and the queries it
+        made of the comment table.
+        """
+        connection.use_debug_cursor = True
+        try:
+            connection.queries = []
+            res = self.client.get(path, data or {})
+            return res, [query['sql'] for query in connection.queries if 'blog_comment' in query['sql']]
+        finally:
+            connection.use_debug_cursor = None
+    
+    def test_new_comment_added_to_cache(self):
+        """
+        A new comment is added to its post's cached comments, rather than
+        them being loaded again.
+        """
+        self.login()
+        top_comment = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                             content='Top-level comment.')
+        res, queries = self.comment_queries(self.post.get_absolute_url())
+        self.assertEqual(len(queries), 1)
+        
+        reply = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                       content='A reply.', parent=top_comment)
+        res, queries = self.comment_queries(self.post.get_absolute_url())
+        self.assertEqual(queries, [])
+        self.assertContains(res, 'comment_%s_content' % reply.pk)
+        
+        res, queries = self.comment_queries(self.post.get_absolute_url(), {'comment_id': reply.pk})
+        self.assertEqual(queries, [])
+        self.assertContains(res, 'comment_%s_content' % reply.pk)
+    
+    def test_missing_comment_reloaded(self):
+        """
+        Cached comments that are missing one are loaded again.
+        """
+        self.login()
+        Comment.objects.create(user_name='Anonymous', post=self.post, content='First.')
+        second = Comment.objects.create(user_name='Anonymous', post=self.post, content='Second.')
+        self.client.get(self.post.get_absolute_url())
+        #as if the second comment's append had been lost to a concurrent one
+        count_error, nodes = blog_cache.get_comment_tree(self.post.pk)
+        blog_cache.set_comment_tree(self.post.pk, nodes[:1], count_error)
+        Comment.objects.create(user_name='Anonymous', post=self.post, content='Third.')
+        
+        res, queries = self.comment_queries(self.post.get_absolute_url())
+        self.assertEqual(len(queries), 1)
+        self.assertContains(res, 'comment_%s_content' % second.pk)
+        self.assertContains(res, 'Third.')
+    
+    def test_wrong_count_not_reloaded(self):
+        """
+        If a post's comment_count is wrong, its comments are loaded and
+        cached once, not loaded again for every page.
+        """
+        self.login()
+        Comment.objects.create(user_name='Anonymous', post=self.post, content='First.')
+        Post.objects.filter(pk=self.post.pk).update(comment_count=5)
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger('blog.models')
+        old_handlers, logger.handlers = logger.handlers, [handler]
+        try:
+            self.client.get(self.post.get_absolute_url())
+        finally:
+            logger.handlers = old_handlers
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].levelno, logging.WARNING)
+        
+        res, queries = self.comment_queries(self.post.get_absolute_url())
+        self.assertEqual(queries, [])
+        self.assertContains(res, 'First.')
+        Comment.objects.create(user_name='Anonymous', post=self.post, content='Second.')
+        res, queries = self.comment_queries(self.post.get_absolute_url())
+        self.assertEqual(queries, [])
+        self.assertContains(res, 'Second.')
+        
+    @override_settings(BLOG_COMMENT_TREE_MAX_BYTES=1000)
+    def test_too_big_not_cached(self):
+        """
+        Comments too big to cache are paged through in the database instead,
+        without loading them all again for every page.
+        """
+        self.login()
+        for i in range(3):
+            Comment.objects.create(user_name='Anonymous', post=self.post, content='Long. ' * 100)
+        res = self.client.get(self.post.get_absolute_url())
+        self.assertContains(res, 'Long.')
+        self.assertEqual(blog_cache.get_comment_tree(self.post.pk), (0, None))
+        
+        post = Post.objects.get(pk=self.post.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(Comment.get_tree_nodes(post), None)
+        
+    def test_changed_comment_forgotten(self):
+        """
+        Editing a comment makes its post's comments be loaded again.
+        """
+        self.login()
+        comment = Comment.objects.create(user_name='Anonymous', post=self.post, content='First.')
+        other_comment = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                               content='Second.')
+        self.client.get(self.post.get_absolute_url())
+        
+        comment.content = 'Edited.'
+        comment.save()
+        res = self.client.get(self.post.get_absolute_url())
+        self.assertContains(res, 'Edited.')
+        
+        other_comment.delete()
+        res = self.client.get(self.post.get_absolute_url())
+        self.assertNotContains(res, 'Second.')
+
+
+class TestCommentPolling(CommentTestCase):
+    """
+    Tests of polling for new comments on a post.
+    """
+    
+    def setUp(self):
+        super(TestCommentPolling, self).setUp()
+        self.poll_url = reverse('comment-poll', kwargs={'post_slug': self.post.slug})
+        self.first = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                            content='First.')
+    
+    def poll(self, data, **extra):
+        res = self.client.get(self.poll_url, data, **extra)
+        self.assertEqual(res.status_code, 200)
+        return res, json.loads(res.content)
+    
+    def test_after_id(self):
+        """
+        Polling after a comment's id gets the comments on the post since.
+        """
+        reply = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                       content='A reply.', parent=self.first)
+        other_post = Post.objects.create(title='Other Post', content='Monkeys', owner=self.author)
+        Comment.objects.create(user_name='Anonymous', post=other_post, content='Elsewhere.')
+        
+        res, data = self.poll({'after': self.first.pk})
+        self.assertEqual([comment['id'] for comment in data['comments']], [reply.pk])
+        self.assertEqual(data['comments'][0]['parent_id'], self.first.pk)
+        self.assertIn('A reply.', data['comments'][0]['html'])
+        self.assertEqual(data['last_id'], reply.pk)
+        self.assertFalse(data['more'])
+        
+        res, data = self.poll({'after': reply.pk})
+        self.assertEqual(data['comments'], [])
+        self.assertEqual(data['last_id'], reply.pk)
+    
+    def test_since(self):
+        """
+        Polling since a time gets the comments on the post since.
+        """
+        Comment.objects.filter(pk=self.first.pk).update(
+            created=datetime.datetime(2013, 1, 1, tzinfo=utc))
+        second = Comment.objects.create(user_name='Anonymous', post=self.post, content='Second.')
+        res, data = self.poll({'since': '2013-01-02T00:00:00'})
+        self.assertEqual([comment['id'] for comment in data['comments']], [second.pk])
+        
+        res, data = self.poll({'since': '2012-12-31T23:00:00-02:00'})
+        self.assertEqual([comment['id'] for comment in data['comments']], [second.pk])
+        
+        res, data = self.poll({'since': '2012-12-31T00:00:00Z'})
+        self.assertEqual([comment['id'] for comment in data['comments']],
+                         [self.first.pk, second.pk])
+    
+    def test_more(self):
+        """
+        At most POLL_MAX_COMMENTS come at once, and more says whether there are others.
+        """
+        for i in range(3):
+            Comment.objects.create(user_name='Anonymous', post=self.post, content='Another.')
+        old_max = views.POLL_MAX_COMMENTS
+        views.POLL_MAX_COMMENTS = 2
+        try:
+            res, data = self.poll({'after': self.first.pk})
+            self.assertEqual(len(data['comments']), 2)
+            self.assertTrue(data['more'])
+            res, data = self.poll({'after': data['last_id']})
+            self.assertEqual(len(data['comments']), 1)
+            self.assertFalse(data['more'])
+        finally:
+            views.POLL_MAX_COMMENTS = old_max
+    
+    def test_bad_requests(self):
+        """
+        Polls without a usable after or since, or for no post, fail.
+        """
+        res = self.client.get(self.poll_url)
+        self.assertEqual(res.status_code, 400)
+        res = self.client.get(self.poll_url, {'since': 'yesterday'})
+        self.assertEqual(res.status_code, 400)
+        res = self.client.get(self.poll_url, {'since': '2013-02-30T00:00:00'})
+        self.assertEqual(res.status_code, 400)
+        res = self.client.get(reverse('comment-poll', kwargs={'post_slug': 'no-such-post'}),
+                              {'after': 0})
+        self.assertEqual(res.status_code, 404)
+    
+    def test_not_modified(self):
+        """
+        Polling again with the ETag costs no queries until there's a new
+        comment, or the poll is for comments after another point.
+        """
+        res, data = self.poll({'after': self.first.pk})
+        etag = res['ETag']
+        
+        connection.use_debug_cursor = True
+        try:
+            connection.queries = []
+            res = self.client.get(self.poll_url, {'after': self.first.pk}, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(res.status_code, 304)
+            self.assertEqual(connection.queries, [])
+        finally:
+            connection.use_debug_cursor = None
+        
+        reply = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                       content='A reply.', parent=self.first)
+        res, data = self.poll({'after': self.first.pk}, HTTP_IF_NONE_MATCH=etag)
+        self.assertNotEqual(res['ETag'], etag)
+        self.assertEqual([comment['id'] for comment in data['comments']], [reply.pk])
+        etag = res['ETag']
+        
+        res, data = self.poll({'after': 0}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual([comment['id'] for comment in data['comments']], [self.first.pk, reply.pk])
+        res, data = self.poll({'since': '2012-12-31T00:00:00Z'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(len(data['comments']), 2)
+
+
+@override_settings(BLOG_EVENTS_KEEPALIVE=0.01, BLOG_EVENTS_MAX_TIME=1)
+class TestCommentEvents(CommentTestCase):
+    """
+    Tests of the server-sent events stream of new comments.
+    """
+    
+    def setUp(self):
+        super(TestCommentEvents, self).setUp()
+        self.events_url = reverse('comment-events', kwargs={'post_slug': self.post.slug})
+    
+    def open_stream(self, data=None, **extra):
+        res = self.client.get(self.events_url, data or {}, **extra)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res['Content-Type'], 'text/event-stream')
+        stream = iter(res)
+        self.assertEqual(next(stream), 'retry: 1000\n\n')
+        return res, stream
+    
+    def next_event(self, stream):
+        """
+        Helper method.  The data of the next event, skipping keep-alives.
+        """
+        for chunk in stream:
+            if not chunk.startswith(':'):
+                lines = chunk.splitlines()
+                self.assertTrue(lines[0].startswith('id: '))
+                return json.loads(lines[1][len('data: '):])
+    
+    def test_new_comment_sent(self):
+        """
+        A comment posted while the stream is open is sent as an event.
+        """
+        res, stream = self.open_stream()
+        self.assertTrue(next(stream).startswith(': keepalive'))
+        
+        comment = Comment.objects.create(user_name='Anonymous', post=self.post, content='Live!')
+        other_post = Post.objects.create(title='Other Post', content='Monkeys', owner=self.author)
+        Comment.objects.create(user_name='Anonymous', post=other_post, content='Elsewhere.')
+        reply = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                       content='A reply.', parent=comment)
+        
+        data = self.next_event(stream)
+        self.assertEqual(data['id'], comment.pk)
+        self.assertIn('Live!', data['html'])
+        data = self.next_event(stream)
+        self.assertEqual((data['id'], data['parent_id']), (reply.pk, comment.pk))
+        #publishing the comment left it alone
+        self.assertEqual(list(comment.replies), [reply])
+        res.close()
+    
+    def test_missed_comments_sent_first(self):
+        """
+        Comments since Last-Event-ID are sent before any new ones.
+        """
+        first = Comment.objects.create(user_name='Anonymous', post=self.post, content='First.')
+        second = Comment.objects.create(user_name='Anonymous', post=self.post, content='Second.')
+        res, stream = self.open_stream(HTTP_LAST_EVENT_ID=str(first.pk))
+        self.assertEqual(self.next_event(stream)['id'], second.pk)
+        third = Comment.objects.create(user_name='Anonymous', post=self.post, content='Third.')
+        self.assertEqual(self.next_event(stream)['id'], third.pk)
+        res.close()
+    
+    def test_stream_ends(self):
+        """
+        The stream closes after BLOG_EVENTS_MAX_TIME, for the browser to reopen.
+        """
+        from .broker import get_broker, post_channel
+        res, stream = self.open_stream()
+        channel = post_channel(self.post.pk)
+        self.assertTrue(get_broker().has_subscribers(channel))
+        chunks = list(stream)
+        self.assertTrue(all(chunk.startswith(':') for chunk in chunks))
+        self.assertFalse(get_broker().has_subscribers(channel))
+    
+    def test_unknown_post(self):
+        """
+        There's no stream for a post that doesn't exist.
+        """
+        res = self.client.get(reverse('comment-events', kwargs={'post_slug': 'no-such-post'}))
+        self.assertEqual(res.status_code, 404)
+
+
+class TestMoveSubtree(CommentTestCase):
+    """
+    Tests of moving comments, with their replies, to another parent.
+    """
+    
+    def setUp(self):
+        super(TestMoveSubtree, self).setUp()
+        self.earlier = Comment.objects.create(user_name='Anonymous', post=self.post, content='Earlier.')
+        self.first = Comment.objects.create(user_name='Anonymous', post=self.post, content='First.')
+        self.child = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                            content='Child.', parent=self.first)
+        self.grandchild = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                                 content='Grandchild.', parent=self.child)
+    
+    def reload(self, comment):
+        return Comment.objects.get(pk=comment.pk)
+    
+    def test_move_to_other_thread(self):
+        """
+        Moving a comment to another thread takes its replies along, with a
+        fixed number of queries, and moves their count to the new thread.
+        """
+        with self.assertNumQueries(4):
+            self.child.move_subtree(self.earlier)
+        
+        child, grandchild = self.reload(self.child), self.reload(self.grandchild)
+        self.assertEqual(child.parent, self.earlier)
+        self.assertEqual(child.path_list, [str(self.earlier.pk)])
+        self.assertEqual(grandchild.path_list, [str(self.earlier.pk), str(child.pk)])
+        self.assertEqual(self.reload(self.first).descendant_count, 0)
+        self.assertEqual(self.reload(self.earlier).descendant_count, 2)
+        self.assertEqual(self.reload(self.earlier).descendants, [child, grandchild])
+    
+    def test_move_to_top_level_and_back(self):
+        """
+        A reply can become a thread of its own, and go back again.
+        """
+        self.child.move_subtree(None)
+        child = self.reload(self.child)
+        self.assertEqual((child.parent, child.thread_path), (None, None))
+        self.assertEqual(child.descendant_count, 1)
+        self.assertEqual(self.reload(self.grandchild).path_list, [str(child.pk)])
+        self.assertEqual(self.reload(self.first).descendant_count, 0)
+        
+        child.move_subtree(self.earlier)
+        self.assertEqual(self.reload(child).descendant_count, 0)
+        self.assertEqual(self.reload(self.earlier).descendant_count, 2)
+        self.assertEqual(self.reload(self.grandchild).path_list,
+                         [str(self.earlier.pk), str(child.pk)])
+    
+    def test_invalid_moves(self):
+        """
+        Comments can't be moved under themselves, their replies, newer
+        comments, or another post.
+        """
+        later = Comment.objects.create(user_name='Anonymous', post=self.post, content='Later.')
+        other_post = Post.objects.create(title='Other Post', content='Monkeys', owner=self.author)
+        elsewhere = Comment.objects.create(user_name='Anonymous', post=other_post, content='Elsewhere.')
+        self.assertRaises(ValueError, self.first.move_subtree, self.first)
+        self.assertRaises(ValueError, self.first.move_subtree, self.grandchild)
+        self.assertRaises(ValueError, self.first.move_subtree, elsewhere)
+        self.assertRaises(ValueError, self.child.move_subtree, later)
+        self.assertEqual(self.reload(self.grandchild).path_list,
+                         [str(self.first.pk), str(self.child.pk)])
+    
+    def test_paged_after_move(self):
+        """
+        A moved subtree is paged like any other replies: the oldest first,
+        each after what it replies to.
+        """
+        self.child.move_subtree(self.earlier)
+        in_memory = Comment.get_thread_page(self.post, threads=1, replies_per_thread=1)[0]
+        with override_settings(BLOG_COMMENT_TREE_MAX_COMMENTS=0):
+            in_database = Comment.get_thread_page(self.post, threads=1, replies_per_thread=1)[0]
+        for comments in (in_memory, in_database):
+            self.assertEqual(comments, [self.earlier])
+            self.assertEqual(comments[0].replies, [self.child])
+            self.assertEqual(comments[0].replies[0].replies, [])
+            self.assertEqual(comments[0].hidden_reply_count, 1)
+    
+    def test_page_updated(self):
+        """
+        A moved comment shows up in its new place on the post's page.
+        """
+        self.client.get(self.post.get_absolute_url())
+        self.child.move_subtree(self.earlier)
+        res = self.client.get(self.post.get_absolute_url())
+        #the child's markup has moved inside the earlier comment's
+        second = res.content.index("id='comment_%s'" % self.earlier.pk)
+        self.assertTrue(second < res.content.index("id='comment_%s'" % self.child.pk))
+        self.assertTrue(second < res.content.index("id='comment_%s'" % self.grandchild.pk))
+    
+    def test_admin_moves_replies(self):
+        """
+        Changing a comment's parent in the admin moves its replies too.
+        """
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin_pass')
+        self.client.login(username='admin', password='admin_pass')
+        url = reverse('admin:blog_comment_change', args=[self.child.pk])
+        data = {'post': self.post.pk, 'user': '', 'user_name': 'Anonymous',
+                'content': 'Child.', 'parent': self.earlier.pk}
+        res = self.client.post(url, data)
+        self.assertEqual(res.status_code, 302)
+        self.assertEqual(self.reload(self.grandchild).path_list,
+                         [str(self.earlier.pk), str(self.child.pk)])
+        self.assertEqual(self.reload(self.earlier).descendant_count, 2)
+        
+        data['parent'] = self.grandchild.pk
+        res = self.client.post(url, data)
+        self.assertContains(res, "can&#39;t be moved under itself")
+
+
+class TestDeletePosts(CommentTestCase):
+    """
+    Tests of deleting posts with their comments, now and deferred.
+    """
+    
+    def setUp(self):
+        super(TestDeletePosts, self).setUp()
+        self.author.is_staff = True
+        self.author.set_password('post_author_pass')
+        self.author.save()
+        self.other_post = Post.objects.create(title='Other Post', content='Monkeys',
+                                              owner=self.author)
+        self.other_comment = Comment.objects.create(user_name='Anonymous', post=self.other_post,
+                                                    content='Elsewhere.')
+    
+    def add_comments(self, post, count):
+        parent = None
+        for i in range(count):
+            parent = Comment.objects.create(user_name='Anonymous', post=post,
+                                            content='Comment %s.' % i, parent=parent)
+    
+    def delete_queries(self, post):
+        """
+        Helper method.  Delete post, returning the number of queries it took.
+        """
+        connection.use_debug_cursor = True
+        try:
+            connection.queries = []
+            post.delete()
+            return len(connection.queries)
+        finally:
+            connection.use_debug_cursor = None
+    
+    def test_delete_queries_dont_grow(self):
+        """
+        Deleting a post takes the same queries however many comments it has,
+        and deletes them all.
+        """
+        self.add_comments(self.post, 3)
+        bigger_post = Post.objects.create(title='Bigger Post', content='Monkeys', owner=self.author)
+        self.add_comments(bigger_post, 30)
+        
+        self.assertEqual(self.delete_queries(self.post), self.delete_queries(bigger_post))
+        self.assertFalse(Comment.objects.filter(post__in=[self.post.pk, bigger_post.pk]).exists())
+        self.assertEqual(list(Comment.objects.all()), [self.other_comment])
+    
+    def test_delete_comments(self):
+        """
+        delete_comments() empties a post and its page.
+        """
+        self.add_comments(self.post, 3)
+        self.client.get(self.post.get_absolute_url())
+        self.assertEqual(self.post.delete_comments(), 3)
+        self.assertEqual(Post.objects.get(pk=self.post.pk).comment_count, 0)
+        res = self.client.get(self.post.get_absolute_url())
+        self.assertNotContains(res, 'Comment 0.')
+    
+    @override_settings(BLOG_DEFER_POST_DELETION=True)
+    def test_deferred_deletion(self):
+        """
+        With BLOG_DEFER_POST_DELETION on, a deleted post is hidden at once,
+        and purge_deleted_posts deletes it and its comments later.
+        """
+        self.add_comments(self.post, 3)
+        post_url = self.post.get_absolute_url()
+        self.client.get(post_url)
+        self.client.login(username='post_author', password='post_author_pass')
+        res = self.client.post(reverse('post-delete', kwargs={'slug': self.post.slug}))
+        self.assertRedirects(res, reverse('post-list'))
+        
+        #hidden at once, but still there
+        self.client.logout()
+        self.assertEqual(self.client.get(post_url).status_code, 404)
+        self.assertNotContains(self.client.get(reverse('post-list')), 'Base Post')
+        self.assertEqual(Comment.objects.filter(post=self.post).count(), 3)
+        new_post = Post.objects.create(title='Base Post', content='Again', owner=self.author)
+        self.assertEqual(new_post.slug, 'base-post-2')
+        
+        management.call_command('purge_deleted_posts', verbosity=0)
+        self.assertFalse(Post.all_objects.filter(pk=self.post.pk).exists())
+        self.assertFalse(Comment.objects.filter(post=self.post).exists())
+        self.assertTrue(Comment.objects.filter(pk=self.other_comment.pk).exists())
+    
+    def test_stale_save_keeps_tombstone(self):
+        """
+        Saving a post loaded before it was tombstoned doesn't bring it back.
+        """
+        stale_post = Post.objects.get(pk=self.post.pk)
+        self.post.tombstone()
+        stale_post.save()
+        self.assertFalse(Post.objects.filter(pk=self.post.pk).exists())
+
+
+class TestRemovedComments(CommentTestCase):
+    """
+    Tests of removing comments, which leaves placeholders in their threads.
+    """
+    
+    def setUp(self):
+        super(TestRemovedComments, self).setUp()
+        self.top_comment = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                                  content='Regrettable.')
+        self.reply = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                            content='Reply to the regrettable.',
+                                            parent=self.top_comment)
+    
+    def reload(self, obj):
+        return obj.__class__.objects.get(pk=obj.pk)
+    
+    def remove(self, *comments):
+        return Comment.objects.remove(Comment.objects.filter(pk__in=[c.pk for c in comments]))
+    
+    def test_placeholder_keeps_replies(self):
+        """
+        A removed comment shows as a placeholder with its replies still
+        under it, and only comes off the counts once.
+        """
+        self.client.get(self.post.get_absolute_url())
+        self.assertEqual(self.remove(self.top_comment), 1)
+        self.assertEqual(self.remove(self.top_comment), 0)
+        
+        res = self.client.get(self.post.get_absolute_url())
+        self.assertNotContains(res, 'Regrettable.')
+        self.assertContains(res, '[removed]')
+        self.assertContains(res, 'Reply to the regrettable.')
+        self.assertNotContains(res, 'comment_%s_reply_link' % self.top_comment.pk)
+        self.assertEqual(self.reload(self.post).comment_count, 1)
+        self.assertEqual(self.reload(self.top_comment).descendant_count, 1)
+    
+    def test_rendered_from_cache_in_one_pass(self):
+        """
+        Placeholders are rendered from the cached comments without
+        querying the comments again.
+        """
+        self.remove(self.top_comment)
+        self.login()
+        self.client.get(self.post.get_absolute_url())
+        connection.use_debug_cursor = True
+        try:
+            connection.queries = []
+            res = self.client.get(self.post.get_absolute_url())
+            self.assertEqual([query for query in connection.queries
+                              if 'blog_comment' in query['sql']], [])
+        finally:
+            connection.use_debug_cursor = None
+        self.assertContains(res, '[removed]')
+    
+    def test_no_replies_to_removed(self):
+        """
+        A removed comment can't be replied to.
+        """
+        self.remove(self.top_comment)
+        res = self.client.post(self.top_comment.get_reply_url(),
+                               {'user_name': 'Anonymous', 'content': 'Too late.'})
+        self.assertEqual(res.status_code, 404)
+    
+    def test_deleting_removed_comment(self):
+        """
+        Deleting a removed comment doesn't take it off its post's count again.
+        """
+        self.remove(self.reply)
+        self.reload(self.reply).delete()
+        self.assertEqual(self.reload(self.post).comment_count, 1)
+    
+    def test_admin_action(self):
+        """
+        The admin's remove_comments action removes just the comments selected.
+        """
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin_pass')
+        self.client.login(username='admin', password='admin_pass')
+        res = self.client.post(reverse('admin:blog_comment_changelist'),
+                               {'action': 'remove_comments',
+                                '_selected_action': [self.reply.pk]})
+        self.assertEqual(res.status_code, 302)
+        self.assertTrue(self.reload(self.reply).is_removed)
+        self.assertFalse(self.reload(self.top_comment).is_removed)
+    
+    def test_compaction(self):
+        """
+        compact_removed_comments deletes removed comments with nothing
+        showing under them, and keeps the counts right.
+        """
+        dead_reply = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                            content='Dead reply.', parent=self.reply)
+        dead_thread = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                             content='Dead thread.')
+        dead_thread_reply = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                                   content='Dead too.', parent=dead_thread)
+        self.remove(self.top_comment, dead_reply, dead_thread, dead_thread_reply)
+        
+        management.call_command('compact_removed_comments', verbosity=0)
+        #the top comment still has a reply showing
+        self.assertEqual(sorted(Comment.objects.values_list('pk', flat=True)),
+                         [self.top_comment.pk, self.reply.pk])
+        self.assertEqual(self.reload(self.top_comment).descendant_count, 1)
+        self.assertEqual(self.reload(self.post).comment_count, 1)
+        res = self.client.get(self.post.get_absolute_url())
+        self.assertContains(res, 'Reply to the regrettable.')
+    
+    def test_stale_save_keeps_removed(self):
+        """
+        Saving a comment loaded before it was removed doesn't bring it back,
+        or put it back on its post's count.
+        """
+        stale = self.reload(self.reply)
+        self.remove(self.reply)
+        stale.content = 'Edited.'
+        stale.save()
+        self.assertTrue(self.reload(self.reply).is_removed)
+        self.assertEqual(self.reload(self.post).comment_count, 1)
+
+
+class TestCommentCounts(CommentTestCase):
+    """
+    Tests of the denormalized comment counts on posts and threads.
+    """
+    
+    def reload(self, obj):
+        return obj.__class__.objects.get(pk=obj.pk)
+    
+    def make_thread(self):
+        """
+        Helper method.  A top-level comment with a reply, which has a reply.
+        """
+        top_comment = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                             content='Top-level comment.')
+        reply = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                       content='Reply.', parent=top_comment)
+        reply_reply = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                             content='Reply to the reply.', parent=reply)
+        return top_comment, reply, reply_reply
+    
+    def test_counts_on_save(self):
+        """
+        Adding a comment counts it on its post and its thread, once.
+        """
+        top_comment, reply, reply_reply = self.make_thread()
+        
+        self.assertEqual(self.reload(self.post).comment_count, 3)
+        self.assertEqual(self.reload(top_comment).descendants_count, 2)
+        self.assertRaises(ValueError, lambda: self.reload(reply).descendants_count)
+        
+        #saving an existing comment doesn't count it again
+        reply.save()
+        self.assertEqual(self.reload(self.post).comment_count, 3)
+        self.assertEqual(self.reload(top_comment).descendant_count, 2)
+        
+    def test_counts_on_delete(self):
+        """
+        Deleting a comment takes it and its replies off the counts.
+        """
+        top_comment, reply, reply_reply = self.make_thread()
+        other_comment = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                               content='Another top-level comment.')
+        
+        #deleting a reply takes its replies with it
+        reply.delete()
+        self.assertEqual(self.reload(self.post).comment_count, 2)
+        self.assertEqual(self.reload(top_comment).descendant_count, 0)
+        
+        top_comment.delete()
+        self.assertEqual(self.reload(self.post).comment_count, 1)
+        
+    def test_stale_save_keeps_counts(self):
+        """
+        Saving a post or comment loaded before comments were added doesn't
+        put back the counts it was loaded with.
+        """
+        stale_post = self.reload(self.post)
+        top_comment = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                             content='Top-level comment.')
+        stale_comment = self.reload(top_comment)
+        Comment.objects.create(user_name='Anonymous', post=self.post,
+                               content='Reply.', parent=top_comment)
+        
+        stale_post.title = 'Edited'
+        stale_post.save()
+        stale_comment.content = 'Edited'
+        stale_comment.save()
+        
+        self.assertEqual(stale_post.comment_count, 2)
+        self.assertEqual(self.reload(self.post).comment_count, 2)
+        self.assertEqual(self.reload(top_comment).descendant_count, 1)
+        
+    def test_counts_on_post_list(self):
+        """
+        The list of posts shows each post's count.
+        """
+        self.make_thread()
+        res = self.client.get(reverse('post-list'))
+        self.assertContains(res, '3 comments')
+        
+    def test_recount_comments(self):
+        """
+        recount_comments puts wrong counts right.
+        """
+        top_comment, reply, reply_reply = self.make_thread()
+        Post.objects.update(comment_count=42)
+        Comment.objects.update(descendant_count=42)
+        
+        management.call_command('recount_comments', verbosity=0)
+        
+        self.assertEqual(self.reload(self.post).comment_count, 3)
+        self.assertEqual(self.reload(top_comment).descendant_count, 2)
+
+
+class TestCommentTransactions(TransactionTestCase):
+    """
+    Tests of saving comments within a transaction of the caller's.
+    """
+    
+    def setUp(self):
+        """
+        A post to comment on, and no cached queries from earlier tests.
+        """
+        cache.clear()
+        johnny_local.clear('%s_*' % johnny_settings.MIDDLEWARE_KEY_PREFIX)
+        author = User.objects.create(username='post_author')
+        self.post = Post.objects.create(title='Base Post', content='Just a dummy post',
+                                        owner=author)
+    
+    def test_rolled_back_with_caller(self):
+        """
+        Comment.save() leaves the caller's transaction for the caller to
+        commit, so if the caller rolls back, the comment and its count go too.
+        """
+        try:
+            with transaction.commit_on_success():
+                Comment.objects.create(user_name='Anonymous', post=self.post,
+                                       content='Never mind.')
+                raise ValueError
+        except ValueError:
+            pass
+        
+        self.assertEqual(Comment.objects.count(), 0)
+        self.assertEqual(Post.objects.get(pk=self.post.pk).comment_count, 0)
+    
+    def test_post_delete_all_or_nothing(self):
+        """
+        If deleting a post fails, its comments aren't deleted either.
+        """
+        Comment.objects.create(user_name='Anonymous', post=self.post, content='Still here.')
+        def refuse(sender, instance, **kwargs):
+            raise ValueError
+        pre_delete.connect(refuse, sender=Post)
+        try:
+            self.assertRaises(ValueError, Post.objects.get(pk=self.post.pk).delete)
+        finally:
+            pre_delete.disconnect(refuse, sender=Post)
+        
+        self.assertEqual(Comment.objects.filter(post=self.post).count(), 1)
+        self.assertEqual(Post.objects.get(pk=self.post.pk).comment_count, 1)
+    
+    def test_remove_rolled_back_with_caller(self):
+        """
+        CommentManager.remove() leaves the caller's transaction for the
+        caller to commit, so if the caller rolls back, the comment stays.
+        """
+        comment = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                         content='Keep me.')
+        try:
+            with transaction.commit_on_success():
+                Comment.objects.remove(Comment.objects.filter(pk=comment.pk))
+                raise ValueError
+        except ValueError:
+            pass
+        
+        self.assertFalse(Comment.objects.get(pk=comment.pk).is_removed)
+        self.assertEqual(Post.objects.get(pk=self.post.pk).comment_count, 1)
+
+
+class TestPageCache(CommentTestCase):
+    """
+    Tests of caching rendered pages.
+    """
+    
+    def test_anonymous_page_cached(self):
+        """
+        The second anonymous view of a post doesn't touch the database.
+        """
+        Comment.objects.create(user_name='Anonymous', post=self.post, content='First!')
+        url = self.post.get_absolute_url()
+        self.client.get(url)
+        
+        with self.assertNumQueries(0):
+            res = self.client.get(url)
+        self.assertContains(res, 'First!')
+        
+        self.client.get(reverse('post-list'))
+        with self.assertNumQueries(0):
+            res = self.client.get(reverse('post-list'))
+        self.assertContains(res, self.post.title)
+        
+    def test_comment_invalidates_page(self):
+        """
+        Adding or deleting a comment shows up on the post's page and on the list.
+        """
+        url = self.post.get_absolute_url()
+        self.client.get(url)
+        self.client.get(reverse('post-list'))
+        
+        comment = Comment.objects.create(user_name='Anonymous', post=self.post, content='Second!')
+        self.assertContains(self.client.get(url), 'Second!')
+        self.assertContains(self.client.get(reverse('post-list')), '1 comment')
+        
+        comment.delete()
+        self.assertNotContains(self.client.get(url), 'Second!')
+        self.assertContains(self.client.get(reverse('post-list')), '0 comments')
+        
+    def test_edit_invalidates_page(self):
+        """
+        Editing a post shows up on its page.
+        """
+        url = self.post.get_absolute_url()
+        self.client.get(url)
+        
+        self.post.content = 'A brand new dummy post'
+        self.post.save()
+        self.assertContains(self.client.get(url), 'A brand new dummy post')
+        
+    def test_csrf_token_per_visitor(self):
+        """
+        Each anonymous visitor gets their own CSRF token in a cached page.
+        """
+        url = self.post.get_absolute_url()
+        self.client.get(url)
+        
+        other_client = Client()
+        res = other_client.get(url)
+        token = other_client.cookies['csrftoken'].value
+        self.assertContains(res, "value='%s'" % token)
+        self.assertNotContains(res, self.client.cookies['csrftoken'].value)
+        
+    def test_csrf_token_like_markup(self):
+        """
+        A visitor whose CSRF cookie is a word that's in the page doesn't
+        change the page cached for everyone else.
+        """
+        url = self.post.get_absolute_url()
+        expected = Client().get(url).content
+        cache.clear()
+        
+        self.client.cookies['csrftoken'] = 'div'
+        res = self.client.get(url)
+        self.assertContains(res, "value='div'")
+        res = Client().get(url)
+        self.assertEqual(res.content.count('<div'), expected.count('<div'))
+        self.assertNotContains(res, "value='div'")
+        
+    def test_logged_in_page_not_cached(self):
+        """
+        Logged-in users get their own page, but the comments are cached.
+        """
+        Comment.objects.create(user_name='Anonymous', post=self.post, content='Third!')
+        url = self.post.get_absolute_url()
+        self.client.get(url)
+        
+        self.login()
+        res = self.client.get(url)
+        self.assertContains(res, 'Hello, logged_in_commenter.')
+        self.assertContains(res, 'Third!')
+        self.assertFalse('comments' in res.context)
+        
+    def test_versions_bumped_after_save(self):
+        """
+        A comment's post gets new cache versions only once the comment's
+        committed, so a page rendered just before can't be cached under them.
+        """
+        version = blog_cache.get_version(blog_cache.post_version(self.post.pk))
+        seen = []
+        def during_save(sender, instance, **kwargs):
+            seen.append(blog_cache.get_version(blog_cache.post_version(instance.post_id)))
+        post_save.connect(during_save, sender=Comment)
+        try:
+            Comment.objects.create(user_name='Anonymous', post=self.post, content='Fourth!')
+        finally:
+            post_save.disconnect(during_save, sender=Comment)
+        
+        self.assertEqual(seen, [version])
+        self.assertNotEqual(blog_cache.get_version(blog_cache.post_version(self.post.pk)), version)
+        
+    def test_query_string_junk_not_cached(self):
+        """
+        Query string parameters a page doesn't use don't make another copy of it.
+        """
+        url = self.post.get_absolute_url()
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            self.client.get(url, {'utm_source': 'elsewhere'})
+        
+        self.client.get(reverse('post-list'))
+        with self.assertNumQueries(0):
+            self.client.get(reverse('post-list'), {'before': 'garbled'})
+
+
+
+class TestCommentTreeTag(CommentTestCase):
+    """
+    Tests of the comment_tree template tag.
+    """
+    
+    def normalize(self, html):
+        """
+        Helper method.  Squash whitespace differences between templates.
+        """
+        return ' '.join(html.replace('>', '> ').replace('<', ' <').split())
+    
+    def test_same_as_include(self):
+        """
+        comment_tree renders the same markup as the recursive include it replaced.
+        """
+        top_comment = Comment.objects.create(user_name='Anonymous <script>', post=self.post,
+                                             content='Top-level & "quoted".')
+        reply = Comment.objects.create(user=self.commenter, post=self.post,
+                                       content='Reply.', parent=top_comment)
+        Comment.objects.create(user_name='Anonymous', post=self.post,
+                               content='Reply to the reply.', parent=reply)
+        Comment.objects.create(user_name='Anonymous', post=self.post,
+                               content='Second reply.', parent=top_comment)
+        Comment.objects.create(user_name='Anonymous', post=self.post,
+                               content='Another thread.')
+        comments = Comment.get_comment_tree_for_post(self.post)
+        
+        include_template = Template("{% for comment in comments %}<li>"
+                                    "{% include 'blog/benchmark/comment_inline_include.html' %}"
+                                    "</li>{% endfor %}")
+        tag_template = Template("{% load comment_tree %}{% comment_tree comments %}")
+        
+        expected = include_template.render(Context({'comments': comments}))
+        with self.assertNumQueries(0):
+            rendered = tag_template.render(Context({'comments': comments}))
+        self.assertEqual(self.normalize(rendered), self.normalize(expected))
+        self.assertTrue('&lt;script&gt;' in rendered)
+        
+    def test_removed_placeholder_same_as_include(self):
+        """
+        The tag renders a removed comment's placeholder the same as the
+        include does.
+        """
+        top_comment = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                             content='Removed.')
+        Comment.objects.create(user_name='Anonymous', post=self.post,
+                               content='Reply.', parent=top_comment)
+        Comment.objects.remove(Comment.objects.filter(pk=top_comment.pk))
+        comments = Comment.get_comment_tree_for_post(self.post)
+        
+        include_template = Template("{% for comment in comments %}<li>"
+                                    "{% include 'blog/benchmark/comment_inline_include.html' %}"
+                                    "</li>{% endfor %}")
+        tag_template = Template("{% load comment_tree %}{% comment_tree comments %}")
+        rendered = tag_template.render(Context({'comments': comments}))
+        self.assertEqual(self.normalize(rendered),
+                         self.normalize(include_template.render(Context({'comments': comments}))))
+        self.assertTrue('[removed]' in rendered and 'Removed.' not in rendered)
+        
+    def test_deep_thread(self):
+        """
+        A thread far deeper than Python's recursion limit still renders.
+        """
+        parent = None
+        for i in range(1200):
+            parent = Comment(user_name='Anonymous', post=self.post,
+                             content='Comment %s.' % i, parent=parent)
+            parent.save()
+        
+        res = self.client.get(self.post.get_absolute_url(), {'thread': parent.root_id})
+        self.assertContains(res, 'comment_%s_content' % parent.pk)
+
+
+class TestImportExport(CommentTestCase):
+    """
+    Tests of the export_blog and import_blog commands.
+    """
+    
+    def setUp(self):
+        """
+        An empty file for the commands to write and read.
+        """
+        super(TestImportExport, self).setUp()
+        fd, self.filename = tempfile.mkstemp(suffix='.jsonl')
+        os.close(fd)
+    
+    def tearDown(self):
+        os.remove(self.filename)
+    
+    def import_blog(self, **options):
+        """
+        Run import_blog with options, raising any CommandError rather
+        than exiting like call_command() does.
+        """
+        command = import_blog.Command()
+        command.stdout = StringIO()
+        options = dict({'batch_size': 1000, 'owner': None, 'verbosity': 0}, **options)
+        command.handle(self.filename, **options)
+    
+    def write_records(self, *records):
+        with open(self.filename, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+    
+    def test_round_trip_after_move(self):
+        """
+        Comments moved to another thread are exported after their new parents.
+        """
+        earlier = Comment.objects.create(user_name='Anonymous', post=self.post, content='Earlier.')
+        top_comment = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                             content='Top-level comment.')
+        reply = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                       content='Reply.', parent=top_comment)
+        Comment.objects.create(user_name='Anonymous', post=self.post,
+                               content='Reply to the reply.', parent=reply)
+        reply.move_subtree(earlier)
+        
+        management.call_command('export_blog', self.filename, verbosity=0)
+        self.import_blog()
+        
+        copy = Post.objects.get(slug='base-post-2')
+        copied_earlier, copied_top = Comment.get_comment_tree_for_post(copy)
+        self.assertEqual(copied_earlier.descendant_count, 2)
+        self.assertEqual(copied_top.descendant_count, 0)
+        self.assertEqual(copied_earlier.replies[0].content, 'Reply.')
+        self.assertEqual(copied_earlier.replies[0].replies[0].content, 'Reply to the reply.')
+    
+    def test_round_trip(self):
+        """
+        Exporting then importing copies every post and comment, with new ids,
+        thread paths and counts as if they'd been posted one by one.
+        """
+        top_comment = Comment.objects.create(user=self.commenter, post=self.post,
+                                             content='Top-level comment.')
+        reply = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                       content='Reply.', parent=top_comment)
+        Comment.objects.create(user_name='Anonymous', post=self.post,
+                               content='Reply to the reply.', parent=reply)
+        Comment.objects.create(user_name='Anonymous', post=self.post,
+                               content='Another top-level comment.')
+        Post.objects.create(title='Quiet Post', content='No comments', owner=self.author)
+        
+        management.call_command('export_blog', self.filename, verbosity=0)
+        management.call_command('import_blog', self.filename, batch_size=2, verbosity=0)
+        
+        self.assertEqual(Post.objects.count(), 4)
+        copy = Post.objects.get(slug='base-post-2')
+        self.assertEqual(copy.owner, self.author)
+        self.assertEqual(copy.created, self.post.created)
+        self.assertEqual(copy.comment_count, 4)
+        self.assertEqual(Post.objects.get(slug='quiet-post-2').comment_count, 0)
+        
+        copied_comments = Comment.get_comment_tree_for_post(copy)
+        self.assertEqual([comment.content for comment in copied_comments],
+                         ['Top-level comment.', 'Another top-level comment.'])
+        copied_top, copied_other = copied_comments
+        self.assertEqual(copied_top.user, self.commenter)
+        self.assertEqual(copied_top.descendant_count, 2)
+        self.assertEqual(copied_other.descendant_count, 0)
+        copied_reply = copied_top.replies[0]
+        self.assertEqual(copied_reply.content, 'Reply.')
+        self.assertEqual(copied_reply.thread_path, copied_top.child_thread_path)
+        self.assertEqual(copied_reply.replies[0].thread_path, copied_reply.child_thread_path)
+        
+        #new comments carry on after the imported ids
+        comment = Comment.objects.create(user_name='Anonymous', post=copy,
+                                         content='New comment.', parent=copied_reply)
+        self.assertEqual(Comment.objects.get(pk=comment.pk).thread_path, comment.thread_path)
+        self.assertEqual(Post.objects.get(pk=copy.pk).comment_count, 5)
+    
+    def test_unknown_owner(self):
+        """
+        Posts by users who aren't here aren't imported without --owner, and
+        comments by them are kept as anonymous ones.
+        """
+        self.write_records({'type': 'post', 'id': 1, 'title': 'Imported', 'content': 'Monkeys',
+                            'owner': 'nobody', 'created': '2012-12-01T10:00:00Z'},
+                           {'type': 'comment', 'id': 1, 'post': 1, 'parent': None,
+                            'user': 'nobody', 'user_name': 'nobody', 'content': 'Hi'})
+        self.assertRaises(CommandError, self.import_blog)
+        self.assertFalse(Post.objects.filter(title='Imported').exists())
+        
+        self.import_blog(owner='post_author')
+        post = Post.objects.get(title='Imported')
+        self.assertEqual(post.owner, self.author)
+        self.assertEqual(post.slug, 'imported')
+        self.assertEqual(post.created.year, 2012)
+        comment = post.comment_set.get()
+        self.assertEqual(comment.user, None)
+        self.assertEqual(comment.user_name, 'nobody')
+    
+    def test_reply_before_parent(self):
+        """
+        A reply must come after the comment it replies to.
+        """
+        self.write_records({'type': 'post', 'id': 1, 'title': 'Imported', 'content': 'Monkeys',
+                            'owner': 'post_author'},
+                           {'type': 'comment', 'id': 2, 'post': 1, 'parent': 3,
+                            'user_name': 'Anonymous', 'content': 'Reply'})
+        self.assertRaises(CommandError, self.import_blog)
+
+
+class TestQueryInstrumentation(CommentTestCase):
+    """
+    Tests of the opt-in instrumentation middleware.
+    """
+    
+    def setUp(self):
+        super(TestQueryInstrumentation, self).setUp()
+        self.records = []
+        self.handler = logging.Handler()
+        self.handler.emit = self.records.append
+        #capture the log lines instead of printing them
+        self.logger = logging.getLogger('blog.instrumentation')
+        self.old_handlers = self.logger.handlers
+        self.logger.handlers = [self.handler]
+    
+    def tearDown(self):
+        self.logger.handlers = self.old_handlers
+    
+    def test_off_by_default(self):
+        """
+        Without BLOG_INSTRUMENTATION, responses carry no counts and nothing's logged.
+        """
+        res = self.client.get(self.post.get_absolute_url())
+        self.assertFalse(res.has_header('X-Query-Count'))
+        self.assertEqual(self.records, [])
+    
+    @override_settings(BLOG_INSTRUMENTATION=True)
+    def test_headers_and_log(self):
+        """
+        Each response carries its query count, cache hits and misses and
+        timings, and a line with them is logged.
+        """
+        Comment.objects.create(user_name='Anonymous', post=self.post, content='A comment.')
+        connection.use_debug_cursor = True
+        try:
+            connection.queries = []
+            res = Client().get(self.post.get_absolute_url())
+            queries = len(connection.queries)
+        finally:
+            connection.use_debug_cursor = None
+        
+        self.assertEqual(int(res['X-Query-Count']), queries)
+        #the page isn't cached yet
+        self.assertTrue(int(res['X-Cache-Misses']) > 0)
+        self.assertTrue(float(res['X-Template-Time']) > 0)
+        self.assertTrue(float(res['X-Response-Time']) >= float(res['X-Template-Time']))
+        self.assertEqual(len(self.records), 1)
+        self.assertEqual(self.records[0].levelno, logging.INFO)
+        line = self.records[0].getMessage()
+        self.assertTrue(line.startswith('method=GET path="%s" status=200 query_count=%s ' %
+                                        (self.post.get_absolute_url(), queries)))
+        
+        #now the page comes from the cache
+        res = Client().get(self.post.get_absolute_url())
+        self.assertEqual(res['X-Query-Count'], '0')
+        self.assertTrue(int(res['X-Cache-Hits']) > 0)
+    
+    @override_settings(BLOG_INSTRUMENTATION=True, BLOG_SLOW_REQUEST_TIME=0,
+                       BLOG_INSTRUMENTATION_HEADERS=False)
+    def test_slow_request(self):
+        """
+        Slow requests are logged as warnings, and the headers can be left off.
+        """
+        res = Client().get(reverse('post-list'))
+        self.assertFalse(res.has_header('X-Query-Count'))
+        self.assertEqual(self.records[0].levelno, logging.WARNING)
+        self.assertTrue(self.records[0].getMessage().endswith(' slow=1'))
+
+
+class QueryBudget(object):
+    """
+    Context manager which fails test_case if the block runs more than
+    budget queries, listing the queries it ran.
+    
+    Unlike assertNumQueries(), a change that saves queries doesn't fail, so
+    budgets only need raising when a page genuinely needs more.
+    """
+    def __init__(self, test_case, budget):
+        self.test_case = test_case
+        self.budget = budget
+    
+    def __enter__(self):
+        self.use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        #the queries would otherwise be forgotten at the start of each request
+        request_started.disconnect(reset_queries)
+        self.start = len(connection.queries)
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        connection.use_debug_cursor = self.use_debug_cursor
+        request_started.connect(reset_queries)
+        if exc_type is not None:
+            return
+        queries = connection.queries[self.start:]
+        if len(queries) > self.budget:
+            self.test_case.fail("%s queries run, over the budget of %s:\n%s" %
+                                (len(queries), self.budget,
+                                 '\n'.join(query['sql'] for query in queries)))
+
+
+class TestQueryBudgets(CommentTestCase):
+    """
+    The most queries the busiest pages may run, with nothing cached.
+    
+    Each budget is what the page needs today, and none of them grows with
+    the number of posts or comments; if one of these fails, something has
+    probably started querying per post or per comment.
+    """
+    
+    def assertQueryBudget(self, budget):
+        return QueryBudget(self, budget)
+    
+    def clear_caches(self):
+        """
+        Empty the page cache and johnny's query cache, which within a test's
+        transaction keeps results in its local store rather than the cache.
+        """
+        cache.clear()
+        johnny_local.clear('%s_*' % johnny_settings.MIDDLEWARE_KEY_PREFIX)
+    
+    def setUp(self):
+        super(TestQueryBudgets, self).setUp()
+        for i in range(30):
+            Post.objects.create(title='Post %s' % i, content='Monkeys', owner=self.author)
+        parent = None
+        for i in range(100):
+            parent = Comment.objects.create(user_name='Anonymous', post=self.post,
+                                            content='Comment at depth %s.' % i, parent=parent)
+        self.deepest_comment = parent
+        for i in range(30):
+            top_comment = Comment.objects.create(user=self.commenter, post=self.post,
+                                                 content='Thread %s.' % i)
+            for j in range(3):
+                Comment.objects.create(user_name='Anonymous', post=self.post,
+                                       content='Reply %s.' % j, parent=top_comment)
+        #start every request with nothing in the page or query caches
+        self.clear_caches()
+    
+    def test_post_list(self):
+        """
+        A page of the list of posts.
+        """
+        with self.assertQueryBudget(1):
+            res = self.client.get(reverse('post-list'))
+        self.assertEqual(res.status_code, 200)
+    
+    def test_post_detail(self):
+        """
+        A post's page, with its first page of threads.
+        """
+        with self.assertQueryBudget(5):
+            res = self.client.get(self.post.get_absolute_url())
+        self.assertContains(res, 'Comment at depth 50.')
+        self.assertNotContains(res, 'Comment at depth 51.')
+    
+    def test_post_detail_logged_in(self):
+        """
+        A post's page for a logged-in user, which isn't cached whole.
+        """
+        self.login()
+        self.clear_caches()
+        with self.assertQueryBudget(6):
+            res = self.client.get(self.post.get_absolute_url())
+        self.assertContains(res, 'Comment at depth 50.')
+    
+    def test_post_detail_whole_thread(self):
+        """
+        A post's page showing one thread, however deep.
+        """
+        with self.assertQueryBudget(5):
+            res = self.client.get(self.post.get_absolute_url(),
+                                  {'thread': self.deepest_comment.root_id})
+        self.assertContains(res, 'Comment at depth 99.')
+    
+    def test_post_comment(self):
+        """
+        Posting a comment.
+        """
+        with self.assertQueryBudget(3):
+            res = self.client.post(self.comment_form_url,
+                                   {'user_name': 'Anonymous', 'content': 'Another comment.'})
+        self.assertEqual(res.status_code, 302)
+    
+    def test_post_reply(self):
+        """
+        Posting a reply to the deepest comment in a thread.
+        """
+        reply_url = self.deepest_comment.get_reply_url()
+        self.clear_caches()
+        with self.assertQueryBudget(5):
+            res = self.client.post(reply_url, {'user_name': 'Anonymous', 'content': 'Deeper.'})
+        self.assertEqual(res.status_code, 302)
+    
+    def test_registration(self):
+        """
+        Registering an account, which queues its activation email.
+        """
+        with self.assertQueryBudget(7):
+            res = self.client.post(reverse('registration_register'),
+                                   {'username': 'newcomer', 'email': 'newcomer@example.com',
+                                    'password1': 'secret', 'password2': 'secret'})
+        self.assertEqual(res.status_code, 302)
+        
+        activation_key = RegistrationProfile.objects.get(user__username='newcomer').activation_key
+        self.clear_caches()
+        with self.assertQueryBudget(3):
+            res = self.client.get(reverse('registration_activate',
+                                          kwargs={'activation_key': activation_key}))
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(User.objects.get(username='newcomer').is_active)
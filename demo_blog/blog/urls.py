@@ -1,7 +1,7 @@
 from django.conf.urls import patterns, url
 
 from .views import ViewPost, ListPosts, CreatePost, DeletePost, EditPost
-from .views import post_comment
+from .views import post_comment, poll_comments, comment_events
 
 urlpatterns = patterns('',
     url(r'^$', ListPosts.as_view(), name='post-list'),
@@ -11,4 +11,6 @@ urlpatterns = patterns('',
     url(r'^(?P<slug>[-_\w]+)/delete/$', DeletePost.as_view(), name='post-delete'),
     url(r'^(?P<post_slug>[-_\w]+)/comment/$', post_comment, name='comment-create'),
     url(r'^(?P<post_slug>[-_\w]+)/comment_reply/(?P<parent_id>\d+)/$', post_comment, name='reply-create'),
+    url(r'^(?P<post_slug>[-_\w]+)/comments/new/$', poll_comments, name='comment-poll'),
+    url(r'^(?P<post_slug>[-_\w]+)/comments/events/$', comment_events, name='comment-events'),
 )
@@ -1,19 +1,52 @@
+import datetime
+import hashlib
+import json
+import time
+
 from django.views.generic import ListView, DetailView, DeleteView, CreateView, UpdateView, View
 from django.views.generic.edit import ModelFormMixin
 from django.views.generic.detail import SingleObjectMixin
 from django.views.decorators.csrf import csrf_protect
+from django.views.decorators.http import condition
 
-from django.http import HttpResponseForbidden, HttpResponseRedirect
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseRedirect, HttpResponseBadRequest, Http404
 from django.core.exceptions import PermissionDenied
 from django.core.urlresolvers import reverse_lazy
+from django.db.models import Q
 
 from django.shortcuts import render_to_response, get_object_or_404
-from django.template import RequestContext
+from django.template import Context, RequestContext
+from django.template.loader import render_to_string
+from django.middleware.csrf import get_token
 from django.contrib.admin.views.decorators import staff_member_required
 from django.utils.decorators import method_decorator
+from django.utils.safestring import mark_safe
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import utc, is_naive, make_aware
 
 from .forms import PostForm, CommentForm
 from .models import Post, Comment
+from . import cache
+from .broker import comment_data, get_broker, post_channel
+from .templatetags.comment_tree import comment_tree
+
+#timestamps in ListPosts' paging cursors are UTC, down to the microsecond
+CURSOR_TIME_FORMAT = '%Y%m%d%H%M%S%f'
+
+#stands in for the visitor's CSRF token in cached pages; see CachedPageMixin.
+#Anything from a post or its title is escaped, so can't contain the '<'.
+CSRF_TOKEN_PLACEHOLDER = '<!--csrf token-->'
+
+#marks where the comments go in a streamed post page; see ViewPost.get_streaming_response.
+#Anything from a post or its title is escaped, so can't contain the '<'.
+STREAMED_COMMENTS_MARKER = '<!--streamed comments-->'
+
+#most comments sent in answer to one poll; see poll_comments
+POLL_MAX_COMMENTS = 100
+
+#most comments an event stream sends from before it was opened; see comment_events
+EVENTS_MAX_MISSED_COMMENTS = 100
 
 class AJAXPostFormMixin(object):
     """
@@ -89,7 +122,20 @@ class EditPost(AJAXPostFormMixin, PostMixin, UpdateView):
     pass
 
 class DeletePost(PostMixin, DeleteView):
-   
+    """
+    Deleting a post deletes its comments too, which for a post with many
+    of them can take a while.  With BLOG_DEFER_POST_DELETION on, the post
+    is only hidden (see Post.tombstone()), and the purge_deleted_posts
+    command deletes it later.
+    """
+    
+    def delete(self, request, *args, **kwargs):
+        if not getattr(settings, 'BLOG_DEFER_POST_DELETION', False):
+            return super(DeletePost, self).delete(request, *args, **kwargs)
+        self.object = self.get_object()
+        self.object.tombstone()
+        return HttpResponseRedirect(self.get_success_url())
+    
     def get_success_url(self):
         """
         PostMixin's get_success_url doesn't make sense if the post's been deleted.
@@ -99,30 +145,297 @@ class DeletePost(PostMixin, DeleteView):
         return reverse_lazy('post-list')
     
 
-class ListPosts(ListView):
+def lookup_post_id(slug):
+    """
+    The pk of the post with this slug, from the cache if possible, or None
+    if there's no such post.
+    """
+    post_id = cache.get_post_id(slug)
+    if post_id is None:
+        post_ids = Post.objects.filter(slug=slug).values_list('pk', flat=True)
+        if not post_ids:
+            return None
+        post_id = post_ids[0]
+        cache.set_post_id(slug, post_id)
+    return post_id
+
+
+class CachedPageMixin(object):
+    """
+    Serve GET requests from anonymous users from a cache of the whole
+    rendered page, without touching the database or the templates.
+    
+    Logged-in users see edit/delete links, their name, etc. so their pages
+    aren't cached whole.  The only per-visitor part of an anonymous page is
+    the CSRF token in any forms on it, so the page is rendered with a
+    placeholder for the token, and the visitor's own token is put in
+    when it's served.
+    
+    Subclasses define get_cache_version(), the name of the cache version
+    (see blog.cache) that's bumped when anything on the page changes, or
+    None if the page shouldn't be cached.  Pages are cached by path and
+    whatever get_cache_vary() adds, rather than by the whole query string,
+    so that junk added to it doesn't fill the cache with copies of a page.
+    """
+    def get(self, request, *args, **kwargs):
+        if request.user.is_authenticated():
+            return super(CachedPageMixin, self).get(request, *args, **kwargs)
+        
+        version = self.get_cache_version()
+        if version is None:
+            return super(CachedPageMixin, self).get(request, *args, **kwargs)
+        
+        path = '%s?%s' % (request.path, self.get_cache_vary())
+        content = cache.get_content('page', version, path)
+        if content is not None:
+            return HttpResponse(content.replace(CSRF_TOKEN_PLACEHOLDER, get_token(request)))
+        
+        response = super(CachedPageMixin, self).get(request, *args, **kwargs)
+        #the csrf context processor and {% csrf_token %} read the token from here
+        token = get_token(request)
+        request.META['CSRF_COOKIE'] = CSRF_TOKEN_PLACEHOLDER
+        try:
+            response.render()
+        finally:
+            request.META['CSRF_COOKIE'] = token
+        if response.status_code == 200:
+            cache.set_content('page', version, path, response.content)
+        response.content = response.content.replace(CSRF_TOKEN_PLACEHOLDER, token)
+        return response
+    
+    def get_cache_vary(self):
+        """
+        What, besides the path, tells apart the pages this view shows: the
+        query string parameters it uses, as it understands them.
+        """
+        return ''
+
+
+class ListPosts(CachedPageMixin, ListView):
     """
-    View a list of posts.
+    View a list of posts, newest first, a page at a time.
+    
+    Pages are keyed on the (created, id) of the last post on the previous
+    page, passed as the before query string parameter, rather than on a
+    page number; a page is then an index range scan however far back it is.
     """
     model = Post
+    posts_per_page = 20
+    
+    def get_queryset(self):
+        """
+        Posts older than the before cursor, with their owners but without
+        their content, which the list doesn't show.
+        
+        One more post than fits on the page is loaded to tell whether
+        there's another page.
+        """
+        posts = Post.objects.select_related('owner').defer('content').order_by('-created', '-pk')
+        cursor = self.get_cursor()
+        if cursor is not None:
+            created, pk = cursor
+            posts = posts.filter(Q(created__lt=created) | Q(created=created, pk__lt=pk))
+        return posts[:self.posts_per_page + 1]
+    
+    def get_cursor(self):
+        """
+        Decode the before query string parameter into a (created, id)
+        pair, or None if it's missing or garbled.
+        """
+        try:
+            created, pk = self.request.GET['before'].split('-')
+            created = datetime.datetime.strptime(created, CURSOR_TIME_FORMAT)
+            return created.replace(tzinfo=utc), int(pk)
+        except (KeyError, ValueError):
+            return None
+    
+    def get_context_data(self, **kwargs):
+        """
+        Trim the extra post off the page and add next_posts_url, the link
+        to the next page, if there is one.
+        """
+        posts = list(self.object_list)
+        next_posts_url = None
+        if len(posts) > self.posts_per_page:
+            posts = posts[:self.posts_per_page]
+            last = posts[-1]
+            cursor = '%s-%s' % (last.created.astimezone(utc).strftime(CURSOR_TIME_FORMAT), last.pk)
+            next_posts_url = '%s?before=%s' % (reverse_lazy('post-list'), cursor)
+        
+        kwargs['object_list'] = posts
+        context = super(ListPosts, self).get_context_data(**kwargs)
+        context['next_posts_url'] = next_posts_url
+        return context
+    
+    def get_cache_version(self):
+        return cache.POST_LIST_VERSION
+    
+    def get_cache_vary(self):
+        return '%s-%s' % (self.get_cursor() or ('', ''))
     
 
-class ViewPost(DetailView):
+class ViewPost(CachedPageMixin, DetailView):
     """
     View a specific post, aka the post detail page.
+    
+    Comments are shown a page of threads at a time, and long threads
+    are cut off after a number of replies.  Query string parameters:
+    
+    - after: show the threads after the top-level comment with this id.
+    - comment_id: show the page of threads starting with the thread this
+      comment is in, making sure the comment itself is shown.
+    - thread: show just the thread starting with this top-level comment,
+      with all of its replies.
+    - stream: show every comment, sending the page as it's rendered
+      (see get_streaming_response).
     """
     model = Post
+    threads_per_page = 20
+    replies_per_thread = 50
+    threads_per_stream_chunk = 50
+    streaming = False
+    
+    def get(self, request, *args, **kwargs):
+        if request.GET.get('stream'):
+            return self.get_streaming_response()
+        return super(ViewPost, self).get(request, *args, **kwargs)
 
     def get_context_data(self, *args, **kwargs):
         """
-        Add the post's top-level comments and the comment form to the context.
+        Add a page of the post's comment threads, links to other pages
+        and the comment form to the context.
+        
+        Each thread's replies are loaded up front along with the threads,
+        so the recursive comment template doesn't query for each comment's replies.
         
-        Nested comments will be loaded recursively.
+        The rendered comments are the same for everyone, so they're cached
+        separately from the rest of the page; logged-in users (whose pages
+        aren't cached whole) get them from there.
         """
         context = super(ViewPost, self).get_context_data(*args, **kwargs)
-        context['comments'] = Comment.get_top_comments_for_post(post=self.object)
+        if self.streaming:
+            context['comments_html'] = mark_safe(STREAMED_COMMENTS_MARKER)
+        else:
+            context['comments_html'] = self.get_comments_html()
         context['comment_form'] = CommentForm(post=self.object,
                                               user=self.request.user)
         return context
+    
+    def get_cache_version(self):
+        """
+        Cached pages are filed under the post's id, which is looked up from
+        the slug in the cache where possible.  If there's no post with this
+        slug, the (404) page isn't cached.
+        """
+        post_id = lookup_post_id(self.kwargs['slug'])
+        if post_id is None:
+            return None
+        return cache.post_version(post_id)
+    
+    def get_cache_vary(self):
+        return '%s:%s:%s' % (self.get_int_param('after'), self.get_int_param('thread'),
+                             self.get_int_param('comment_id'))
+    
+    def get_comments_html(self):
+        """
+        Render the page of comment threads requested in the query string,
+        or get it from the cache.
+        """
+        version = cache.post_version(self.object.pk)
+        vary = self.get_cache_vary()
+        html = cache.get_content('comments', version, vary)
+        if html is None:
+            html = render_to_string('blog/comment_threads.html', self.get_comment_threads())
+            cache.set_content('comments', version, vary, html)
+        return mark_safe(html)
+    
+    def get_streaming_response(self):
+        """
+        Send the whole page with every comment on the post, without holding
+        all the threads (or the page) in memory at once.
+        
+        The page is rendered with a marker where the comments go.  Everything
+        before the marker (the header and the post itself) is sent straight
+        away, then the comments are loaded, rendered and sent a chunk of
+        threads at a time, then the rest of the page.  The comments aren't
+        loaded until the response is being sent, so time to first byte
+        doesn't depend on how many there are.
+        
+        Each thread in a chunk is loaded whole, so memory is bounded by the
+        biggest threads_per_stream_chunk threads rather than by a number of
+        comments: a single thread with a huge number of replies is held all
+        at once.
+        """
+        self.streaming = True
+        self.object = self.get_object()
+        response = self.render_to_response(self.get_context_data(object=self.object))
+        head, tail = response.rendered_content.rsplit(STREAMED_COMMENTS_MARKER, 1)
+        return HttpResponse(self.stream_page(head, tail))
+    
+    def stream_page(self, head, tail):
+        yield head
+        yield '<ul>\n'
+        after = None
+        while True:
+            comments, after = Comment.get_thread_page(self.object, after=after,
+                                                      threads=self.threads_per_stream_chunk,
+                                                      replies_per_thread=None)
+            yield comment_tree(Context(), comments)
+            if after is None:
+                break
+        yield '</ul>\n'
+        yield tail
+    
+    def get_int_param(self, name):
+        """
+        Get a positive integer from the query string, or None if it's
+        missing or not a number.
+        """
+        value = self.request.GET.get(name, '')
+        if value.isdigit():
+            return int(value)
+        return None
+
+    def get_comment_threads(self):
+        """
+        Load the page of comment threads requested in the query string.
+        
+        Returns a dictionary of context variables:
+        comments, the top-level comments with their replies attached;
+        next_comments_url, a link to the next page of threads, if any;
+        first_comments_url, a link back to the first page, if this isn't it.
+        """
+        post = self.object
+        after = self.get_int_param('after')
+        thread = self.get_int_param('thread')
+        comment_id = self.get_int_param('comment_id')
+        
+        if thread is not None:
+            comments, next_after = Comment.get_thread_page(post, first=thread, threads=1,
+                                                           replies_per_thread=None)
+            #only a top-level comment starts a thread
+            comments = [comment for comment in comments if comment.pk == thread]
+            next_after = None
+        elif comment_id is not None:
+            root_id = Comment.get_thread_root_id(post, comment_id)
+            comments, next_after = Comment.get_thread_page(post, first=root_id,
+                                                           threads=self.threads_per_page,
+                                                           replies_per_thread=self.replies_per_thread,
+                                                           reveal=comment_id)
+        else:
+            comments, next_after = Comment.get_thread_page(post, after=after,
+                                                           threads=self.threads_per_page,
+                                                           replies_per_thread=self.replies_per_thread)
+        
+        post_url = post.get_absolute_url()
+        context = {'comments': comments,
+                   'next_comments_url': None,
+                   'first_comments_url': None}
+        if next_after is not None:
+            context['next_comments_url'] = '%s?after=%s#comments' % (post_url, next_after)
+        if after is not None or thread is not None or comment_id is not None:
+            context['first_comments_url'] = '%s#comments' % post_url
+        return context
 
 
 @csrf_protect
@@ -133,13 +446,26 @@ def post_comment(request, post_slug, parent_id=None):
     CBVs not used due to time constraints.
     
     Some parts modeled after django.contrib.comments.
+    
+    AJAX requests get fragments instead of pages.  A GET, or a POST with
+    errors (with status 400), gets the comment form; a successful POST gets
+    JSON with the new comment's id, its parent's id and its markup, rendered
+    from blog/comment_inline.html, for the page to insert itself instead of
+    reloading the post:
+    
+        {"id": 12, "parent_id": 3, "html": "<div id='comment_12'>..."}
     """
 
-    post = get_object_or_404(Post, slug=post_slug)
+    #the post's slug is all that commenting needs of it, for reply links
+    post = get_object_or_404(Post.objects.only('id', 'slug'), slug=post_slug)
     
-    #if this is a reply, get the comment we're replying to
+    #if this is a reply, get the comment we're replying to, which must be on
+    #the same post and not removed.  Saving a reply only needs the parent's
+    #thread_path; the rest is loaded only if the parent's shown (see below).
     if parent_id is not None:
-        parent_comment = Comment.objects.get(pk=parent_id)
+        parent_comment = get_object_or_404(Comment.objects.only('id', 'post', 'thread_path'),
+                                           pk=parent_id, post=post, is_removed=False)
+        parent_comment._post_cache = post
     else:
         parent_comment = None
 
@@ -161,6 +487,9 @@ def post_comment(request, post_slug, parent_id=None):
             #now save
             comment.save()
 
+            if request.is_ajax():
+                return comment_json_response(comment)
+
             #build the URL to redirect to
             anchor = comment.pk
             
@@ -171,6 +500,11 @@ def post_comment(request, post_slug, parent_id=None):
             url = post.get_absolute_url() + '?comment_id=%s#comment_%s' % (anchor, anchor)
             return HttpResponseRedirect(url)
 
+    if parent_comment:
+        #the form shows the comment being replied to
+        parent_comment = Comment.objects.get(pk=parent_comment.pk)
+        parent_comment._post_cache = post
+    
     #for ajax requests, return just the HTML fragment for the comment form.
     if request.is_ajax():
         template_name = 'blog/comment_form.html'
@@ -178,8 +512,153 @@ def post_comment(request, post_slug, parent_id=None):
         template_name = 'blog/comment_form_page.html'
     #we're here either due to a GET or the form had errors.
     #in either case, display the form
-    return render_to_response(template_name,
-                                {'form':form,
-                                 'post':post,
-                                 'parent_comment': parent_comment},
+    response = render_to_response(template_name,
+                                  {'form':form,
+                                   'post':post,
+                                   'parent_comment': parent_comment},
                                   context)
+    if request.is_ajax() and request.method == 'POST':
+        response.status_code = 400
+    return response
+
+
+def comment_json_response(comment):
+    """
+    The JSON answer to an AJAX comment: the new comment's comment_data().
+    """
+    return HttpResponse(json.dumps(comment_data(comment)), content_type='application/json')
+
+
+def comment_poll_etag(request, post_slug):
+    #the post's cache version changes whenever a comment on it does, and
+    #polls for comments after different points get different answers
+    post_id = lookup_post_id(post_slug)
+    if post_id is None:
+        return None
+    vary = u'%s:%s' % (request.GET.get('after', ''), request.GET.get('since', ''))
+    return '%s-%s' % (cache.get_version(cache.post_version(post_id)),
+                      hashlib.md5(vary.encode('utf-8')).hexdigest())
+
+
+@condition(etag_func=comment_poll_etag)
+def poll_comments(request, post_slug):
+    """
+    New comments on a post, for its page to add without reloading.
+    
+    Query string parameters (one of them is needed):
+    
+    - after: comments with a greater id than this.
+    - since: comments posted after this date and time (e.g.
+      2013-01-30T17:05:00Z; UTC unless it says otherwise).
+    
+    Answers with JSON: the comment_data() of each comment, oldest first and
+    at most POLL_MAX_COMMENTS of them, whether there are more, and the id to
+    ask for comments after next time (unchanged if there were none):
+    
+        {"comments": [{"id": 12, "parent_id": 3, "html": "..."}, ...],
+         "more": false, "last_id": 12}
+    
+    The response has an ETag, so polling with If-None-Match is answered
+    with a 304 and no database queries until something changes.
+    """
+    post = get_object_or_404(Post.objects.only('id', 'slug'), slug=post_slug)
+    comments = Comment.objects.filter(post=post)
+    after = request.GET.get('after', '')
+    since = request.GET.get('since', '')
+    last_id = None
+    if after.isdigit():
+        last_id = int(after)
+        comments = comments.filter(pk__gt=last_id).order_by('pk')
+    elif since:
+        try:
+            since = parse_datetime(since)
+        except ValueError:
+            #well formed, but not a real date, e.g. February 30th
+            since = None
+        if since is None:
+            return HttpResponseBadRequest("since isn't a date and time.")
+        if is_naive(since):
+            since = make_aware(since, utc)
+        comments = comments.filter(created__gt=since).order_by('created', 'pk')
+    else:
+        return HttpResponseBadRequest("Give after or since.")
+    
+    comments = list(comments[:POLL_MAX_COMMENTS + 1])
+    more = len(comments) > POLL_MAX_COMMENTS
+    comments = comments[:POLL_MAX_COMMENTS]
+    for comment in comments:
+        comment._post_cache = post
+        last_id = max(last_id, comment.pk)
+    return HttpResponse(json.dumps({'comments': [comment_data(comment) for comment in comments],
+                                    'more': more,
+                                    'last_id': last_id}),
+                        content_type='application/json')
+
+
+def comment_events(request, post_slug):
+    """
+    A stream of server-sent events, one for each new comment on a post as
+    it's posted, for browsers to follow with EventSource.  Each event's data
+    is the comment's comment_data() as JSON, and its id is the comment's.
+    
+    When a browser reconnects it sends the id of the last event it got, and
+    comments posted since then are sent first (up to
+    EVENTS_MAX_MISSED_COMMENTS of them); ?after=<comment id> does the same
+    for the first connection.
+    
+    Comments reach the stream through the broker (see broker.py).  The
+    stream sends a comment line every BLOG_EVENTS_KEEPALIVE seconds while
+    it's quiet, so that proxies don't drop it, and ends after
+    BLOG_EVENTS_MAX_TIME seconds, so that it doesn't hold a server thread
+    forever; browsers then reconnect and carry on.
+    """
+    broker = get_broker()
+    if broker is None:
+        raise Http404
+    post_id = lookup_post_id(post_slug)
+    if post_id is None:
+        raise Http404
+    last_id = request.META.get('HTTP_LAST_EVENT_ID') or request.GET.get('after', '')
+    last_id = int(last_id) if last_id.isdigit() else None
+    
+    response = HttpResponse(stream_comment_events(broker, post_id, last_id),
+                            content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+def comment_event(data):
+    return 'id: %s\ndata: %s\n\n' % (data['id'], json.dumps(data))
+
+
+def stream_comment_events(broker, post_id, last_id):
+    keepalive = getattr(settings, 'BLOG_EVENTS_KEEPALIVE', 15)
+    end = time.time() + getattr(settings, 'BLOG_EVENTS_MAX_TIME', 300)
+    #subscribed before looking for missed comments, so none fall in between
+    subscription = broker.subscribe(post_channel(post_id))
+    try:
+        #browsers wait this long (in ms) before reconnecting
+        yield 'retry: 1000\n\n'
+        if last_id is not None:
+            missed = Comment.objects.filter(post=post_id, pk__gt=last_id) \
+                                    .select_related('post').order_by('pk')
+            for comment in missed[:EVENTS_MAX_MISSED_COMMENTS]:
+                last_id = comment.pk
+                yield comment_event(comment_data(comment))
+        
+        while time.time() < end:
+            message = subscription.get(timeout=min(keepalive, max(end - time.time(), 0)))
+            if message is None:
+                yield ': keepalive\n\n'
+                continue
+            data = json.loads(message)
+            if last_id is not None and data['id'] <= last_id:
+                continue
+            if 'html' not in data:
+                #too long to publish whole; see broker.publish_comment
+                comment = Comment.objects.select_related('post').get(pk=data['id'])
+                data = comment_data(comment)
+            last_id = data['id']
+            yield comment_event(data)
+    finally:
+        subscription.close()
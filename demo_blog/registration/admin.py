@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import RegistrationProfile
+from .models import RegistrationProfile, QueuedEmail
 
 
 class RegistrationAdmin(admin.ModelAdmin):
@@ -9,3 +9,12 @@ class RegistrationAdmin(admin.ModelAdmin):
 
 
 admin.site.register(RegistrationProfile, RegistrationAdmin)
+
+
+class QueuedEmailAdmin(admin.ModelAdmin):
+    list_display = ('__unicode__', 'created', 'sent', 'attempts', 'last_error')
+    list_filter = ('sent',)
+    search_fields = ('recipients', 'subject')
+
+
+admin.site.register(QueuedEmail, QueuedEmailAdmin)
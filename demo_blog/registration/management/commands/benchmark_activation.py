@@ -0,0 +1,98 @@
+"""
+A management command which times ``RegistrationManager.activate_user()``
+as the registration profile table grows, to check that activation
+costs the same however many accounts are waiting to be activated.
+
+It runs against a throwaway test database, so it's safe to run
+anywhere; for example::
+
+    manage.py benchmark_activation --sizes=1000,10000,100000 --activations=200
+
+"""
+
+import random
+import sha
+import time
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+from django.utils import timezone
+
+from ...models import RegistrationProfile
+
+
+#rows per INSERT, kept under sqlite's limit on query parameters
+INSERT_BATCH_SIZE = 50
+
+
+def add_profiles(count, start):
+    """
+    Add count inactive users, numbered from start, each with a
+    registration profile, returning their activation keys.
+    """
+    now = timezone.now()
+    keys = []
+    for batch_start in range(start, start + count, INSERT_BATCH_SIZE):
+        numbers = range(batch_start, min(batch_start + INSERT_BATCH_SIZE, start + count))
+        usernames = ['benchmark%s' % i for i in numbers]
+        User.objects.bulk_create([User(username=username, email='%s@example.com' % username,
+                                       password='!', is_active=False,
+                                       date_joined=now, last_login=now)
+                                  for username in usernames])
+        profiles = []
+        for user_id in User.objects.filter(username__in=usernames).values_list('id', flat=True):
+            key = sha.new(str(random.random()) + str(user_id)).hexdigest()
+            profiles.append(RegistrationProfile(user_id=user_id, activation_key=key))
+            keys.append(key)
+        RegistrationProfile.objects.bulk_create(profiles)
+    return keys
+
+
+def time_activations(keys):
+    """
+    Activate each key, returning the time each took in seconds and
+    the number of queries run.
+    """
+    times = []
+    queries_before = len(connection.queries)
+    for key in keys:
+        start = time.time()
+        if not RegistrationProfile.objects.activate_user(key):
+            raise ValueError("Activation key %s didn't activate" % key)
+        times.append(time.time() - start)
+    return times, len(connection.queries) - queries_before
+
+
+class Command(NoArgsCommand):
+    help = "Time account activation against growing numbers of registration profiles"
+    option_list = NoArgsCommand.option_list + (
+        make_option('--sizes', dest='sizes', default='1000,10000,50000',
+                    help='Comma-separated numbers of profiles to time activation at.'),
+        make_option('--activations', type='int', dest='activations', default=100,
+                    help='Activations to time at each size.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        sizes = sorted(int(size) for size in options['sizes'].split(','))
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=verbosity)
+        connection.use_debug_cursor = True
+        try:
+            keys = []
+            for size in sizes:
+                created = RegistrationProfile.objects.count()
+                if size > created:
+                    keys.extend(add_profiles(size - created, created))
+                sample = random.sample(keys, min(options['activations'], len(keys)))
+                times, queries = time_activations(sample)
+                keys = list(set(keys) - set(sample))
+                times.sort()
+                self.stdout.write("%8s profiles: median %.2f ms, max %.2f ms, %.1f queries per activation\n" %
+                                  (size, times[len(times) // 2] * 1000, times[-1] * 1000,
+                                   float(queries) / len(times)))
+        finally:
+            connection.use_debug_cursor = None
+            connection.creation.destroy_test_db(old_name, verbosity=verbosity)
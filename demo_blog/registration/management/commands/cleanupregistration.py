@@ -5,8 +5,14 @@ accounts which signed up but never activated) from the database.
 Calls ``RegistrationProfile.objects.delete_expired_users()``, which
 contains the actual logic for determining which accounts are deleted.
 
+Accounts are deleted in batches (``--batch-size``), each in its own
+transaction, so this can be run while the site is up. Use
+``--dry-run`` to see how many accounts would be deleted.
+
 """
 
+from optparse import make_option
+
 from django.core.management.base import NoArgsCommand
 
 from ...models import RegistrationProfile
@@ -14,6 +20,25 @@ from ...models import RegistrationProfile
 
 class Command(NoArgsCommand):
     help = "Delete expired user registrations from the database"
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+                    help='Delete this many accounts per transaction.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help="Count the accounts which would be deleted, but don't delete them."),
+    )
 
     def handle_noargs(self, **options):
-        RegistrationProfile.objects.delete_expired_users()
+        verbosity = int(options.get('verbosity', 1))
+        
+        def progress(deleted):
+            if verbosity >= 2:
+                self.stdout.write("Deleted %s expired accounts so far.\n" % deleted)
+        
+        count = RegistrationProfile.objects.delete_expired_users(batch_size=options['batch_size'],
+                                                                 dry_run=options['dry_run'],
+                                                                 progress=progress)
+        if verbosity >= 1:
+            if options['dry_run']:
+                self.stdout.write("%s expired accounts would be deleted.\n" % count)
+            else:
+                self.stdout.write("Deleted %s expired accounts.\n" % count)
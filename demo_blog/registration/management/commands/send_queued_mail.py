@@ -0,0 +1,44 @@
+"""
+A management command which sends emails waiting in the outbox (see
+``registration.models.QueuedEmail``), such as activation emails queued
+when ``REGISTRATION_QUEUE_EMAIL`` is ``True``.
+
+Run it regularly, e.g. from cron, or leave it running with ``--loop``.
+Only run one at a time.
+
+"""
+
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from ...models import QueuedEmail
+
+
+class Command(NoArgsCommand):
+    help = "Send queued emails over a single connection to the mail server"
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=100,
+                    help='Send at most this many emails per connection.'),
+        make_option('--max-attempts', type='int', dest='max_attempts', default=5,
+                    help='Give up on an email after it has failed this many times.'),
+        make_option('--loop', action='store_true', dest='loop', default=False,
+                    help='Keep running, checking for new email every --interval seconds.'),
+        make_option('--interval', type='float', dest='interval', default=5,
+                    help='Seconds to wait between checks for new email with --loop.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        while True:
+            sent, failed = QueuedEmail.objects.send_queued(batch_size=options['batch_size'],
+                                                           max_attempts=options['max_attempts'])
+            if verbosity >= 1 and (sent or failed):
+                self.stdout.write("Sent %s emails, %s failed.\n" % (sent, failed))
+            #a full batch probably means there's more waiting; otherwise
+            #we're done, or sleep until more email might have arrived.
+            if sent + failed < options['batch_size']:
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
@@ -4,13 +4,16 @@ import re
 import sha
 
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
 from django.template.loader import render_to_string
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
+from django.utils import timezone
 from django.utils.timezone import utc
 
+from ..transactions import commit_on_success_unless_managed
+
 
 SHA1_RE = re.compile('^[a-f0-9]{40}$')
 
@@ -42,21 +45,30 @@ class RegistrationManager(models.Manager):
         reset to the string ``ALREADY_ACTIVATED`` after successful
         activation.
         
+        The profile and its ``User`` are looked up together by the
+        (indexed) key, and both are updated in one transaction; the
+        profile's update only applies if the key is still unused, so
+        the same key can't activate twice even if it's tried twice at
+        once.  If the caller is managing a transaction, they're updated
+        in that one, for the caller to commit.
+        
         """
         # Make sure the key we're trying conforms to the pattern of a
         # SHA1 hash; if it doesn't, no point trying to look it up in
         # the database.
         if SHA1_RE.search(activation_key):
             try:
-                profile = self.get(activation_key=activation_key)
+                profile = self.select_related('user').get(activation_key=activation_key)
             except self.model.DoesNotExist:
                 return False
             if not profile.activation_key_expired():
                 user = profile.user
+                with commit_on_success_unless_managed():
+                    if not self.filter(pk=profile.pk, activation_key=activation_key) \
+                               .update(activation_key=self.model.ACTIVATED):
+                        return False
+                    User.objects.filter(pk=user.pk).update(is_active=True)
                 user.is_active = True
-                user.save()
-                profile.activation_key = self.model.ACTIVATED
-                profile.save()
                 return user
         return False
     
@@ -101,6 +113,11 @@ class RegistrationManager(models.Manager):
         ``user``
             The ``User`` to relate the profile to.
         
+        If the setting ``REGISTRATION_QUEUE_EMAIL`` is ``True``, the
+        email is not sent here but added to the ``QueuedEmail``
+        outbox, to be sent later by ``manage.py send_queued_mail``; the
+        new user doesn't have to wait for the mail server.
+        
         """
         new_user = User.objects.create_user(username, email, password)
         new_user.is_active = False
@@ -125,7 +142,10 @@ class RegistrationManager(models.Manager):
                                          'expiration_days': settings.ACCOUNT_ACTIVATION_DAYS,
                                          'site': current_site })
             
-            send_mail(subject, message, settings.DEFAULT_FROM_EMAIL, [new_user.email])
+            if getattr(settings, 'REGISTRATION_QUEUE_EMAIL', False):
+                QueuedEmail.objects.queue(subject, message, settings.DEFAULT_FROM_EMAIL, [new_user.email])
+            else:
+                send_mail(subject, message, settings.DEFAULT_FROM_EMAIL, [new_user.email])
         return new_user
     
     def create_profile(self, user):
@@ -143,10 +163,26 @@ class RegistrationManager(models.Manager):
         return self.create(user=user,
                            activation_key=activation_key)
         
-    def delete_expired_users(self):
+    def expired(self):
+        """
+        Instances of ``RegistrationProfile`` with expired activation
+        keys (see ``RegistrationProfile.activation_key_expired()``)
+        whose associated ``User``s are inactive.
+        
+        This is the same test as ``activation_key_expired()``, done by
+        the database instead of one profile at a time.
+        
+        """
+        expiration_date = datetime.timedelta(days=settings.ACCOUNT_ACTIVATION_DAYS)
+        return self.filter(models.Q(activation_key=self.model.ACTIVATED) |
+                           models.Q(user__date_joined__lte=timezone.now() - expiration_date),
+                           user__is_active=False)
+    
+    def delete_expired_users(self, batch_size=1000, dry_run=False, progress=None):
         """
         Remove expired instances of ``RegistrationProfile`` and their
-        associated ``User``s.
+        associated ``User``s, returning the number of ``User``s
+        deleted.
         
         Accounts to be deleted are identified by searching for
         instances of ``RegistrationProfile`` with expired activation
@@ -155,6 +191,17 @@ class RegistrationManager(models.Manager):
         ``User`` who is both inactive and has an expired activation
         key will be deleted.
         
+        The search is done by the database (see ``expired()``), and
+        the ``User``s are deleted ``batch_size`` at a time, each batch
+        in its own transaction, so that no locks are held for long and
+        the site can stay up while this runs.
+        
+        If ``dry_run`` is ``True``, nothing is deleted; the number of
+        ``User``s which would be deleted is returned.
+        
+        If ``progress`` is given, it's called after each batch with
+        the number of ``User``s deleted so far.
+        
         It is recommended that this method be executed regularly as
         part of your routine site maintenance; this application
         provides a custom management command which will call this
@@ -183,11 +230,37 @@ class RegistrationManager(models.Manager):
         be deleted.
         
         """
-        for profile in self.all():
-            if profile.activation_key_expired():
-                user = profile.user
-                if not user.is_active:
-                    user.delete()
+        expired = self.expired()
+        if dry_run:
+            return expired.count()
+        
+        deleted = 0
+        last_user_id = 0
+        while True:
+            # Walk through in order of user id, so each batch starts
+            # where the last one stopped even if some users in it
+            # couldn't be deleted.
+            user_ids = list(expired.filter(user__gt=last_user_id)
+                                   .order_by('user')
+                                   .values_list('user', flat=True)[:batch_size])
+            if not user_ids:
+                break
+            deleted += self._delete_users(user_ids)
+            last_user_id = user_ids[-1]
+            if progress is not None:
+                progress(deleted)
+        return deleted
+    
+    @transaction.commit_on_success
+    def _delete_users(self, user_ids):
+        # Any of them might have activated since they were found, so
+        # check again, locking the rows of those still expired until
+        # they're deleted.
+        user_ids = list(self.expired().select_for_update()
+                                      .filter(user__in=user_ids)
+                                      .values_list('user', flat=True))
+        User.objects.filter(pk__in=user_ids).delete()
+        return len(user_ids)
 
 
 class RegistrationProfile(models.Model):
@@ -212,7 +285,8 @@ class RegistrationProfile(models.Model):
     ACTIVATED = u"ALREADY_ACTIVATED"
     
     user = models.ForeignKey(User, unique=True, verbose_name=_('user'))
-    activation_key = models.CharField(_('activation key'), max_length=40)
+    #not unique: every activated profile shares ACTIVATED
+    activation_key = models.CharField(_('activation key'), max_length=40, db_index=True)
     
     objects = RegistrationManager()
     
@@ -253,3 +327,110 @@ class RegistrationProfile(models.Model):
                 (self.user.date_joined + expiration_date <= datetime.datetime.utcnow().replace(tzinfo=utc)))
     
     activation_key_expired.boolean = True
+
+
+class QueuedEmailManager(models.Manager):
+    """
+    Custom manager for the ``QueuedEmail`` model.
+    
+    """
+    def queue(self, subject, body, from_email, recipient_list):
+        """
+        Add an email to the outbox, returning the ``QueuedEmail``.
+        
+        """
+        return self.create(subject=subject, body=body, from_email=from_email,
+                           recipients='\n'.join(recipient_list))
+    
+    def due(self, max_attempts):
+        """
+        Emails which haven't been sent yet, haven't failed too many
+        times, and are due to be (re)tried, oldest first.
+        
+        """
+        return self.filter(sent__isnull=True, attempts__lt=max_attempts,
+                           next_attempt__lte=timezone.now()).order_by('pk')
+    
+    def send_queued(self, batch_size=100, max_attempts=5, connection=None):
+        """
+        Send up to ``batch_size`` due emails over a single connection to
+        the mail server, returning a tuple of the number sent and the
+        number which failed.
+        
+        An email which fails is retried by later calls, waiting twice
+        as long after each failure (starting from a minute), until it
+        has failed ``max_attempts`` times; after that it stays in the
+        outbox with its last error for someone to look at.
+        
+        ``connection`` is the email backend to send with; by default,
+        the one from the ``EMAIL_BACKEND`` setting.
+        
+        Each email is marked sent as soon as it's been sent, so if this
+        stops part way through a batch, the emails already sent aren't
+        sent again.  Only one process should send queued email at a
+        time, or an email may be sent twice.
+        
+        """
+        from django.core.mail import EmailMessage, get_connection
+        
+        batch = list(self.due(max_attempts)[:batch_size])
+        if not batch:
+            return 0, 0
+        
+        if connection is None:
+            connection = get_connection()
+        sent = failed = 0
+        connection.open()
+        try:
+            for email in batch:
+                message = EmailMessage(email.subject, email.body, email.from_email,
+                                       email.recipient_list, connection=connection)
+                try:
+                    message.send()
+                except Exception, e:
+                    failed += 1
+                    delay = datetime.timedelta(minutes=2 ** email.attempts)
+                    self.filter(pk=email.pk).update(attempts=models.F('attempts') + 1,
+                                                    last_error=unicode(e) or e.__class__.__name__,
+                                                    next_attempt=timezone.now() + delay)
+                else:
+                    sent += 1
+                    self.filter(pk=email.pk).update(sent=timezone.now(),
+                                                    attempts=models.F('attempts') + 1)
+        finally:
+            connection.close()
+        return sent, failed
+
+
+class QueuedEmail(models.Model):
+    """
+    An email waiting in the outbox to be sent by ``manage.py
+    send_queued_mail`` (see ``QueuedEmailManager.send_queued()``).
+    
+    Sent emails are kept, with the time they were sent, until they're
+    deleted by hand.
+    
+    """
+    subject = models.TextField(_('subject'))
+    body = models.TextField(_('body'))
+    from_email = models.CharField(_('from'), max_length=254)
+    recipients = models.TextField(_('recipients'), help_text=_('One address per line.'))
+    
+    created = models.DateTimeField(_('created'), auto_now_add=True)
+    next_attempt = models.DateTimeField(_('next attempt'), default=timezone.now, db_index=True)
+    attempts = models.PositiveIntegerField(_('attempts'), default=0)
+    last_error = models.TextField(_('last error'), blank=True)
+    sent = models.DateTimeField(_('sent'), null=True, blank=True)
+    
+    objects = QueuedEmailManager()
+    
+    class Meta:
+        verbose_name = _('queued email')
+        verbose_name_plural = _('queued emails')
+    
+    def __unicode__(self):
+        return u"%s to %s" % (self.subject, u", ".join(self.recipient_list))
+    
+    @property
+    def recipient_list(self):
+        return self.recipients.splitlines()
@@ -21,16 +21,20 @@ getting django-registration running in the default setup, to wit:
 
 import datetime
 import sha
+import smtplib
 
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core import mail
+from django.core.mail.backends import locmem
 from django.core import management
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+from django.utils.timezone import utc
 
 import forms
-from .models import RegistrationProfile
+from .models import RegistrationProfile, QueuedEmail
 
 
 class RegistrationTestCase(TestCase):
@@ -73,10 +77,15 @@ class RegistrationModelTests(RegistrationTestCase):
 
     def test_activation_email(self):
         """
-        Test that user signup sends an activation email.
+        Test that user signup sends an activation email, either
+        straight away or once the outbox has been sent.
         
         """
+        if getattr(settings, 'REGISTRATION_QUEUE_EMAIL', False):
+            self.assertEqual(len(mail.outbox), 0)
+            management.call_command('send_queued_mail', verbosity=0)
         self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(mail.outbox[0].to, ['alice@example.com'])
 
     def test_activation(self):
         """
@@ -105,6 +114,19 @@ class RegistrationModelTests(RegistrationTestCase):
         # Activating from a key that doesn't exist returns False.
         self.failIf(RegistrationProfile.objects.activate_user(sha.new('foo').hexdigest()))
 
+    def test_activation_queries(self):
+        """
+        Test that activating an account costs the same few queries
+        however many accounts there are.
+        
+        """
+        activation_key = RegistrationProfile.objects.get(user=self.sample_user).activation_key
+        with self.assertNumQueries(3):
+            user = RegistrationProfile.objects.activate_user(activation_key)
+        self.failUnless(user.is_active)
+        self.failUnless(User.objects.get(pk=self.sample_user.pk).is_active)
+        self.failIf(RegistrationProfile.objects.activate_user(activation_key))
+    
     def test_account_expiration_condition(self):
         """
         Test that ``RegistrationProfile.activation_key_expired()``
@@ -132,14 +154,101 @@ class RegistrationModelTests(RegistrationTestCase):
         RegistrationProfile.objects.delete_expired_users()
         self.assertEqual(RegistrationProfile.objects.count(), 1)
 
+    def test_expired_user_deletion_batches(self):
+        """
+        Test that deleting expired users in batches deletes all of
+        them, and reports progress after each batch.
+        
+        """
+        for i in range(4):
+            user = RegistrationProfile.objects.create_inactive_user(username='expired%s' % i,
+                                                                    password='secret',
+                                                                    email='expired%s@example.com' % i)
+            user.date_joined -= datetime.timedelta(days=settings.ACCOUNT_ACTIVATION_DAYS + 1)
+            user.save()
+        progress = []
+        
+        self.assertEqual(RegistrationProfile.objects.delete_expired_users(batch_size=2,
+                                                                          progress=progress.append),
+                         5)
+        self.assertEqual(progress, [2, 4, 5])
+        self.assertEqual(RegistrationProfile.objects.count(), 1)
+        self.failUnless(User.objects.filter(pk=self.sample_user.pk).exists())
+    
+    def test_expired_activated_user_kept(self):
+        """
+        Test that a user who activated isn't deleted, however long
+        ago they signed up.
+        
+        """
+        RegistrationProfile.objects.activate_user(RegistrationProfile.objects.get(user=self.sample_user).activation_key)
+        User.objects.filter(pk=self.sample_user.pk).update(date_joined=self.expired_user.date_joined)
+        
+        RegistrationProfile.objects.delete_expired_users()
+        self.failUnless(User.objects.filter(pk=self.sample_user.pk).exists())
+        self.failIf(User.objects.filter(pk=self.expired_user.pk).exists())
+    
+    def test_activated_since_found_kept(self):
+        """
+        Test that a user who activates after being found expired, but
+        before being deleted, isn't deleted, and isn't counted.
+        
+        """
+        RegistrationProfile.objects.activate_user(RegistrationProfile.objects.get(user=self.sample_user).activation_key)
+        
+        self.assertEqual(RegistrationProfile.objects._delete_users([self.sample_user.pk,
+                                                                    self.expired_user.pk]),
+                         1)
+        self.failUnless(User.objects.filter(pk=self.sample_user.pk).exists())
+        self.failIf(User.objects.filter(pk=self.expired_user.pk).exists())
+    
     def test_management_command(self):
         """
         Test that ``manage.py cleanupregistration`` functions
         correctly.
         
         """
-        management.call_command('cleanupregistration')
+        management.call_command('cleanupregistration', verbosity=0)
         self.assertEqual(RegistrationProfile.objects.count(), 1)
+    
+    def test_management_command_dry_run(self):
+        """
+        Test that ``manage.py cleanupregistration --dry-run``
+        doesn't delete anything.
+        
+        """
+        management.call_command('cleanupregistration', dry_run=True, verbosity=0)
+        self.assertEqual(RegistrationProfile.objects.count(), 2)
+
+
+class RegistrationTransactionTests(TransactionTestCase):
+    """
+    Tests for activating accounts within a transaction of the
+    caller's.
+    
+    """
+    def test_activation_rolled_back_with_caller(self):
+        """
+        Test that activation leaves the caller's transaction for the
+        caller to commit, so if the caller rolls back, the account
+        isn't activated.
+        
+        """
+        user = RegistrationProfile.objects.create_inactive_user(username='alice',
+                                                                password='secret',
+                                                                email='alice@example.com',
+                                                                send_email=False)
+        activation_key = RegistrationProfile.objects.get(user=user).activation_key
+        try:
+            with transaction.commit_on_success():
+                self.failUnless(RegistrationProfile.objects.activate_user(activation_key))
+                raise ValueError
+        except ValueError:
+            pass
+        
+        self.failIf(User.objects.get(pk=user.pk).is_active)
+        self.failUnlessEqual(RegistrationProfile.objects.get(user=user).activation_key,
+                             activation_key)
 
 
 class RegistrationFormTests(RegistrationTestCase):
@@ -316,3 +425,103 @@ class RegistrationViewTests(RegistrationTestCase):
         response = self.client.get(reverse('registration_activate',
                                            kwargs={ 'activation_key': sha.new('foo').hexdigest() }))
         self.failIf(response.context['account'])
+
+
+class FlakyEmailBackend(locmem.EmailBackend):
+    """
+    An email backend which fails to send to anyone at
+    ``broken.example.com``, and counts how many times it's opened.
+    
+    """
+    opened = 0
+    
+    def open(self):
+        FlakyEmailBackend.opened += 1
+    
+    def send_messages(self, messages):
+        for message in messages:
+            if message.to[0].endswith('@broken.example.com'):
+                raise smtplib.SMTPRecipientsRefused({message.to[0]: (550, 'No such user')})
+        return super(FlakyEmailBackend, self).send_messages(messages)
+
+
+class QueuedEmailTests(TestCase):
+    """
+    Tests for the email outbox.
+    
+    """
+    def setUp(self):
+        FlakyEmailBackend.opened = 0
+    
+    def queue(self, recipient):
+        return QueuedEmail.objects.queue('Subject', 'Body', 'site@example.com', [recipient])
+    
+    def test_send_queued(self):
+        """
+        Test that queued emails are sent in batches over one
+        connection per batch, and only once.
+        
+        """
+        for i in range(5):
+            self.queue('user%s@example.com' % i)
+        
+        self.assertEqual(QueuedEmail.objects.send_queued(batch_size=3, connection=FlakyEmailBackend()),
+                         (3, 0))
+        self.assertEqual(QueuedEmail.objects.send_queued(batch_size=3, connection=FlakyEmailBackend()),
+                         (2, 0))
+        self.assertEqual(QueuedEmail.objects.send_queued(batch_size=3, connection=FlakyEmailBackend()),
+                         (0, 0))
+        self.assertEqual(FlakyEmailBackend.opened, 2)
+        self.assertEqual([message.to for message in mail.outbox],
+                         [['user%s@example.com' % i] for i in range(5)])
+        self.assertEqual(QueuedEmail.objects.filter(sent__isnull=True).count(), 0)
+    
+    def test_sent_kept_when_interrupted(self):
+        """
+        Test that emails sent before sending is interrupted part way
+        through a batch are marked sent, and not sent again.
+        
+        """
+        class InterruptedEmailBackend(FlakyEmailBackend):
+            def send_messages(self, messages):
+                if messages[0].to[0] == 'last@example.com':
+                    raise KeyboardInterrupt
+                return super(InterruptedEmailBackend, self).send_messages(messages)
+        
+        first = self.queue('first@example.com')
+        last = self.queue('last@example.com')
+        self.assertRaises(KeyboardInterrupt, QueuedEmail.objects.send_queued,
+                          connection=InterruptedEmailBackend())
+        self.failUnless(QueuedEmail.objects.get(pk=first.pk).sent)
+        self.failIf(QueuedEmail.objects.get(pk=last.pk).sent)
+        
+        QueuedEmail.objects.filter(pk=last.pk).update(recipients='other@example.com')
+        self.assertEqual(QueuedEmail.objects.send_queued(connection=FlakyEmailBackend()), (1, 0))
+        self.assertEqual([message.to for message in mail.outbox],
+                         [['first@example.com'], ['other@example.com']])
+    
+    def test_retry_failures(self):
+        """
+        Test that a failed email is kept with its error, retried once
+        it's due, and given up on after too many failures.
+        
+        """
+        broken = self.queue('someone@broken.example.com')
+        self.queue('someone@example.com')
+        
+        self.assertEqual(QueuedEmail.objects.send_queued(connection=FlakyEmailBackend()), (1, 1))
+        broken = QueuedEmail.objects.get(pk=broken.pk)
+        self.assertEqual(broken.attempts, 1)
+        self.failUnless('No such user' in broken.last_error)
+        self.failIf(broken.sent)
+        
+        # Not due again yet.
+        self.assertEqual(QueuedEmail.objects.send_queued(connection=FlakyEmailBackend()), (0, 0))
+        
+        QueuedEmail.objects.update(next_attempt=datetime.datetime(2000, 1, 1, tzinfo=utc))
+        self.assertEqual(QueuedEmail.objects.send_queued(max_attempts=2, connection=FlakyEmailBackend()),
+                         (0, 1))
+        QueuedEmail.objects.update(next_attempt=datetime.datetime(2000, 1, 1, tzinfo=utc))
+        self.assertEqual(QueuedEmail.objects.send_queued(max_attempts=2, connection=FlakyEmailBackend()),
+                         (0, 0))
+        self.assertEqual(QueuedEmail.objects.get(pk=broken.pk).attempts, 2)
@@ -94,8 +94,14 @@ TEMPLATE_LOADERS = (
     'django.template.loaders.filesystem.Loader',
     'django.template.loaders.app_directories.Loader',
 )
+# Without DEBUG, compile each template once rather than for every render.
+if not DEBUG:
+    TEMPLATE_LOADERS = (
+        ('django.template.loaders.cached.Loader', TEMPLATE_LOADERS),
+    )
 
 MIDDLEWARE_CLASSES = (
+    'demo_blog.blog.middleware.QueryInstrumentationMiddleware',
     'johnny.middleware.LocalStoreClearMiddleware',
     'johnny.middleware.QueryCacheMiddleware',    
     'django.middleware.common.CommonMiddleware',
@@ -114,6 +120,38 @@ CACHES = {
 }
 JOHNNY_MIDDLEWARE_KEY_PREFIX='jc_tblog'
 
+#how long the blog keeps rendered pages and comment threads cached, in seconds.
+#they're also invalidated whenever a post or comment changes; see blog/cache.py
+BLOG_PAGE_CACHE_TIMEOUT = 60 * 60
+
+#posts with up to this many comments keep them all in the cache, so that
+#paging through them doesn't touch the database, as long as they pickle to
+#no more than BLOG_COMMENT_TREE_MAX_BYTES.  Keep that within the largest
+#value memcached takes (1MB by default).
+BLOG_COMMENT_TREE_MAX_COMMENTS = 1000
+BLOG_COMMENT_TREE_MAX_BYTES = 1000 * 1000
+
+#deleting a post with many comments can take a while.  If this is on, deleted
+#posts are only hidden, and the purge_deleted_posts command (run it from cron)
+#deletes them later.
+BLOG_DEFER_POST_DELETION = False
+
+#log the queries, cache hits and template time of every request, and add them
+#as response headers; see blog/middleware.py.  Requests taking longer than
+#BLOG_SLOW_REQUEST_TIME seconds are logged as warnings.
+BLOG_INSTRUMENTATION = False
+BLOG_INSTRUMENTATION_HEADERS = True
+BLOG_SLOW_REQUEST_TIME = 1.0
+
+#where new comments are published for the server-sent events view; see
+#blog/broker.py.  LocalBroker only reaches browsers connected to the same
+#process, PostgresBroker reaches every process using the database.  Idle
+#event streams send a keep-alive every BLOG_EVENTS_KEEPALIVE seconds, and
+#end after BLOG_EVENTS_MAX_TIME seconds, when browsers reconnect.
+BLOG_COMMENT_BROKER = 'demo_blog.blog.broker.LocalBroker'
+BLOG_EVENTS_KEEPALIVE = 15
+BLOG_EVENTS_MAX_TIME = 300
+
 ROOT_URLCONF = 'demo_blog.urls'
 
 # Python dotted path to the WSGI application used by Django's runserver.
@@ -146,6 +184,11 @@ TEMPLATE_CONTEXT_PROCESSORS = (
 # go home after login
 LOGIN_REDIRECT_URL = '/' 
 
+# Queue activation emails instead of sending them during the signup request.
+# They're sent by "manage.py send_queued_mail", which should be run regularly
+# (or left running with --loop).
+REGISTRATION_QUEUE_EMAIL = True
+
 INSTALLED_APPS = (
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -178,7 +221,11 @@ LOGGING = {
             'level': 'ERROR',
             'filters': ['require_debug_false'],
             'class': 'django.utils.log.AdminEmailHandler'
-        }
+        },
+        'console': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
     },
     'loggers': {
         'django.request': {
@@ -186,5 +233,15 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        'blog.instrumentation': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+        'blog.models': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
     }
 }
@@ -0,0 +1,22 @@
+"""
+Transaction handling shared by the blog and registration apps.
+"""
+
+from contextlib import contextmanager
+
+from django.db import transaction
+
+
+@contextmanager
+def commit_on_success_unless_managed():
+    """
+    Like transaction.commit_on_success(), but if the caller is already
+    managing the transaction, leave it to the caller to commit or roll
+    back.  A nested commit_on_success() would commit the caller's
+    transaction, half done, on the way out.
+    """
+    if transaction.is_managed():
+        yield
+    else:
+        with transaction.commit_on_success():
+            yield